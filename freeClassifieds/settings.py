@@ -15,6 +15,23 @@ ALLOWED_HOSTS = ['*']
 MEDIA_URL  = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Media in an S3 bucket (MinIO etc. through AWS_S3_ENDPOINT_URL) instead of
+# MEDIA_ROOT. Credentials are read from AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY.
+USE_S3 = os.getenv('USE_S3', '').lower() in ('1', 'true', 'yes')
+AWS_STORAGE_BUCKET_NAME = os.getenv('AWS_STORAGE_BUCKET_NAME')
+AWS_S3_REGION_NAME = os.getenv('AWS_S3_REGION_NAME')
+AWS_S3_ENDPOINT_URL = os.getenv('AWS_S3_ENDPOINT_URL')
+AWS_S3_CUSTOM_DOMAIN = os.getenv('AWS_S3_CUSTOM_DOMAIN')
+AWS_S3_SIGNATURE_VERSION = 's3v4'
+# listing images are public (bucket policy), so their URLs need no signature
+AWS_QUERYSTRING_AUTH = False
+AWS_DEFAULT_ACL = None
+
+# direct uploads: how long a presigned PUT URL is valid (seconds) and the
+# largest image a client may upload with one
+DIRECT_UPLOAD_EXPIRY = 600
+DIRECT_UPLOAD_MAX_SIZE = 15 * 1024 * 1024
+
 
 PAYSTACK_PUBLIC_KEY = 'pk_test_9e045e55f0f33796dc48365b2a4fa0dcc8ea0e92'
 PAYSTACK_SECRET_KEY	= 'sk_test_21573d264afc3cc181acbbbff1ced33c56e86adf'
@@ -62,15 +79,10 @@ JAZZMIN_SETTINGS = {
     # 2) still only order your main app
     "order_with_respect_to": ["main"],
 
-    "custom_css": [
-
-        "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css",
-
-        "css/jazzmin-overrides.css",
-    ],
-    "custom_js": [
-        "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/js/all.min.js",
-    ],
+    # a single static path each: jazzmin passes these to {% static %}, and
+    # it already bundles Font Awesome 6
+    "custom_css": "css/jazzmin-overrides.css",
+    "custom_js": None,
 
     "custom_dashboard_link": "admin:dashboard",  
 
@@ -136,6 +148,8 @@ JAZZMIN_UI_TWEAKS = {
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # serves /static/ before anything else does work on the request
+    'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -143,7 +157,6 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
 ]
 
 ROOT_URLCONF = 'freeClassifieds.urls'
@@ -200,7 +213,9 @@ CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
-            "hosts": [REDIS_URL]
+            # channels_redis spreads groups and channels over every host given,
+            # so chat fan-out can be split across several Redis instances
+            "hosts": os.getenv('CHANNEL_REDIS_URLS', REDIS_URL).split(','),
         },
     },
 }
@@ -237,6 +252,33 @@ REST_FRAMEWORK = {
     ],
 }
 
+# listings per page on the property feed (clients may ask for up to 100)
+PROPERTY_PAGE_SIZE = 20
+
+# seconds between flushes of buffered property visits to the database
+VISIT_FLUSH_INTERVAL = 10
+
+# processes rendering uploaded property images; 0 renders in the web process
+IMAGE_WORKERS = 2
+
+# uploads larger than this are streamed to a temporary file instead of memory
+FILE_UPLOAD_MAX_MEMORY_SIZE = 512 * 1024
+
+# seconds a websocket handshake may reuse the user its token resolved to
+WEBSOCKET_USER_CACHE_TTL = 60
+
+# seconds a chat socket counts as online after connecting or its last
+# heartbeat; clients send {"type": "heartbeat"} every 25 seconds or so
+PRESENCE_TTL = 60
+
+# seconds a push for a message to an offline user waits in the outbox so
+# a burst of messages to them becomes one notification
+MESSAGE_PUSH_DELAY = 5
+
+# seconds a message email waits in the outbox so further messages to the
+# same recipient can be sent with it as one digest
+MESSAGE_EMAIL_DELAY = 60
+
 CSRF_TRUSTED_ORIGINS = [
     "https://casaz-2.onrender.com",
     'http://192.168.157.75:8000',
@@ -274,6 +316,18 @@ STATICFILES_DIRS = [
 STATIC_URL = "/static/"
 STATIC_ROOT = BASE_DIR / "staticfiles"
 
+# collectstatic writes content-hashed copies of every file plus .br and .gz
+# variants; WhiteNoise serves the hashed names with a one-year immutable
+# Cache-Control (when DEBUG is off) and picks the variant the client accepts
+STORAGES = {
+    'default': {
+        'BACKEND': 'main.storages.MediaStorage' if USE_S3 else 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage'},
+}
+# jazzmin asks {% static %} for the vendor/bootswatch directory, which has no manifest entry
+WHITENOISE_MANIFEST_STRICT = False
+
 # Internationalization
 LANGUAGE_CODE = 'en-us'
 TIME_ZONE = 'UTC'
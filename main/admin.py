@@ -1,5 +1,5 @@
 from django.contrib import admin
-from . import models
+from . import models, services
 
 
 @admin.register(models.CompleteUser)
@@ -15,6 +15,12 @@ class PropertyAdmin(admin.ModelAdmin):
     list_editable = ['is_verified', 'is_featured', 'is_recommended', 'is_promoted',]
     search_fields = ['creator', 'type', 'property_type']
     list_filter = ['date_posted', 'is_featured', 'price']
+    actions = ['mark_verified']
+
+    @admin.action(description='Mark selected listings as verified')
+    def mark_verified(self, request, queryset):
+        count = services.verify_properties(queryset)
+        self.message_user(request, f'{count} listing(s) verified.')
 
 @admin.register(models.City)
 class CityAdmin(admin.ModelAdmin):
@@ -28,6 +34,12 @@ class MessageAdmin(admin.ModelAdmin):
     list_display = ['sender', 'recipient', 'timestamp', 'is_read']
     list_filter = ['timestamp']
 
+
+@admin.register(models.Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ['user_low', 'user_high', 'unread_low', 'unread_high', 'last_activity']
+    raw_id_fields = ['user_low', 'user_high', 'last_message']
+
 @admin.register(models.PropertyFeature)
 class PropertyFeature(admin.ModelAdmin):
     list_display = ['name']
@@ -66,6 +78,12 @@ class ListingPaymentAdmin(admin.ModelAdmin):
     list_display = ['user', 'property', 'amount', 'status']
 
 
+@admin.register(models.OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ['channel', 'dedupe_key', 'created_at', 'attempts', 'delivered_at']
+    list_filter = ['channel']
+
+
 @admin.register(models.Perk)
 class PerkAdmin(admin.ModelAdmin):
     list_display = ['code', 'label', 'has_badge', 'has_double_badge']
@@ -0,0 +1,364 @@
+"""
+Unread badges: per user, how many messages they have not read (in total
+and per conversation) and how many unread notifications, so a badge is
+one hash read instead of counting rows.
+
+The counters change once the transaction that changed what is unread
+commits: new messages and notifications add to them, read receipts and
+NotificationViewSet.mark_read take away. Anything else (editing or
+deleting messages and notifications) recounts the users involved from
+Postgres, and so does `manage.py reconcile_badges`, which puts right
+whatever drift a lost update or a flushed Redis has left. Users without
+counters yet are counted from Postgres the first time they are needed, and
+so is everyone while Redis is unreachable.
+
+After every change the user's NotificationConsumer sockets get the new
+figures as {"type": "badges", "messages": n, "notifications": n,
+"conversations": {<other user id>: n}}, conversations holding only the
+ones that changed.
+
+Counters live in a Redis hash per user when the default cache is
+django_redis, otherwise in an in-process dict.
+"""
+import asyncio
+import logging
+import threading
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from . import deferred
+
+
+logger = logging.getLogger(__name__)
+
+MESSAGES = 'messages'
+NOTIFICATIONS = 'notifications'
+# present once a user's counters have been counted from Postgres
+SEEDED = 'seeded'
+RECONCILE_BATCH_SIZE = 1000
+
+# what NotificationViewSet lists
+VISIBLE_NOTIFICATIONS = Q(content_type__isnull=False, object_id__isnull=False)
+
+# adds ARGV's (field, delta) pairs to the hash KEYS[1], dropping fields
+# that reach zero, and returns the new values; returns nil without
+# touching anything when the hash has not been seeded
+APPLY_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return false
+end
+local values = {}
+for i = 2, #ARGV, 2 do
+    local value = redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+    if value <= 0 then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+        value = 0
+    end
+    values[#values + 1] = value
+end
+return values
+"""
+
+
+def conversation_field(other_id):
+    return f'c:{other_id}'
+
+
+class RedisBadges:
+    prefix = 'badges:'
+
+    def __init__(self):
+        from django_redis import get_redis_connection
+        self.redis = get_redis_connection('default')
+        self.script = self.redis.register_script(APPLY_SCRIPT)
+
+    def apply(self, changes):
+        """{user_id: {field: delta}} -> {user_id: {field: value}, or None if not seeded}."""
+        user_ids = list(changes)
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            args = [SEEDED]
+            for field, delta in changes[user_id].items():
+                args += [field, delta]
+            self.script(keys=[f'{self.prefix}{user_id}'], args=args, client=pipe)
+        results = {}
+        for user_id, values in zip(user_ids, pipe.execute()):
+            results[user_id] = None if values is None else dict(zip(changes[user_id], values))
+        return results
+
+    def get(self, user_id):
+        counts = self.redis.hgetall(f'{self.prefix}{user_id}')
+        if SEEDED.encode() not in counts:
+            return None
+        return {field.decode(): int(value) for field, value in counts.items()}
+
+    def replace(self, user_ids, recount):
+        """
+        Set the counters of `user_ids` to recount(user_ids) and return those.
+        The hashes are watched while counting: if apply() changes one before
+        the write, the users are counted again (in halves, so one busy user
+        does not hold up a whole batch) instead of losing its delta.
+        """
+        from redis.exceptions import WatchError
+
+        counts = {}
+        batches = [list(user_ids)]
+        with self.redis.pipeline() as pipe:
+            while batches:
+                batch = batches.pop()
+                try:
+                    pipe.watch(*[f'{self.prefix}{user_id}' for user_id in batch])
+                    batch_counts = recount(batch)
+                    pipe.multi()
+                    for user_id, fields in batch_counts.items():
+                        key = f'{self.prefix}{user_id}'
+                        pipe.delete(key)
+                        pipe.hset(key, mapping={SEEDED: 1, **{field: value for field, value in fields.items() if value}})
+                    pipe.execute()
+                except WatchError:
+                    half = (len(batch) + 1) // 2
+                    batches += [batch[:half], batch[half:]] if len(batch) > 1 else [batch]
+                    continue
+                counts.update(batch_counts)
+        return counts
+
+    def forget(self, user_id):
+        self.redis.delete(f'{self.prefix}{user_id}')
+
+    def user_ids(self):
+        return [int(key.decode()[len(self.prefix):]) for key in self.redis.scan_iter(f'{self.prefix}*', count=1000)]
+
+
+class LocalBadges:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        # bumped by apply(), so replace() can tell a user changed while counting
+        self.versions = {}
+
+    def apply(self, changes):
+        results = {}
+        with self.lock:
+            for user_id, fields in changes.items():
+                counts = self.counts.get(user_id)
+                if counts is None:
+                    results[user_id] = None
+                    continue
+                self.versions[user_id] = self.versions.get(user_id, 0) + 1
+                results[user_id] = {}
+                for field, delta in fields.items():
+                    value = counts.get(field, 0) + delta
+                    if value <= 0:
+                        counts.pop(field, None)
+                        value = 0
+                    else:
+                        counts[field] = value
+                    results[user_id][field] = value
+        return results
+
+    def get(self, user_id):
+        with self.lock:
+            counts = self.counts.get(user_id)
+            return None if counts is None else {SEEDED: 1, **counts}
+
+    def replace(self, user_ids, recount):
+        while True:
+            with self.lock:
+                versions = [self.versions.get(user_id) for user_id in user_ids]
+            counts = recount(user_ids)
+            with self.lock:
+                if versions != [self.versions.get(user_id) for user_id in user_ids]:
+                    continue
+                for user_id, fields in counts.items():
+                    self.counts[user_id] = {field: value for field, value in fields.items() if value}
+            return counts
+
+    def forget(self, user_id):
+        with self.lock:
+            self.counts.pop(user_id, None)
+
+    def user_ids(self):
+        with self.lock:
+            return list(self.counts)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                backend = settings.CACHES['default']['BACKEND']
+                _store = RedisBadges() if backend.startswith('django_redis') else LocalBadges()
+    return _store
+
+
+def reset():
+    """Forget every counter (tests)."""
+    global _store
+    _store = None
+
+
+def badge(counts):
+    """The API and websocket shape of a user's counters."""
+    return {
+        'messages': counts.get(MESSAGES, 0),
+        'notifications': counts.get(NOTIFICATIONS, 0),
+        'conversations': {
+            int(field[2:]): value for field, value in counts.items() if field.startswith('c:')
+        },
+    }
+
+
+def get(user_id):
+    """
+    A user's badge, counted from Postgres if they have no counters yet or
+    the counters cannot be read.
+    """
+    try:
+        counts = get_store().get(user_id)
+        if counts is None:
+            counts = reconcile([user_id], notify=False)[user_id]
+    except Exception:
+        logger.exception('Reading the badges of user %s failed', user_id)
+        counts = count([user_id])[user_id]
+    return badge(counts)
+
+
+def count(user_ids):
+    """{user_id: {field: value}} of `user_ids` from Postgres."""
+    from .models import Message, Notification
+
+    counts = {user_id: {MESSAGES: 0, NOTIFICATIONS: 0} for user_id in user_ids}
+    unread_messages = (
+        Message.objects.filter(recipient_id__in=user_ids, is_read=False)
+        .values_list('recipient_id', 'sender_id').annotate(unread=Count('*')).order_by()
+    )
+    for recipient_id, sender_id, unread in unread_messages:
+        counts[recipient_id][MESSAGES] += unread
+        counts[recipient_id][conversation_field(sender_id)] = unread
+    unread_notifications = (
+        Notification.objects.filter(VISIBLE_NOTIFICATIONS, user_id__in=user_ids, is_read=False)
+        .values_list('user_id').annotate(unread=Count('*')).order_by()
+    )
+    for user_id, unread in unread_notifications:
+        counts[user_id][NOTIFICATIONS] = unread
+    return counts
+
+
+def reconcile(user_ids=None, notify=True):
+    """
+    Recount the counters of `user_ids`, or of everyone who has any, from
+    Postgres. Returns the new counters by user.
+    """
+    from .models import Message, Notification
+
+    if user_ids is None:
+        user_ids = set(get_store().user_ids())
+        user_ids.update(Message.objects.filter(is_read=False).values_list('recipient_id', flat=True).distinct())
+        user_ids.update(
+            Notification.objects.filter(VISIBLE_NOTIFICATIONS, is_read=False).values_list('user_id', flat=True).distinct()
+        )
+    user_ids = sorted(user_ids)
+
+    counts = {}
+    for start in range(0, len(user_ids), RECONCILE_BATCH_SIZE):
+        counts.update(get_store().replace(user_ids[start:start + RECONCILE_BATCH_SIZE], count))
+    if notify:
+        push({user_id: badge(fields) for user_id, fields in counts.items()})
+    return counts
+
+
+def push(badges):
+    """Send {user_id: badge} to the users' NotificationConsumer sockets."""
+    if not badges:
+        return
+    from channels.layers import get_channel_layer
+
+    channel_layer = get_channel_layer()
+
+    async def send():
+        await asyncio.gather(*(
+            channel_layer.group_send(f'notifications_{user_id}', {'type': 'notify', 'data': {'type': 'badges', **data}})
+            for user_id, data in badges.items()
+        ))
+
+    try:
+        async_to_sync(send)()
+    except Exception:
+        logger.exception('Pushing badges to %d user(s) failed', len(badges))
+
+
+def apply(changes):
+    """Add {user_id: {field: delta}} to the counters now and push the results."""
+    try:
+        results = get_store().apply(changes)
+    except Exception:
+        logger.exception('Updating the badges of %d user(s) failed', len(changes))
+        return
+    unseeded = [user_id for user_id, values in results.items() if values is None]
+    if unseeded:
+        # counting includes the change that was just committed
+        results.update(reconcile(unseeded, notify=False))
+    push({user_id: badge(values) for user_id, values in results.items()})
+
+
+def change(changes):
+    """Apply {user_id: {field: delta}} once the current transaction commits."""
+    changes = {user_id: {MESSAGES: 0, NOTIFICATIONS: 0, **fields} for user_id, fields in changes.items() if fields}
+    if changes:
+        transaction.on_commit(lambda: apply(changes))
+
+
+def recount(user_ids):
+    """
+    Reconcile `user_ids` once the current transaction commits, together
+    with every other user recounted in it (cascaded deletes recount per row).
+    """
+    deferred.collect('badges.recount', user_ids, _recount)
+
+
+def _recount(user_ids):
+    try:
+        reconcile(user_ids)
+    except Exception:
+        logger.exception('Recounting the badges of %d user(s) failed', len(user_ids))
+
+
+def forget(user_id):
+    transaction.on_commit(lambda: get_store().forget(user_id))
+
+
+def messages_created(messages):
+    changes = {}
+    for message in messages:
+        if message.is_read:
+            continue
+        fields = changes.setdefault(message.recipient_id, {MESSAGES: 0})
+        fields[MESSAGES] += 1
+        field = conversation_field(message.sender_id)
+        fields[field] = fields.get(field, 0) + 1
+    change(changes)
+
+
+def messages_read(reader_id, other_id, marked):
+    change({reader_id: {MESSAGES: -marked, conversation_field(other_id): -marked}})
+
+
+def notifications_created(notifications):
+    changes = {}
+    for notification in notifications:
+        if notification.is_read or notification.content_type_id is None or notification.object_id is None:
+            continue
+        fields = changes.setdefault(notification.user_id, {NOTIFICATIONS: 0})
+        fields[NOTIFICATIONS] += 1
+    change(changes)
+
+
+def notifications_read(user_id, marked):
+    change({user_id: {NOTIFICATIONS: -marked}})
@@ -0,0 +1,134 @@
+"""
+Reference counting for the content-addressed image storage.
+
+Identical files share one stored copy (see main/storages.py), so a file may
+only be deleted once nothing points at it any more. Every name a
+PropertyImage stores (original and renditions) is acquire()d when it is
+assigned and release()d when it is replaced or the image is deleted.
+
+A file whose count drops to zero is not deleted straight away: the same
+bytes may be in the middle of being uploaded again, and that upload has
+already found the file in storage. collect_garbage() deletes files that have
+been unreferenced for longer than GRACE.
+"""
+import logging
+import re
+from collections import Counter
+from datetime import timedelta
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import ImageBlob, PropertyImage
+
+
+logger = logging.getLogger(__name__)
+
+GRACE = timedelta(hours=1)
+DIGEST_PATTERN = re.compile(r'([0-9a-f]{64})\.\w+$')
+
+ACQUIRE_SQL = """
+    INSERT INTO main_imageblob (name, sha256, phash, size, ref_count, created_at, released_at)
+    VALUES {rows}
+    ON CONFLICT (name) DO UPDATE SET
+        ref_count = main_imageblob.ref_count + EXCLUDED.ref_count,
+        released_at = NULL,
+        phash = CASE WHEN main_imageblob.phash = '' THEN EXCLUDED.phash ELSE main_imageblob.phash END,
+        size = COALESCE(main_imageblob.size, EXCLUDED.size)
+"""
+
+
+def storage():
+    return PropertyImage._meta.get_field('images').storage
+
+
+def _digest(name):
+    match = DIGEST_PATTERN.search(name)
+    return match.group(1) if match else ''
+
+
+def _counts(names):
+    return Counter(name for name in names if name)
+
+
+def acquire(names, phashes=None, sizes=None):
+    """
+    Add one reference per occurrence of each name. A single upsert, so a
+    count is never lost to a concurrent release or collection.
+    """
+    counts = _counts(names)
+    if not counts:
+        return
+    phashes, sizes, now = phashes or {}, sizes or {}, timezone.now()
+    rows = [
+        (name, _digest(name), phashes.get(name, ''), sizes.get(name), amount, now, None)
+        for name, amount in sorted(counts.items())
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            ACQUIRE_SQL.format(rows=', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(rows))),
+            [value for row in rows for value in row],
+        )
+
+
+def release(names):
+    """Drop one reference per occurrence of each name."""
+    counts = _counts(names)
+    if not counts:
+        return
+
+    # files stored before reference counting existed have no row yet
+    existing = set(ImageBlob.objects.filter(name__in=counts).values_list('name', flat=True))
+    ImageBlob.objects.bulk_create(
+        [ImageBlob(name=name, sha256=_digest(name), ref_count=counts[name]) for name in counts if name not in existing],
+        ignore_conflicts=True,
+    )
+
+    by_amount = {}
+    for name, amount in counts.items():
+        by_amount.setdefault(amount, []).append(name)
+    for amount, group in by_amount.items():
+        ImageBlob.objects.filter(name__in=group).update(ref_count=F('ref_count') - amount)
+    ImageBlob.objects.filter(name__in=counts, ref_count__lte=0, released_at__isnull=True).update(
+        released_at=timezone.now(),
+    )
+
+
+def discard(names):
+    """
+    Hand files that were written but never acquired (e.g. renditions of an
+    image deleted while it was processed) to the garbage collector, unless
+    something references them.
+    """
+    now = timezone.now()
+    ImageBlob.objects.bulk_create(
+        [ImageBlob(name=name, sha256=_digest(name), released_at=now) for name in _counts(names)],
+        ignore_conflicts=True,
+    )
+
+
+def references(image):
+    """Every stored name a PropertyImage points at."""
+    return [image.images.name, *(r['name'] for r in image.renditions)]
+
+
+def collect_garbage(grace=GRACE, batch_size=500):
+    """
+    Delete files that have had no references for longer than `grace`.
+    Returns the number of files deleted.
+    """
+    cutoff = timezone.now() - grace
+    with transaction.atomic():
+        orphans = list(
+            ImageBlob.objects.filter(ref_count__lte=0, released_at__lte=cutoff)
+            .select_for_update(skip_locked=True)
+            .values_list('pk', 'name')[:batch_size]
+        )
+        ImageBlob.objects.filter(pk__in=[pk for pk, _ in orphans]).delete()
+
+    files = storage()
+    for _, name in orphans:
+        try:
+            files.delete(name)
+        except OSError:
+            logger.exception('Deleting orphaned image %s failed', name)
+    return len(orphans)
@@ -0,0 +1,126 @@
+import hashlib
+import uuid
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.response import Response
+
+
+PROPERTIES = 'properties'
+REGIONS = 'regions'
+CITIES = 'cities'
+SUBSCRIPTION_PLANS = 'subscription_plans'
+NAMESPACES = [PROPERTIES, REGIONS, CITIES, SUBSCRIPTION_PLANS]
+
+RESPONSE_TIMEOUT = 300
+
+
+def _version_key(namespace):
+    return f'resp:{namespace}:version'
+
+
+def _stats_key(namespace, outcome):
+    return f'resp:{namespace}:{outcome}'
+
+
+def namespace_version(namespace):
+    # a random token rather than a counter, so an evicted version key can never
+    # resurrect entries cached under an older version
+    return cache.get_or_set(_version_key(namespace), uuid.uuid4().hex, None)
+
+
+def invalidate(*namespaces):
+    """
+    Drop every cached response in the given namespaces once the current
+    transaction commits. Old entries are orphaned and age out on their TTL.
+    """
+    def bump():
+        cache.set_many({_version_key(ns): uuid.uuid4().hex for ns in namespaces}, None)
+
+    transaction.on_commit(bump)
+
+
+def record(namespace, outcome):
+    key = _stats_key(namespace, outcome)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, None)
+        cache.incr(key)
+
+
+def stats():
+    keys = {ns: (_stats_key(ns, 'hit'), _stats_key(ns, 'miss')) for ns in NAMESPACES}
+    values = cache.get_many([key for pair in keys.values() for key in pair])
+    return {
+        ns: {'hits': values.get(hit, 0), 'misses': values.get(miss, 0)}
+        for ns, (hit, miss) in keys.items()
+    }
+
+
+def response_key(namespace, view_name, request, lookup=None):
+    # normalise the query string so ?b=2&a=1 and ?a=1&b=2 share an entry
+    params = sorted(
+        (name, tuple(sorted(values)))
+        for name, values in request.query_params.lists()
+        if any(values)
+    )
+    raw = repr((request.get_host(), view_name, lookup, params))
+    digest = hashlib.sha1(raw.encode()).hexdigest()
+    return f'resp:{namespace}:{namespace_version(namespace)}:{digest}'
+
+
+class CachedResponseMixin:
+    """
+    Serve list/retrieve for anonymous users out of the cache. Authenticated
+    requests always go to the database since their querysets differ per user.
+    """
+    cache_namespace = None
+    cache_timeout = RESPONSE_TIMEOUT
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response('list', super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response('retrieve', super().retrieve, request, *args, **kwargs)
+
+    def cached_response(self, view_name, handler, request, *args, **kwargs):
+        if request.user.is_authenticated:
+            return handler(request, *args, **kwargs)
+
+        key = response_key(self.cache_namespace, view_name, request, kwargs.get(self.lookup_url_kwarg or self.lookup_field))
+        data = cache.get(key)
+        if data is not None:
+            record(self.cache_namespace, 'hit')
+            return Response(data)
+
+        record(self.cache_namespace, 'miss')
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            timeout = self.get_cache_timeout(response.data)
+            if timeout > 0:
+                cache.set(key, response.data, timeout)
+        return response
+
+    def get_cache_timeout(self, data):
+        return self.cache_timeout
+
+
+def seconds_until_first_expiry(data, default):
+    """
+    TTL for a cached property payload: never longer than the time until the
+    first listing in it expires, so expired listings drop out on their own.
+    """
+    if isinstance(data, dict):
+        items = data.get('results', [data])
+    else:
+        items = data
+
+    timeout = default
+    now = timezone.now()
+    for item in items:
+        expiry = parse_datetime(item.get('expiry_date') or '')
+        if expiry is not None:
+            timeout = min(timeout, int((expiry - now).total_seconds()))
+    return timeout
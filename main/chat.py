@@ -0,0 +1,113 @@
+"""
+Write-behind persistence of chat messages sent over websockets.
+
+ChatConsumer builds the Message (its UUID and timestamp are set up front),
+hands it to the writer of its event loop, and fans it out and acknowledges
+it to the sender right away. The writer is one task per process that
+saves whatever has queued up while the previous batch was being written
+with one bulk_create, updating their conversations and queueing their push
+and email in the same transaction. A burst of frames therefore costs a
+transaction per batch instead of three queries per message, and the sync
+thread is free in between.
+
+Messages are written in the order they were queued, so within a process a
+conversation is stored in the order it was sent. A batch that cannot be
+written is retried a few times, then written in halves until the message
+that fails it is on its own, so one bad row (a recipient deleted since the
+consumer looked them up) does not lose the rest. Senders are told over
+their socket ({"type": "failed", "ids": [...]}) which messages were lost,
+as they were already acknowledged.
+"""
+import asyncio
+import logging
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.db import transaction
+from . import conversations, delivery
+from .models import Message
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+# messages waiting to be written before ChatConsumer.receive has to wait
+MAX_PENDING = 10000
+ATTEMPTS = 3
+
+
+def persist(messages):
+    with transaction.atomic():
+        Message.objects.bulk_create(messages)
+        # bulk_create skips post_save; recipients have the message already
+        conversations.record(messages)
+        delivery.messages_created(messages, delivered_live=True)
+
+
+class MessageWriter:
+
+    def __init__(self):
+        self.queue = asyncio.Queue(MAX_PENDING)
+        self.task = None
+
+    async def submit(self, message, reply_channel=None):
+        """Queue an unsaved message; `reply_channel` hears about it if it is lost."""
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        await self.queue.put((message, reply_channel))
+
+    async def flush(self):
+        """Wait until everything queued so far is written (tests, benchmarks)."""
+        await self.queue.join()
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < BATCH_SIZE and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self.write(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def write(self, batch, attempts=ATTEMPTS):
+        messages = [message for message, _ in batch]
+        for attempt in range(attempts):
+            try:
+                await database_sync_to_async(persist)(messages)
+                return
+            except Exception:
+                logger.exception('Writing %d chat messages failed (attempt %d)', len(messages), attempt + 1)
+                if attempt + 1 < attempts:
+                    await asyncio.sleep(0.1 * 2 ** attempt)
+
+        if len(batch) > 1:
+            # the retries were for the database; what still fails is a row,
+            # and the halves only need one attempt each to find it
+            half = len(batch) // 2
+            await self.write(batch[:half], attempts=1)
+            await self.write(batch[half:], attempts=1)
+            return
+
+        lost = {}
+        for message, reply_channel in batch:
+            if reply_channel:
+                lost.setdefault(reply_channel, []).append(str(message.pk))
+        channel_layer = get_channel_layer()
+        for reply_channel, ids in lost.items():
+            await channel_layer.send(reply_channel, {'type': 'chat.failed', 'ids': ids})
+
+
+_writers = {}
+
+
+def get_writer():
+    """The writer of the running event loop."""
+    loop = asyncio.get_running_loop()
+    writer = _writers.get(loop)
+    if writer is None:
+        # writers of finished loops (tests, async_to_sync) are dropped here
+        for other in [other for other in _writers if other.is_closed()]:
+            del _writers[other]
+        writer = _writers[loop] = MessageWriter()
+    return writer
@@ -1,8 +1,11 @@
 import json
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
+from . import badges, chat, delivery, presence
 from .models import Message
 
 
@@ -17,16 +20,32 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
 
         self.room_group_name = f'chat_user_{user.id}'
+        # recipient id as sent -> user id, or None if there is no such user
+        self.recipients = {}
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.touch_presence()
         await self.accept()
 
     async def disconnect(self, close_code):
-        user = self.scope['user']
-        room_group = f'chat_user_{user.id}'
-        await self.channel_layer.group_discard(room_group, self.channel_name)
+        # rejected handshakes never joined a group
+        if hasattr(self, 'room_group_name'):
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+            await presence.disconnected(self.scope['user'].id, self.channel_name)
+
+    async def touch_presence(self):
+        self.presence_touched = time.monotonic()
+        await presence.heartbeat(self.scope['user'].id, self.channel_name)
 
     async def receive(self, text_data):
         data = json.loads(text_data)
+        if data.get('type') == 'heartbeat':
+            await self.touch_presence()
+            await self.send(text_data=json.dumps({'type': 'heartbeat'}))
+            return
+        # any other frame proves the socket is alive too; renew a few times per TTL at most
+        if time.monotonic() - self.presence_touched > settings.PRESENCE_TTL / 3:
+            await self.touch_presence()
+
         recipient_id = data.get('recipient')
         content = data.get('content')
 
@@ -34,70 +53,37 @@ class ChatConsumer(AsyncWebsocketConsumer):
         if not sender.is_authenticated or not recipient_id or not content:
             return
 
-        # Get avatar URL during message creation
-        result = await database_sync_to_async(self.save_message)(
-            sender.id, 
-            recipient_id, 
-            content,
-            sender.username
-        )
-        message = result['message']
-        avatar_url = result['avatar_url']
-
-        # Send message with avatar to recipient
-        await self.channel_layer.group_send(
-            f'chat_user_{recipient_id}',
-            {
-                'type': 'chat_message',
-                'message': {
-                    'id': message.id,
-                    'sender': sender.id,
-                    'sender_username': sender.username,
-                    'recipient': recipient_id,
-                    'content': message.content,
-                    'timestamp': str(message.timestamp),
-                    'is_read': message.is_read,
-                    'avatar_url': avatar_url,  # ADDED AVATAR URL
-                }
-            }
-        )
-
-        # Also send confirmation to sender with avatar
-        await self.send(text_data=json.dumps({
-            'message': {
-                'id': message.id,
-                'sender': sender.id,
-                'sender_username': sender.username,
-                'recipient': recipient_id,
-                'content': message.content,
-                'timestamp': str(message.timestamp),
-                'is_read': message.is_read,
-                'avatar_url': avatar_url,  # ADDED AVATAR URL
-            }
-        }))
-
-    def save_message(self, sender_id, recipient_id, content, sender_username):
-        sender = User.objects.get(id=sender_id)
-        recipient = User.objects.get(id=recipient_id)
-        message = Message.objects.create(
-            sender=sender,
-            recipient=recipient,
-            content=content,
-            sender_username=sender_username
-        )
-        
-        # Get sender's avatar URL (modify based on your Profile model)
-        avatar_url = None
-        try:
-            if sender.profile.avatar:  # Adjust this to match your profile structure
-                avatar_url = sender.profile.avatar.url
-        except Exception:
-            pass
-            
-        return {
-            'message': message,
-            'avatar_url': avatar_url
-        }
+        recipient_id = await self.resolve_recipient(recipient_id)
+        if recipient_id is None:
+            await self.send(text_data=json.dumps({'type': 'error', 'error': 'Unknown recipient.'}))
+            return
+
+        # acknowledged once queued; the writer saves it with whatever else is queued
+        message = Message(sender=sender, recipient_id=recipient_id, content=content)
+        await chat.get_writer().submit(message, self.channel_name)
+        payload = delivery.chat_payload(message)
+        await self.channel_layer.group_send(f'chat_user_{recipient_id}', {'type': 'chat_message', 'message': payload})
+        await self.send(text_data=json.dumps({'message': payload}))
+
+    async def resolve_recipient(self, recipient_id):
+        """The recipient's id if it is an active user; looked up once per conversation."""
+        key = str(recipient_id)
+        if key not in self.recipients:
+            self.recipients[key] = await database_sync_to_async(find_recipient)(recipient_id)
+        return self.recipients[key]
+
+    async def chat_message(self, event):
+        await self.send(text_data=json.dumps({'message': event['message']}))
+
+    async def chat_failed(self, event):
+        await self.send(text_data=json.dumps({'type': 'failed', 'ids': event['ids']}))
+
+
+def find_recipient(recipient_id):
+    try:
+        return User.objects.filter(pk=recipient_id, is_active=True).values_list('pk', flat=True).first()
+    except (TypeError, ValueError):
+        return None
 
 
 class NotificationConsumer(AsyncWebsocketConsumer):
@@ -110,9 +96,14 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         self.group_name = f'notifications_{user.id}'
         await self.channel_layer.group_add(self.group_name, self.channel_name)
         await self.accept()
+        # the current badge, then every change to it as it happens
+        badge = await database_sync_to_async(badges.get)(user.id)
+        await self.send(text_data=json.dumps({'type': 'badges', **badge}))
 
     async def disconnect(self, code):
-        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        # rejected handshakes never joined a group
+        if hasattr(self, 'group_name'):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
     async def notify(self, event):
         # Send notification payload
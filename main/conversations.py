@@ -0,0 +1,219 @@
+"""
+Conversation rows: one per pair of users who have exchanged messages, with
+the last message, each side's unread count and the last activity, so an
+inbox is one indexed query over Conversation instead of a scan of every
+message the user ever sent or received.
+
+They are maintained incrementally in the transaction that writes the
+messages: record() for new messages (one upsert per batch), mark_read()
+for a user's read receipt. Anything else that changes messages
+(edits, deletes) calls rebuild() for the pairs involved, which recomputes
+them from main_message; `manage.py rebuild_conversations` does that for
+every pair.
+
+history() reads a conversation a window at a time.
+"""
+import uuid
+from datetime import timedelta
+from django.db import connection
+from django.db.models import F, Q, Subquery, prefetch_related_objects
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+from . import badges
+from .models import Conversation, Message
+
+
+# how far behind a user's last read receipt the next one looks for unread
+# messages first: chat messages are timestamped when they are received
+# but written by chat.MessageWriter later (see mark_read for how much)
+RECEIPT_SLACK = timedelta(minutes=1)
+
+
+RECORD_SQL = """
+    INSERT INTO main_conversation (id, user_low_id, user_high_id, last_message_id, unread_low, unread_high, last_activity)
+    VALUES {rows}
+    ON CONFLICT (user_low_id, user_high_id) DO UPDATE SET
+        unread_low = main_conversation.unread_low + EXCLUDED.unread_low,
+        unread_high = main_conversation.unread_high + EXCLUDED.unread_high,
+        last_message_id = CASE WHEN EXCLUDED.last_activity >= main_conversation.last_activity
+            THEN EXCLUDED.last_message_id ELSE main_conversation.last_message_id END,
+        last_activity = GREATEST(main_conversation.last_activity, EXCLUDED.last_activity)
+"""
+
+REBUILD_SQL = """
+    INSERT INTO main_conversation (id, user_low_id, user_high_id, last_message_id, unread_low, unread_high, last_activity)
+    SELECT
+        gen_random_uuid(), low, high,
+        (array_agg(id ORDER BY timestamp DESC, id DESC))[1],
+        count(*) FILTER (WHERE NOT is_read AND recipient_id = low),
+        count(*) FILTER (WHERE NOT is_read AND recipient_id = high AND low <> high),
+        max(timestamp)
+    FROM (
+        SELECT id, timestamp, is_read, recipient_id,
+               LEAST(sender_id, recipient_id) AS low, GREATEST(sender_id, recipient_id) AS high
+        FROM main_message
+        {where}
+    ) messages
+    GROUP BY low, high
+    ON CONFLICT (user_low_id, user_high_id) DO UPDATE SET
+        last_message_id = EXCLUDED.last_message_id,
+        unread_low = EXCLUDED.unread_low,
+        unread_high = EXCLUDED.unread_high,
+        last_activity = EXCLUDED.last_activity
+"""
+
+
+def pair(user_id, other_id):
+    """(user_low, user_high) of the conversation between two users."""
+    return (user_id, other_id) if user_id <= other_id else (other_id, user_id)
+
+
+def pair_filter(user_id, other_id):
+    low, high = pair(user_id, other_id)
+    return Q(user_low_id=low, user_high_id=high)
+
+
+def involving(user_id):
+    return Q(user_low_id=user_id) | Q(user_high_id=user_id)
+
+
+def record(messages):
+    """Fold new messages into their conversations with a single upsert."""
+    rows = {}
+    for message in messages:
+        low, high = pair(message.sender_id, message.recipient_id)
+        row = rows.setdefault((low, high), {'last': message, 'unread_low': 0, 'unread_high': 0})
+        if message.timestamp >= row['last'].timestamp:
+            row['last'] = message
+        if not message.is_read:
+            row['unread_low' if message.recipient_id == low else 'unread_high'] += 1
+    if not rows:
+        return
+
+    # always in the same order, so concurrent batches cannot deadlock
+    values = [
+        (uuid.uuid4(), low, high, row['last'].pk, row['unread_low'], row['unread_high'], row['last'].timestamp)
+        for (low, high), row in sorted(rows.items())
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            RECORD_SQL.format(rows=', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(values))),
+            [value for row in values for value in row],
+        )
+
+
+def mark_read(reader_id, other_id, up_to=None):
+    """
+    Read receipt: mark what `other_id` sent `reader_id` up to the timestamp
+    `up_to` (everything if None) as read. Messages newer than the reader's
+    previous receipt are looked at first, and none at all when the
+    conversation has nothing unread for them. Returns the number of
+    messages marked.
+    """
+    side = 'low' if pair(reader_id, other_id)[0] == reader_id else 'high'
+    unread_field, read_field = f'unread_{side}', f'read_{side}_at'
+    conversation = Conversation.objects.filter(pair_filter(reader_id, other_id)).values(unread_field, read_field).first()
+    if not conversation or not conversation[unread_field]:
+        return 0
+
+    unread = Message.objects.filter(recipient_id=reader_id, sender_id=other_id, is_read=False)
+    if up_to is not None:
+        unread = unread.filter(timestamp__lte=up_to)
+    if conversation[read_field] is None:
+        marked = unread.update(is_read=True)
+    else:
+        marked = unread.filter(timestamp__gt=conversation[read_field] - RECEIPT_SLACK).update(is_read=True)
+        if conversation[unread_field] > marked:
+            # the counter says something is still unread: either newer than
+            # up_to, or written more than RECEIPT_SLACK after its timestamp
+            # (the chat writer under backpressure or retrying through a
+            # database stall). message_unread_idx keeps this to the
+            # reader's unread messages.
+            marked += unread.update(is_read=True)
+
+    read_at = up_to or timezone.now()
+    Conversation.objects.filter(pair_filter(reader_id, other_id)).update(**{
+        # by how many were marked rather than to zero: a message that
+        # arrives meanwhile stays counted
+        unread_field: Greatest(F(unread_field) - marked, 0),
+        read_field: Greatest(Coalesce(F(read_field), read_at), read_at),
+    })
+    if marked:
+        badges.messages_read(reader_id, other_id, marked)
+    return marked
+
+
+def history(user_id, other_id=None, before=None, after=None, limit=50):
+    """
+    Up to `limit` messages between `user_id` and `other_id` (or all of
+    `user_id`'s), oldest first: the ones just before the message `before`,
+    just after the message `after`, or else the latest. Returns
+    (messages, has_more), has_more saying whether there are more in the
+    direction read.
+
+    Each direction of a conversation is read from message_thread_idx in
+    timestamp order and stops after `limit` rows, so a window costs the
+    same however long the conversation is.
+    """
+    if other_id is None:
+        directions = [Q(sender_id=user_id), Q(recipient_id=user_id) & ~Q(sender_id=user_id)]
+    elif other_id == user_id:
+        directions = [Q(sender_id=user_id, recipient_id=user_id)]
+    else:
+        directions = [Q(sender_id=user_id, recipient_id=other_id), Q(sender_id=other_id, recipient_id=user_id)]
+
+    newest_first = after is None
+    lookup = 'lt' if newest_first else 'gt'
+    ordering = ('-timestamp', '-id') if newest_first else ('timestamp', 'id')
+    cursor = before or after
+    if cursor is not None:
+        timestamp = Subquery(
+            Message.objects.filter(Q(sender_id=user_id) | Q(recipient_id=user_id), pk=cursor).order_by().values('timestamp')[:1]
+        )
+        # the first term bounds the index scan, which the OR alone would not
+        position = Q(**{f'timestamp__{lookup}e': timestamp}) & (
+            Q(**{f'timestamp__{lookup}': timestamp}) | Q(timestamp=timestamp, **{f'id__{lookup}': cursor})
+        )
+
+    querysets = []
+    for direction in directions:
+        queryset = Message.objects.filter(direction)
+        if cursor is not None:
+            queryset = queryset.filter(position)
+        querysets.append(queryset.order_by(*ordering)[:limit + 1])
+    if len(querysets) > 1:
+        querysets = [querysets[0].union(*querysets[1:], all=True).order_by(*ordering)[:limit + 1]]
+
+    messages = list(querysets[0])
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if newest_first:
+        messages.reverse()
+    prefetch_related_objects(messages, 'sender', 'recipient')
+    return messages, has_more
+
+
+def rebuild(pairs=None):
+    """
+    Recompute the conversations of `pairs` ((user_low, user_high) tuples),
+    or of everyone, from their messages. Conversations left without
+    messages are deleted. Returns the number of conversations written.
+    """
+    where, params = '', []
+    if pairs is not None:
+        pairs = sorted({pair(*p) for p in pairs})
+        if not pairs:
+            return 0
+        where = 'WHERE (LEAST(sender_id, recipient_id), GREATEST(sender_id, recipient_id)) IN ({})'.format(
+            ', '.join(['(%s, %s)'] * len(pairs))
+        )
+        params = [user_id for p in pairs for user_id in p]
+    with connection.cursor() as cursor:
+        cursor.execute(REBUILD_SQL.format(where=where), params)
+        written = cursor.rowcount
+
+    empty = Conversation.objects.filter(last_message__isnull=True)
+    if pairs is not None:
+        empty = empty.filter(Q(*[Q(user_low_id=low, user_high_id=high) for low, high in pairs], _connector=Q.OR))
+    empty.delete()
+    return written
@@ -0,0 +1,37 @@
+"""
+Work collected over a transaction and done once when it commits.
+
+Receivers that run for every row (post_delete runs for each message of a
+deleted user) hand their keys to collect(). The first call in a
+transaction registers a single on_commit callback, which gets every key
+collected under that name until the commit.
+"""
+from django.db import transaction
+
+
+class Batch:
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.items = set()
+        self.done = False
+
+    def __call__(self):
+        self.done = True
+        self.callback(self.items)
+
+
+def collect(name, items, callback, using=None):
+    """Call callback(set of every item collected under `name`) once on commit."""
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        callback(set(items))
+        return
+
+    batches = connection.__dict__.setdefault('deferred_batches', {})
+    batch = batches.get(name)
+    # a batch whose transaction committed, or was rolled back, is finished
+    if batch is None or batch.done or not any(func is batch for _, func, _ in connection.run_on_commit):
+        batch = batches[name] = Batch(callback)
+        transaction.on_commit(batch, using=using)
+    batch.items.update(items)
@@ -0,0 +1,144 @@
+"""
+Side effects of a new chat message.
+
+A recipient with a chat socket open (see main/presence.py) gets the message
+over the socket and nothing else. Anyone else gets a push notification and
+an email, both queued through the outbox under per-message dedupe keys, so
+each is delivered once however often the message is handed off.
+
+Pushes are held back MESSAGE_PUSH_DELAY seconds and emails
+MESSAGE_EMAIL_DELAY seconds; the outbox worker sends everything queued for
+a recipient by then as one notification and one digest, leaves out
+messages that have been read in the meantime and skips recipients who
+have come online since.
+
+Every recipient's unread badge goes up either way (see main/badges.py).
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from . import badges, outbox, presence
+from .expo_utils import deliver_to_users
+from .models import Message, OutboxEvent
+
+
+def chat_payload(message):
+    """A message as ChatConsumer sends it over the socket."""
+    return {
+        'id': str(message.id),
+        'sender': message.sender_id,
+        'sender_username': message.sender.username,
+        'recipient': message.recipient_id,
+        'content': message.content,
+        'timestamp': str(message.timestamp),
+        'is_read': message.is_read,
+        'avatar_url': message.avatar_url,
+    }
+
+
+def message_created(message, delivered_live=False):
+    """Queue the side effects of a new message in the current transaction."""
+    messages_created([message], delivered_live)
+
+
+def messages_created(messages, delivered_live=False):
+    """
+    Queue the side effects of new messages in the current transaction.
+    `delivered_live` is set by the chat writer: ChatConsumer has already
+    sent the messages to their recipients' sockets itself.
+    """
+    badges.messages_created(messages)
+    online = presence.online({message.recipient_id for message in messages})
+    push_delay = timedelta(seconds=getattr(settings, 'MESSAGE_PUSH_DELAY', 5))
+    email_delay = timedelta(seconds=getattr(settings, 'MESSAGE_EMAIL_DELAY', 60))
+    events = []
+    for message in messages:
+        if message.recipient_id in online:
+            if not delivered_live:
+                events.append(outbox.make_event(
+                    OutboxEvent.CHANNEL_WEBSOCKET,
+                    {'group': f'chat_user_{message.recipient_id}', 'message': {'type': 'chat_message', 'message': chat_payload(message)}},
+                    f'message:{message.pk}:websocket',
+                ))
+            continue
+        payload = {'message_id': str(message.pk), 'recipient_id': message.recipient_id}
+        events += [
+            outbox.make_event(OutboxEvent.CHANNEL_MESSAGE_PUSH, payload, f'message:{message.pk}:push', delay=push_delay),
+            outbox.make_event(OutboxEvent.CHANNEL_MESSAGE_EMAIL, payload, f'message:{message.pk}:email', delay=email_delay),
+        ]
+    outbox.emit_many(events)
+
+
+def unread_by_recipient(message_ids):
+    """
+    The messages among `message_ids` that are still unread, oldest first,
+    by recipient, leaving out recipients who are online now.
+    """
+    unread = {}
+    queryset = (
+        Message.objects.filter(pk__in=message_ids, is_read=False)
+        .select_related('sender', 'recipient')
+        .order_by('timestamp')
+    )
+    for message in queryset:
+        unread.setdefault(message.recipient_id, []).append(message)
+    for recipient_id in presence.online(unread):
+        del unread[recipient_id]
+    return unread
+
+
+def build_push(messages):
+    """(title, body, data) of one push for a recipient's unread messages."""
+    if len(messages) == 1:
+        message = messages[0]
+        return f"New message from {message.sender.username}", message.content[:100], {'chatId': str(message.id)}
+    senders = list(dict.fromkeys(message.sender.username for message in messages))
+    body = ", ".join(senders[:3]) + (f" and {len(senders) - 3} more" if len(senders) > 3 else "")
+    return f"You have {len(messages)} new messages", body, {'chatId': str(messages[-1].id)}
+
+
+def send_message_pushes(message_ids):
+    """
+    Push every offline recipient the messages among `message_ids` they have
+    not read yet, one notification per recipient. Returns how many
+    recipients were notified; raises ExpoUnavailable, for the outbox to
+    retry, when Expo could not be reached.
+    """
+    unread = unread_by_recipient(message_ids)
+    deliver_to_users(
+        ((recipient_id, *build_push(messages)) for recipient_id, messages in unread.items()),
+        raise_unavailable=True,
+    )
+    return len(unread)
+
+
+def build_email(recipient, messages):
+    if len(messages) == 1:
+        message = messages[0]
+        subject = f"New message from {message.sender.username}"
+        body = (
+            f"You have a new message from {message.sender.username}:\n\n"
+            f"{message.content}\n\n"
+            f"View it in the app to reply."
+        )
+    else:
+        subject = f"You have {len(messages)} new messages"
+        lines = [f"{message.sender.username}: {message.content[:200]}" for message in messages]
+        body = "\n\n".join(lines) + "\n\nView them in the app to reply."
+    return EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL, [recipient.email])
+
+
+def send_message_emails(message_ids):
+    """
+    Email every offline recipient the messages among `message_ids` they
+    have not read yet, one email per recipient, over a single SMTP
+    connection. Returns the number of emails sent.
+    """
+    unread = unread_by_recipient(message_ids)
+    emails = [
+        build_email(messages[0].recipient, messages)
+        for messages in unread.values() if messages[0].recipient.email
+    ]
+    if not emails:
+        return 0
+    return get_connection(fail_silently=False).send_messages(emails) or 0
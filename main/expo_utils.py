@@ -1,19 +1,178 @@
+import logging
+import random
+import threading
+import time
+import uuid
 import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
 
-def send_expo_push(token, title, body, data=None):
-    response = requests.post(
-        "https://exp.host/--/api/v2/push/send",
-        json={
-            "to": token,
-            "title": title,
-            "body": body,
-            "data": data or {},
-        },
-        headers={
-            "Accept": "application/json",
-            "Accept-Encoding": "gzip, deflate",
-            "Content-Type": "application/json",
-        }
-    )
+
+logger = logging.getLogger(__name__)
+
+EXPO_PUSH_URL = "https://exp.host/--/api/v2/push/send"
+BATCH_SIZE = 100          # Expo accepts up to 100 messages per request
+MAX_ATTEMPTS = 4
+REQUEST_TIMEOUT = 10
+# per-message errors that are worth another attempt
+RETRYABLE_ERRORS = {'MessageRateExceeded'}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """One pooled, keep-alive session per process."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+                session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+                session.headers.update({
+                    "Accept": "application/json",
+                    "Accept-Encoding": "gzip, deflate",
+                    "Content-Type": "application/json",
+                })
+                _session = session
+    return _session
+
+
+def push_url():
+    return getattr(settings, 'EXPO_PUSH_URL', EXPO_PUSH_URL)
+
+
+def build_message(token, title, body, data=None):
+    return {
+        "to": token,
+        "title": title,
+        "body": body,
+        "data": data or {},
+    }
+
+
+def send_expo_batch(messages):
+    """
+    POST up to BATCH_SIZE messages in one request and return Expo's tickets,
+    one per message and in the same order.
+    """
+    response = get_session().post(push_url(), json=messages, timeout=REQUEST_TIMEOUT)
     response.raise_for_status()
-    return response.json()
+    return response.json()['data']
+
+
+def send_expo_push(token, title, body, data=None):
+    return send_expo_batch([build_message(token, title, body, data)])[0]
+
+
+class ExpoUnavailable(Exception):
+    """Pushes could not be handed to Expo and are worth sending again later."""
+
+
+def _backoff(attempt):
+    return min(30, 0.5 * 2 ** attempt) * (0.5 + random.random() / 2)
+
+
+def deliver(messages, sleep=time.sleep, raise_unavailable=False):
+    """
+    Send messages in batches, retrying transport errors, 429/5xx responses
+    and rate-limited messages with exponential backoff. PushToken rows that
+    Expo reports as DeviceNotRegistered are deleted.
+
+    Returns (sent, failed) message counts. With `raise_unavailable`, raises
+    ExpoUnavailable instead when messages were still failing that way after
+    the last attempt, so that the outbox retries them. Anything Expo
+    rejected (4xx responses, per-message errors) counts as failed and is
+    not worth another try.
+    """
+    from .models import PushToken
+
+    sent = failed = unavailable = 0
+    dead_tokens = set()
+
+    for start in range(0, len(messages), BATCH_SIZE):
+        pending = messages[start:start + BATCH_SIZE]
+        attempt = 0
+        rejected = False
+        while pending and attempt < MAX_ATTEMPTS:
+            if attempt:
+                sleep(_backoff(attempt - 1))
+            attempt += 1
+            try:
+                tickets = send_expo_batch(pending)
+            except requests.HTTPError as exc:
+                status_code = exc.response.status_code if exc.response is not None else None
+                if status_code is not None and status_code < 500 and status_code != 429:
+                    logger.error('Expo rejected push batch: %s', exc)
+                    rejected = True
+                    break
+                logger.warning('Expo push batch failed (attempt %s): %s', attempt, exc)
+                continue
+            except (requests.RequestException, ValueError, KeyError) as exc:
+                logger.warning('Expo push batch failed (attempt %s): %s', attempt, exc)
+                continue
+
+            retry = []
+            for message, ticket in zip(pending, tickets):
+                if ticket.get('status') == 'ok':
+                    sent += 1
+                    continue
+                error = (ticket.get('details') or {}).get('error')
+                if error in RETRYABLE_ERRORS:
+                    retry.append(message)
+                    continue
+                if error == 'DeviceNotRegistered':
+                    dead_tokens.add(message['to'])
+                else:
+                    logger.warning('Expo push to %s failed: %s', message['to'], ticket.get('message'))
+                failed += 1
+            pending = retry
+        failed += len(pending)
+        if not rejected:
+            unavailable += len(pending)
+
+    if dead_tokens:
+        PushToken.objects.filter(token__in=dead_tokens).delete()
+    if raise_unavailable and unavailable:
+        raise ExpoUnavailable(f'{sent} of {len(messages)} pushes sent, {unavailable} could not reach Expo')
+    return sent, failed
+
+
+def deliver_to_users(jobs, sleep=time.sleep, raise_unavailable=False):
+    """
+    jobs: iterable of (user_id, title, body, data). Looks up every user's
+    tokens in one query and fans the messages out in batches.
+    """
+    from .models import PushToken
+
+    jobs = list(jobs)
+    tokens = {}
+    for user_id, token in PushToken.objects.filter(user_id__in={job[0] for job in jobs}).values_list('user_id', 'token'):
+        tokens.setdefault(user_id, []).append(token)
+
+    messages = [
+        build_message(token, title, body, data)
+        for user_id, title, body, data in jobs
+        for token in tokens.get(user_id, [])
+    ]
+    return deliver(messages, sleep=sleep, raise_unavailable=raise_unavailable)
+
+
+def push_event(user_id, title, body, data=None, dedupe_key=None):
+    """An unsaved outbox event pushing to every device of a user."""
+    from . import outbox
+    from .models import OutboxEvent
+
+    payload = {'user_id': user_id, 'title': title, 'body': body, 'data': data or {}}
+    return outbox.make_event(OutboxEvent.CHANNEL_PUSH, payload, dedupe_key or f'push:{uuid.uuid4()}')
+
+
+def push_to_user(user_id, title, body, data=None, dedupe_key=None):
+    """
+    Queue a push to every device of a user through the outbox, in the
+    current transaction.
+    """
+    from . import outbox
+
+    outbox.emit_many([push_event(user_id, title, body, data, dedupe_key)])
@@ -1,10 +1,81 @@
-from django_filters import FilterSet, CharFilter, NumberFilter
+import re
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import F, FloatField
+from django.db.models.functions import Cast
+from django_filters import FilterSet, BaseInFilter, BooleanFilter, ChoiceFilter, NumberFilter
+from rest_framework.filters import SearchFilter
 from . models import Property
 
+
+class ChoiceInFilter(BaseInFilter, ChoiceFilter):
+    pass
+
+
+class NumberInFilter(BaseInFilter, NumberFilter):
+    pass
+
+
 class PropertyFilter(FilterSet):
-    type = CharFilter(field_name='type', lookup_expr='icontains')
-    property_type = CharFilter(field_name='property_type', lookup_expr='icontains')
-    
+    """
+    Exact and range lookups only, so every filter can be served from the
+    composite indexes on Property. Multi-value filters take comma separated
+    values, e.g. ?property_type=apartment,duplex
+    """
+    type = ChoiceInFilter(field_name='type', choices=Property.TYPE_CHOICES)
+    property_type = ChoiceInFilter(field_name='property_type', choices=Property.PROPERTY_TYPE_CHOICES)
+    city__id = NumberInFilter(field_name='city_id')
+
+    price_min = NumberFilter(field_name='price', lookup_expr='gte')
+    price_max = NumberFilter(field_name='price', lookup_expr='lte')
+    bedrooms_min = NumberFilter(field_name='number_of_bedrooms', lookup_expr='gte')
+    bedrooms_max = NumberFilter(field_name='number_of_bedrooms', lookup_expr='lte')
+    bathrooms_min = NumberFilter(field_name='number_of_bathrooms', lookup_expr='gte')
+    bathrooms_max = NumberFilter(field_name='number_of_bathrooms', lookup_expr='lte')
+    square_meters_min = NumberFilter(field_name='square_meters', lookup_expr='gte')
+    square_meters_max = NumberFilter(field_name='square_meters', lookup_expr='lte')
+
+    has_garage = BooleanFilter()
+    wheelchair_access = BooleanFilter()
+    elevator = BooleanFilter()
+    secure_parking = BooleanFilter()
+
     class Meta:
         model = Property
-        fields = ['type', 'property_type', 'city__id', 'price']
\ No newline at end of file
+        fields = ['type', 'property_type', 'city__id', 'price']
+
+
+def full_text_search(queryset, terms):
+    """
+    Match every term as a prefix against Property.search_vector and annotate
+    the relevance as `search_rank`. Returns the queryset untouched when the
+    terms contain nothing searchable.
+    """
+    words = [word for term in terms for word in re.findall(r'\w+', term)]
+    if not words:
+        return queryset
+
+    query = SearchQuery(' & '.join(f'{word}:*' for word in words), search_type='raw', config='english')
+    # cast to double precision so the rank survives a round trip through a cursor
+    rank = Cast(SearchRank(F('search_vector'), query), output_field=FloatField())
+    return queryset.filter(search_vector=query).annotate(search_rank=rank)
+
+
+class PropertySearchFilter(SearchFilter):
+    """
+    Full-text search over the indexed Property.search_vector column.
+
+    Falls back to the plain ILIKE SearchFilter on non-Postgres databases or
+    when the client asks for it with ?search_mode=ilike.
+    """
+    search_mode_param = 'search_mode'
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+
+        if connection.vendor != 'postgresql' or request.query_params.get(self.search_mode_param) == 'ilike':
+            return super().filter_queryset(request, queryset, view)
+
+        return full_text_search(queryset, terms)
@@ -0,0 +1,325 @@
+"""
+Image pipeline for PropertyImage uploads.
+
+Phone uploads are decoded once, turned upright according to their EXIF
+orientation and re-encoded without any metadata (which also drops GPS
+tags). From that we write WebP and JPEG renditions at RENDITION_WIDTHS and
+a tiny blurred placeholder that clients can show while the real image
+loads.
+
+Uploads are stored as-is with status `processing` and rendered after the
+request in a process pool (IMAGE_WORKERS processes; 0 renders in the
+calling thread). Workers only touch storage; the parent records the result
+and tells the owner over the notifications websocket. A pool whose worker
+died is replaced, and images that were left `processing` by a restart are
+rendered by the outbox worker's housekeeping (see requeue_stuck) or by
+`manage.py requeue_images`.
+"""
+import base64
+import io
+import logging
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import django
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageFilter, ImageOps
+
+
+logger = logging.getLogger(__name__)
+
+
+RENDITION_WIDTHS = (320, 640, 1280)
+# the stored original is capped at this many pixels on its longest side
+MAX_DIMENSION = 2560
+PLACEHOLDER_WIDTH = 16
+
+FORMATS = {
+    'webp': ('WEBP', {'quality': 78, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 80, 'optimize': True, 'progressive': True}),
+}
+
+
+def open_upright(fileobj):
+    """Decode an image and apply its EXIF orientation."""
+    image = Image.open(fileobj)
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+    return image
+
+
+def flatten(image):
+    """RGB copy of an image, with any transparency composited onto white."""
+    if image.mode == 'RGB':
+        return image
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel('A'))
+    return background
+
+
+def encode(image, fmt):
+    pil_format, options = FORMATS[fmt]
+    buffer = io.BytesIO()
+    (image if fmt == 'webp' else flatten(image)).save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+
+def resize_to_width(image, width):
+    if image.width <= width:
+        return image
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def placeholder(image):
+    """A base64 data URI of a tiny blurred JPEG, a few hundred bytes."""
+    small = flatten(resize_to_width(image, PLACEHOLDER_WIDTH)).filter(ImageFilter.GaussianBlur(1))
+    buffer = io.BytesIO()
+    small.save(buffer, 'JPEG', quality=50)
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+def dhash(image):
+    """64-bit difference hash as 16 hex digits; similar photos differ in few bits."""
+    pixels = list(image.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f'{bits:016x}'
+
+
+def rendition_widths(width):
+    widths = [w for w in RENDITION_WIDTHS if w < width]
+    return widths or [width]
+
+
+def render(fileobj, storage, directory='restate_ads'):
+    """
+    Clean an image and write its renditions to `storage`.
+
+    Returns a picklable dict: the cleaned original as `original` bytes with
+    a suggested `original_name`, plus `width`, `height`, `renditions` and
+    `placeholder` for the PropertyImage fields and the `phash` of the image.
+    """
+    fileobj.seek(0)
+    image = open_upright(fileobj)
+    image.thumbnail((MAX_DIMENSION, MAX_DIMENSION), Image.LANCZOS)
+
+    token = uuid.uuid4().hex
+
+    renditions = []
+    for width in rendition_widths(image.width):
+        resized = resize_to_width(image, width)
+        for fmt in FORMATS:
+            data = encode(resized, fmt)
+            name = storage.save(f'{directory}/renditions/{token}-{width}w.{fmt}', ContentFile(data))
+            renditions.append({
+                'width': resized.width, 'height': resized.height, 'format': fmt, 'name': name, 'size': len(data),
+            })
+
+    return {
+        'original': encode(image, 'jpeg'),
+        'original_name': f'{token}.jpg',
+        'width': image.width,
+        'height': image.height,
+        'renditions': renditions,
+        'placeholder': placeholder(image),
+        'phash': dhash(image),
+    }
+
+
+def apply_render(image, result):
+    """
+    Put a render() result on a PropertyImage, storing the new original and
+    moving the blob references from the old files to the new ones. Does not
+    save the row.
+    """
+    from . import blobs
+
+    old = blobs.references(image)
+    image.images.save(result['original_name'], ContentFile(result['original']), save=False)
+    image.width = result['width']
+    image.height = result['height']
+    image.renditions = result['renditions']
+    image.placeholder = result['placeholder']
+
+    sizes = {r['name']: r['size'] for r in result['renditions']}
+    sizes[image.images.name] = len(result['original'])
+    blobs.acquire(blobs.references(image), phashes={image.images.name: result['phash']}, sizes=sizes)
+    blobs.release(old)
+
+
+def image_storage():
+    from .models import PropertyImage
+
+    return PropertyImage._meta.get_field('images').storage
+
+
+def render_stored(name):
+    """Process pool entry point: render an image that is already in storage."""
+    storage = image_storage()
+    with storage.open(name, 'rb') as fileobj:
+        return render(fileobj, storage)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # django.setup() makes the workers independent of the start method
+                _pool = ProcessPoolExecutor(max_workers=settings.IMAGE_WORKERS, initializer=django.setup)
+    return _pool
+
+
+def reset_pool(broken):
+    """Drop a pool that lost a worker; the next get_pool() starts a new one."""
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False)
+
+
+def create_image(property_id, images, size=None):
+    """
+    Record an upload as a processing PropertyImage and schedule its
+    rendering. `images` is an uploaded file or the name of one that is
+    already in storage (a direct upload).
+    """
+    from . import blobs
+    from .models import PropertyImage
+
+    image = PropertyImage.objects.create(property_id=property_id, images=images, status=PropertyImage.STATUS_PROCESSING)
+    name = image.images.name
+    blobs.acquire([name], sizes={name: image.images.size if size is None else size})
+    schedule(image)
+    return image
+
+
+def schedule(image):
+    """Render an uploaded PropertyImage once the current transaction commits."""
+    image_id, raw_name = image.pk, image.images.name
+    transaction.on_commit(lambda: _submit(image_id, raw_name))
+
+
+def render_now(image_id, raw_name):
+    try:
+        result = render_stored(raw_name)
+    except Exception as exc:
+        finish(image_id, raw_name, error=exc)
+    else:
+        finish(image_id, raw_name, result)
+
+
+def _submit(image_id, raw_name, retry=True):
+    if not getattr(settings, 'IMAGE_WORKERS', 0):
+        render_now(image_id, raw_name)
+        return
+
+    pool = get_pool()
+
+    def done(future):
+        # runs on the pool's management thread
+        try:
+            error = future.exception()
+            if isinstance(error, BrokenProcessPool):
+                reset_pool(pool)
+                if retry:
+                    _submit(image_id, raw_name, retry=False)
+                    return
+            finish(image_id, raw_name, None if error else future.result(), error)
+        except Exception:
+            logger.exception('Recording the rendition of image %s failed', image_id)
+        finally:
+            close_old_connections()
+
+    try:
+        future = pool.submit(render_stored, raw_name)
+    except BrokenProcessPool as exc:
+        reset_pool(pool)
+        if retry:
+            _submit(image_id, raw_name, retry=False)
+        else:
+            finish(image_id, raw_name, error=exc)
+        return
+    future.add_done_callback(done)
+
+
+def requeue_processing():
+    """
+    Render, in this process, every image still `processing`: after a
+    restart nothing else will. Returns how many there were.
+    """
+    from .models import PropertyImage
+
+    queued = PropertyImage.objects.filter(status=PropertyImage.STATUS_PROCESSING).order_by('pk')
+    count = 0
+    for image_id, raw_name in queued.values_list('pk', 'images').iterator():
+        render_now(image_id, raw_name)
+        count += 1
+    return count
+
+
+def requeue_stuck(seen):
+    """
+    Render the images among `seen`, the ids an earlier call returned, that
+    are still `processing`, and return the ids processing now for the next
+    call. Called a housekeeping interval apart, an image processing on both
+    calls is not being rendered anywhere any more.
+    """
+    from .models import PropertyImage
+
+    processing = dict(PropertyImage.objects.filter(status=PropertyImage.STATUS_PROCESSING).values_list('pk', 'images'))
+    for image_id in sorted(seen & processing.keys()):
+        logger.warning('Image %s was left processing, rendering it again', image_id)
+        render_now(image_id, processing.pop(image_id))
+    return set(processing)
+
+
+def finish(image_id, raw_name, result=None, error=None):
+    """Record the outcome of rendering an image and notify its owner."""
+    from . import blobs, outbox
+    from .models import OutboxEvent, PropertyImage
+    from .serializers import PropertyImageSerializer
+
+    with transaction.atomic():
+        image = (
+            PropertyImage.objects.select_for_update(of=('self',))
+            .select_related('property')
+            .filter(pk=image_id)
+            .first()
+        )
+        if image is None or image.status != PropertyImage.STATUS_PROCESSING:
+            # deleted while it was being rendered, or rendered twice (requeued)
+            blobs.discard(r['name'] for r in (result or {}).get('renditions', []))
+            return
+
+        if error is None:
+            apply_render(image, result)
+            image.status = PropertyImage.STATUS_READY
+        else:
+            logger.warning('Rendering image %s failed: %s', image_id, error)
+            image.status = PropertyImage.STATUS_FAILED
+        image.save(update_fields=['images', 'width', 'height', 'renditions', 'placeholder', 'status'])
+
+        data = {
+            'notif_type': f'image_{image.status}',
+            'object_id': str(image.property_id),
+            'image': PropertyImageSerializer(image).data,
+        }
+        outbox.emit(
+            OutboxEvent.CHANNEL_WEBSOCKET,
+            {'group': f'notifications_{image.property.creator_id}', 'message': {'type': 'notify', 'data': data}},
+            f'property-image:{image.pk}:{image.status}',
+        )
+
@@ -0,0 +1,86 @@
+import asyncio
+import statistics
+import time
+import uuid
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+from main import chat, models
+from main.consumers import find_recipient
+
+
+def save_message(sender_id, recipient_id, content):
+    """What ChatConsumer.receive used to do for every frame."""
+    User = get_user_model()
+    sender = User.objects.get(id=sender_id)
+    recipient = User.objects.get(id=recipient_id)
+    return models.Message.objects.create(sender=sender, recipient=recipient, content=content)
+
+
+class Command(BaseCommand):
+    help = (
+        "Chat ingestion throughput: --conversations senders each send --messages messages "
+        "back to back, saved one by one through database_sync_to_async as ChatConsumer used "
+        "to, then queued to the batching chat writer. Reports how long a sender waits for "
+        "the acknowledgement and how long until everything is stored."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--conversations', type=int, default=100)
+        parser.add_argument('--messages', type=int, default=50)
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        prefix = f'chat-bench-{uuid.uuid4().hex[:8]}'
+        count = options['conversations']
+        users = User.objects.bulk_create([User(username=f'{prefix}-{i}') for i in range(2 * count)])
+        pairs = list(zip(users[:count], users[count:]))
+        try:
+            for label, run in (('per message', self.per_message), ('batched writer', self.batched)):
+                queries = []
+                # thread-sensitive database calls run on this thread under async_to_sync
+                with connection.execute_wrapper(lambda execute, sql, *args: queries.append(sql) or execute(sql, *args)):
+                    started = time.perf_counter()
+                    acks = async_to_sync(self.storm)(run, pairs, options['messages'])
+                    elapsed = time.perf_counter() - started
+                self.report(label, elapsed, acks, len(queries))
+        finally:
+            messages = models.Message.objects.filter(Q(sender__in=users) | Q(recipient__in=users))
+            keys = [f'message:{pk}:{kind}' for pk in messages.values_list('pk', flat=True) for kind in ('push', 'email')]
+            models.OutboxEvent.objects.filter(dedupe_key__in=keys).delete()
+            User.objects.filter(username__startswith=prefix).delete()
+
+    async def storm(self, run, pairs, count):
+        results = await asyncio.gather(*(run(sender, recipient, count) for sender, recipient in pairs))
+        await chat.get_writer().flush()
+        return [ack for acks in results for ack in acks]
+
+    async def per_message(self, sender, recipient, count):
+        acks = []
+        for i in range(count):
+            started = time.perf_counter()
+            await database_sync_to_async(save_message)(sender.pk, recipient.pk, f'bench {i}')
+            acks.append(time.perf_counter() - started)
+        return acks
+
+    async def batched(self, sender, recipient, count):
+        acks = []
+        recipient_id = await database_sync_to_async(find_recipient)(recipient.pk)
+        writer = chat.get_writer()
+        for i in range(count):
+            started = time.perf_counter()
+            await writer.submit(models.Message(sender=sender, recipient_id=recipient_id, content=f'bench {i}'))
+            acks.append(time.perf_counter() - started)
+            # a real socket yields between frames
+            await asyncio.sleep(0)
+        return acks
+
+    def report(self, label, elapsed, acks, queries):
+        quantiles = statistics.quantiles(acks, n=100)
+        self.stdout.write(
+            f'{label:15} {len(acks) / elapsed:8.0f} msg/s stored  '
+            f'ack p50 {quantiles[49] * 1000:8.2f} ms  p99 {quantiles[98] * 1000:8.2f} ms  {queries:6} queries'
+        )
@@ -0,0 +1,134 @@
+import socketserver
+import statistics
+import threading
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+from main import delivery, models, outbox
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib, with an artificial delay per command."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            time.sleep(self.server.latency)
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self.reply('250 sink')
+            elif command == b'DATA':
+                self.reply('354 end with .')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                with self.server.lock:
+                    self.server.received += 1
+                self.reply('250 queued')
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, latency):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+        self.latency = latency
+        self.received = 0
+        self.lock = threading.Lock()
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure POST /main/messages/ latency against a local SMTP sink, comparing "
+        "an email sent inside the request with the digest email queued in the outbox."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=100)
+        parser.add_argument('--smtp-latency', type=float, default=0.05, help='Seconds the sink waits per SMTP command')
+        parser.add_argument('--email-delay', type=float, default=1, help='MESSAGE_EMAIL_DELAY for the run')
+
+    def handle(self, *args, **options):
+        sink = SMTPSink(options['smtp_latency'])
+        threading.Thread(target=sink.serve_forever, daemon=True).start()
+
+        sender, _ = models.CompleteUser.objects.get_or_create(username='bench-sender')
+        recipient, _ = models.CompleteUser.objects.get_or_create(
+            username='bench-recipient', defaults={'email': 'bench-recipient@example.com'},
+        )
+        client = APIClient()
+        client.force_authenticate(sender)
+
+        email_settings = override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1',
+            EMAIL_PORT=sink.server_address[1],
+            EMAIL_HOST_USER='',
+            EMAIL_HOST_PASSWORD='',
+            EMAIL_USE_SSL=False,
+            EMAIL_USE_TLS=False,
+            MESSAGE_EMAIL_DELAY=options['email_delay'],
+        )
+        try:
+            with email_settings:
+                # what the Message receiver used to do: one SMTP session per message inside the request
+                post_save.connect(self.send_inline, sender=models.Message, dispatch_uid='bench-inline-email')
+                try:
+                    inline = self.run(client, recipient, options['messages'])
+                finally:
+                    post_save.disconnect(sender=models.Message, dispatch_uid='bench-inline-email')
+                inline_emails = sink.received
+
+                queued = self.run(client, recipient, options['messages'])
+                # what the drain_outbox worker does once the digest delay has passed
+                time.sleep(options['email_delay'])
+                while outbox.process(models.OutboxEvent.CHANNEL_MESSAGE_EMAIL):
+                    pass
+        finally:
+            sink.shutdown()
+            messages = models.Message.objects.filter(Q(sender=sender) | Q(recipient=sender))
+            keys = [f'message:{pk}:{kind}' for pk in messages.values_list('pk', flat=True) for kind in ('push', 'email')]
+            models.OutboxEvent.objects.filter(dedupe_key__in=keys).delete()
+            messages.delete()
+
+        self.report('inline email', inline, inline_emails)
+        self.report('queued email', queued, sink.received - inline_emails)
+
+    def send_inline(self, sender, instance, created, **kwargs):
+        if created:
+            # marked read first so the queued digest leaves it out
+            models.Message.objects.filter(pk=instance.pk).update(is_read=True)
+            delivery.build_email(instance.recipient, [instance]).send()
+
+    def run(self, client, recipient, count):
+        latencies = []
+        for i in range(count):
+            started = time.perf_counter()
+            response = client.post('/main/messages/', {'recipient': recipient.pk, 'content': f'bench {i}'}, format='json')
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 201:
+                raise CommandError(
+                    f'Message {i + 1} of {count}: POST /main/messages/ returned {response.status_code}, '
+                    f'expected 201: {response.content.decode(errors="replace")}'
+                )
+        return latencies
+
+    def report(self, label, latencies, emails):
+        p95 = statistics.quantiles(latencies, n=20)[-1]
+        self.stdout.write(
+            f"{label:14} p50 {statistics.median(latencies) * 1000:7.1f} ms  "
+            f"p95 {p95 * 1000:7.1f} ms  emails {emails}"
+        )
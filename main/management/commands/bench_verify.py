@@ -0,0 +1,59 @@
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from main import models, services
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare verifying listings one save() at a time, as list_editable does, with "
+        "services.verify_properties (synthetic listings, rolled back afterwards)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--listings', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = options['listings']
+        with transaction.atomic():
+            one_by_one, bulk = self.populate(count)
+
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                for prop in one_by_one:
+                    prop.is_verified = True
+                    prop.save()
+                elapsed = time.perf_counter() - started
+            self.report('save() per row', elapsed, len(queries), count)
+
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                verified = services.verify_properties(models.Property.objects.filter(pk__in=[p.pk for p in bulk]))
+                elapsed = time.perf_counter() - started
+            self.report('verify_properties', elapsed, len(queries), verified)
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(self.style.SUCCESS('Done, synthetic listings rolled back.'))
+
+    def populate(self, count):
+        creator = models.CompleteUser.objects.create(username=f'bench-{uuid.uuid4().hex[:8]}')
+        region = models.Region.objects.create(name='Benchmark')
+        city = models.City.objects.create(region=region, city='Benchmark')
+        props = models.Property.objects.bulk_create([
+            models.Property(
+                creator=creator,
+                city=city,
+                title=f'Benchmark listing {i}',
+                price=1000,
+                is_verified=False,
+                slug=f'bench-{i}-{uuid.uuid4().hex[:8]}',
+            )
+            for i in range(count * 2)
+        ])
+        return props[:count], props[count:]
+
+    def report(self, label, elapsed, queries, verified):
+        self.stdout.write(f"{label:18} {elapsed * 1000:9.1f} ms  {queries:6} queries  {verified} verified")
@@ -0,0 +1,82 @@
+import asyncio
+import statistics
+import time
+import uuid
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework_simplejwt.tokens import AccessToken
+from main import routing
+from main.middleware import JwtAuthMiddleware, user_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Connect-storm benchmark: open --connections websocket handshakes at once through "
+        "JwtAuthMiddleware (in-memory channel layer), spread over --users users who each "
+        "reconnect with the same token. Runs with the user cache disabled, cold and warm; "
+        "each full handshake storm is followed by one that only resolves the tokens, "
+        "which is the part the user cache speeds up."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=5000)
+        parser.add_argument('--users', type=int, default=500)
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        prefix = f'ws-bench-{uuid.uuid4().hex[:8]}'
+        users = User.objects.bulk_create([User(username=f'{prefix}-{i}') for i in range(options['users'])])
+        tokens = [str(AccessToken.for_user(user)) for user in users]
+        tokens = [tokens[i % len(tokens)] for i in range(options['connections'])]
+
+        application = JwtAuthMiddleware(URLRouter(routing.websocket_urlpatterns))
+        try:
+            with override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}):
+                for kind, storm in (('handshake', self.storm), ('auth only', self.auth_storm)):
+                    for label, ttl in (('no cache', 0), ('cold cache', 60), ('warm cache', 60)):
+                        if label != 'warm cache':
+                            user_cache.clear()
+                        with override_settings(WEBSOCKET_USER_CACHE_TTL=ttl), \
+                                CaptureQueriesContext(connection) as queries:
+                            started = time.perf_counter()
+                            latencies, accepted = async_to_sync(storm)(application, tokens)
+                            elapsed = time.perf_counter() - started
+                        self.report(f'{kind} {label}', elapsed, latencies, accepted, len(queries))
+        finally:
+            User.objects.filter(username__startswith=prefix).delete()
+            user_cache.clear()
+
+    async def storm(self, application, tokens):
+        async def handshake(token):
+            communicator = WebsocketCommunicator(application, f'/ws/notifications/?token={token}')
+            started = time.perf_counter()
+            connected, _ = await communicator.connect(timeout=60)
+            latency = time.perf_counter() - started
+            await communicator.disconnect()
+            return latency, connected
+
+        results = await asyncio.gather(*(handshake(token) for token in tokens))
+        return [latency for latency, _ in results], sum(connected for _, connected in results)
+
+    async def auth_storm(self, application, tokens):
+        async def resolve(token):
+            started = time.perf_counter()
+            user = await application.resolve_user({'query_string': f'token={token}'.encode()})
+            return time.perf_counter() - started, user.is_authenticated
+
+        results = await asyncio.gather(*(resolve(token) for token in tokens))
+        return [latency for latency, _ in results], sum(ok for _, ok in results)
+
+    def report(self, label, elapsed, latencies, accepted, queries):
+        quantiles = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+            f'{label:21} {len(latencies) / elapsed:7.0f} handshakes/s  '
+            f'p50 {quantiles[49] * 1000:7.1f} ms  p95 {quantiles[94] * 1000:7.1f} ms  '
+            f'{queries:5} queries  {accepted}/{len(latencies)} accepted'
+        )
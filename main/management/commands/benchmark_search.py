@@ -0,0 +1,94 @@
+import random
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from main import models
+from main.filters import full_text_search
+
+
+WORDS = [
+    'spacious', 'furnished', 'quiet', 'modern', 'gated', 'estate', 'borehole', 'balcony',
+    'tiled', 'kitchen', 'wardrobe', 'compound', 'storey', 'garden', 'ocean', 'view',
+    'airport', 'residential', 'mall', 'university', 'junction', 'road', 'fenced', 'airy',
+]
+AREAS = ['East Legon', 'Osu', 'Spintex', 'Adenta', 'Madina', 'Kasoa', 'Tema', 'Dansoman', 'Labone']
+
+
+class Command(BaseCommand):
+    help = "Compare full-text search against the old ILIKE search on synthetic listings (rolled back afterwards)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--listings', type=int, default=100_000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--batch-size', type=int, default=5_000)
+        parser.add_argument('terms', nargs='*', default=['gated', 'furnished apartment', 'east legon', 'balc'])
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.populate(options['listings'], options['batch_size'])
+
+            for term in options['terms']:
+                ilike = self.time_query(self.ilike_queryset(term), options['repeat'])
+                fts = self.time_query(self.fts_queryset(term), options['repeat'])
+                self.stdout.write(
+                    f"{term!r:24} ilike {ilike['ms']:8.2f} ms ({ilike['rows']} rows)   "
+                    f"fts {fts['ms']:8.2f} ms ({fts['rows']} rows)"
+                )
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(self.style.SUCCESS('Done, synthetic listings rolled back.'))
+
+    def populate(self, count, batch_size):
+        rng = random.Random(42)
+        creator = models.CompleteUser.objects.create(username=f'bench-{uuid.uuid4().hex[:8]}')
+        region = models.Region.objects.create(name='Benchmark')
+        city = models.City.objects.create(region=region, city='Benchmark')
+
+        started = time.perf_counter()
+        batch = []
+        for i in range(count):
+            batch.append(models.Property(
+                creator=creator,
+                city=city,
+                title=' '.join(rng.sample(WORDS, 3)),
+                description=' '.join(rng.choices(WORDS, k=40)),
+                detailed_address=f'{rng.randint(1, 200)} {rng.choice(AREAS)}',
+                type=rng.choice(models.Property.TYPE_CHOICES)[0],
+                property_type=rng.choice(models.Property.PROPERTY_TYPE_CHOICES)[0],
+                price=rng.randint(300, 20_000),
+                is_verified=True,
+                slug=f'bench-{i}-{uuid.uuid4().hex[:8]}',
+            ))
+            if len(batch) >= batch_size:
+                models.Property.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            models.Property.objects.bulk_create(batch)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE main_property')
+        self.stdout.write(f'Inserted {count} listings in {time.perf_counter() - started:.1f}s')
+
+    def ilike_queryset(self, term):
+        # what SearchFilter built from the old search_fields
+        query = Q()
+        for word in term.split():
+            query &= Q(title__icontains=word) | Q(type__icontains=word) | Q(property_type__icontains=word)
+        return models.Property.objects.filter(query).order_by('-date_posted', '-id')
+
+    def fts_queryset(self, term):
+        return full_text_search(models.Property.objects.all(), term.split()).order_by('-search_rank', '-id')
+
+    def time_query(self, queryset, repeat):
+        timings = []
+        rows = 0
+        for _ in range(repeat):
+            started = time.perf_counter()
+            page = list(queryset.values_list('id', flat=True)[:20])
+            timings.append((time.perf_counter() - started) * 1000)
+            rows = len(page)
+        timings.sort()
+        return {'ms': timings[len(timings) // 2], 'rows': rows}
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import logging
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from main import blobs, images, outbox
+from main.models import OutboxEvent
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Deliver queued outbox events (pushes, emails, websocket messages). Every "
+        "channel is drained by its own loop, so a slow SMTP server does not hold up "
+        "pushes. Run as many workers as needed; they never claim the same event."
+    )
+
+    def add_arguments(self, parser):
+        channels = [channel for channel, _ in OutboxEvent.CHANNEL_CHOICES]
+        parser.add_argument('--channel', action='append', choices=channels, help='Only drain these channels')
+        parser.add_argument('--batch-size', type=int, default=outbox.BATCH_SIZE)
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to wait when a channel is empty')
+        parser.add_argument('--stats-interval', type=float, default=60, help='Seconds between lag reports, 0 to disable')
+        parser.add_argument(
+            '--housekeeping-interval', type=float, default=300,
+            help='Seconds between purging delivered events and unreferenced blobs and re-rendering '
+                 'images left processing, 0 to disable',
+        )
+        parser.add_argument('--once', action='store_true', help='Exit once every channel has nothing due, after housekeeping')
+
+    def handle(self, *args, **options):
+        # images seen processing by the last housekeeping round
+        self.processing = set()
+        asyncio.run(self.main(options))
+
+    async def main(self, options):
+        channels = options['channel'] or list(outbox.HANDLERS)
+        tasks = [self.drain(channel, options) for channel in channels]
+        if options['once']:
+            await asyncio.gather(*tasks)
+            await sync_to_async(self.housekeeping, thread_sensitive=False)()
+            return
+        if options['stats_interval']:
+            tasks.append(self.report(options['stats_interval']))
+        if options['housekeeping_interval']:
+            tasks.append(self.housekeep(options['housekeeping_interval']))
+        await asyncio.gather(*tasks)
+
+    async def drain(self, channel, options):
+        # each batch runs in a worker thread with its own database connection
+        process = sync_to_async(self.process, thread_sensitive=False)
+        while True:
+            try:
+                claimed = await process(channel, options['batch_size'])
+            except Exception:
+                logger.exception('Draining the %s outbox failed', channel)
+                claimed = 0
+            if claimed:
+                continue
+            if options['once']:
+                return
+            await asyncio.sleep(options['poll_interval'])
+
+    def process(self, channel, batch_size):
+        try:
+            return outbox.process(channel, batch_size)
+        finally:
+            close_old_connections()
+
+    async def report(self, interval):
+        stats = sync_to_async(self.stats, thread_sensitive=False)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.stdout.write(json.dumps(await stats()))
+            except Exception:
+                logger.exception('Collecting outbox stats failed')
+
+    def stats(self):
+        try:
+            return outbox.lag_stats()
+        finally:
+            close_old_connections()
+
+    async def housekeep(self, interval):
+        housekeeping = sync_to_async(self.housekeeping, thread_sensitive=False)
+        while True:
+            await housekeeping()
+            await asyncio.sleep(interval)
+
+    def housekeeping(self):
+        try:
+            outbox.purge_delivered()
+            blobs.collect_garbage()
+            self.processing = images.requeue_stuck(self.processing)
+        except Exception:
+            logger.exception('Outbox housekeeping failed')
+        finally:
+            close_old_connections()
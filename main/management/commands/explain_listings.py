@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+from main import models
+from main.filters import PropertyFilter, full_text_search
+
+
+class Command(BaseCommand):
+    help = "Print EXPLAIN ANALYZE for each canonical property listing query so plan regressions are easy to spot"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--only', help='Run a single shape by name')
+        parser.add_argument('--no-analyze', action='store_true', help='Plain EXPLAIN, do not execute the queries')
+
+    def handle(self, *args, **options):
+        page_size = options['page_size']
+        analyze = not options['no_analyze']
+
+        for name, queryset in self.shapes():
+            if options['only'] and name != options['only']:
+                continue
+            self.stdout.write(self.style.MIGRATE_HEADING(f'== {name}'))
+            if options['verbosity'] > 1:
+                self.stdout.write(str(queryset.query))
+            if analyze:
+                plan = queryset[:page_size].explain(analyze=True, buffers=True)
+            else:
+                plan = queryset[:page_size].explain()
+            self.stdout.write(plan)
+            self.stdout.write('')
+
+    def shapes(self):
+        """
+        The query shapes PropertyViewSet issues for anonymous browsing, built
+        through PropertyFilter so they track the real filters.
+        """
+        sample = models.Property.objects.live().values('city_id', 'type', 'property_type').first() or {
+            'city_id': 1, 'type': models.Property.TYPE_RENTAL, 'property_type': models.Property.TYPE_APARTMENT,
+        }
+        prices = models.Property.objects.live().aggregate(low=Min('price'), high=Max('price'))
+        low = prices['low'] or 0
+        high = prices['high'] or 0
+        mid = low + (high - low) / 2
+
+        def live(**params):
+            # query string values, as the view would see them
+            data = {key: str(value) for key, value in params.items()}
+            return PropertyFilter(data, queryset=models.Property.objects.live()).qs
+
+        return [
+            ('feed_recent', live().order_by('-date_posted', '-id')),
+            ('feed_price_asc', live().order_by('price', 'id')),
+            ('feed_price_desc', live().order_by('-price', '-id')),
+            ('city_recent', live(**{'city__id': sample['city_id']}).order_by('-date_posted', '-id')),
+            ('city_price', live(**{'city__id': sample['city_id']}).order_by('price', 'id')),
+            ('type_recent', live(type=sample['type'], property_type=sample['property_type']).order_by('-date_posted', '-id')),
+            ('type_price', live(type=sample['type'], property_type=sample['property_type']).order_by('price', 'id')),
+            ('exact_price', live(price=mid).order_by('-date_posted', '-id')),
+            ('property_types', live(property_type='apartment,duplex').order_by('-date_posted', '-id')),
+            ('price_range', live(price_min=low, price_max=mid).order_by('price', 'id')),
+            ('city_type_price_range', live(**{
+                'city__id': sample['city_id'], 'type': sample['type'], 'property_type': sample['property_type'],
+                'price_min': low, 'price_max': mid,
+            }).order_by('price', 'id')),
+            ('bedrooms_price_range', live(bedrooms_min=2, bedrooms_max=3, price_max=mid).order_by('price', 'id')),
+            ('search', full_text_search(models.Property.objects.live(), ['apartment']).order_by('-search_rank', '-id')),
+            ('my_properties', models.Property.objects.filter(creator_id=self.sample_creator()).order_by('-date_posted', '-id')),
+        ]
+
+    def sample_creator(self):
+        return models.Property.objects.values_list('creator_id', flat=True).first() or 0
@@ -0,0 +1,18 @@
+import time
+from django.core.management.base import BaseCommand
+from main import visits
+
+
+class Command(BaseCommand):
+    help = "Write buffered property visits to Property.visit_count (once, or every --interval seconds)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0, help='Keep running and flush every N seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            written = visits.flush_visits()
+            self.stdout.write(f'Flushed {written} visit(s).')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from main import models
+from main.images import apply_render, render
+
+
+class Command(BaseCommand):
+    help = (
+        "Backfill renditions and placeholders for PropertyImage rows uploaded before the "
+        "image pipeline existed. Originals are replaced by upright, metadata-free copies."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Regenerate images that already have renditions too')
+
+    def handle(self, *args, **options):
+        queryset = models.PropertyImage.objects.order_by('pk')
+        if not options['all']:
+            queryset = queryset.filter(renditions=[])
+
+        storage = models.PropertyImage._meta.get_field('images').storage
+        done = failed = before = after = 0
+        for image in queryset.iterator(chunk_size=100):
+            old_name = image.images.name
+            try:
+                with image.images.open('rb') as original:
+                    before += image.images.size
+                    result = render(original, storage)
+            except Exception as exc:
+                failed += 1
+                self.stderr.write(f'{old_name}: {exc}')
+                continue
+
+            # the replaced files are released, collect_garbage() deletes them
+            with transaction.atomic():
+                apply_render(image, result)
+                image.status = models.PropertyImage.STATUS_READY
+                image.save(update_fields=['images', 'width', 'height', 'renditions', 'placeholder', 'status'])
+
+            after += image.images.size
+            done += 1
+
+        self.stdout.write(
+            f'{done} images processed, {failed} failed; originals '
+            f'{before / 1_048_576:.1f} MB -> {after / 1_048_576:.1f} MB'
+        )
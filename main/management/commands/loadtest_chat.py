@@ -0,0 +1,140 @@
+import asyncio
+import json
+import random
+import statistics
+import time
+import uuid
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test a running daphne: open --sockets chat sockets at once (one user each), "
+        "keep them heartbeating for --duration seconds and send --messages messages between "
+        "random pairs, reporting connect, heartbeat and delivery latency. Both this process "
+        "and daphne need a file descriptor per socket (ulimit -n)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='ws://127.0.0.1:8000/ws/chat/')
+        parser.add_argument('--sockets', type=int, default=10000)
+        parser.add_argument('--concurrency', type=int, default=500, help='Handshakes in flight at once')
+        parser.add_argument('--duration', type=float, default=60)
+        parser.add_argument('--heartbeat', type=float, default=25, help='Seconds between heartbeats per socket')
+        parser.add_argument('--messages', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        try:
+            import websockets  # noqa: F401
+        except ImportError:
+            raise CommandError('loadtest_chat needs the websockets package')
+
+        User = get_user_model()
+        prefix = f'chat-load-{uuid.uuid4().hex[:8]}'
+        users = User.objects.bulk_create([User(username=f'{prefix}-{i}') for i in range(options['sockets'])])
+        tokens = [str(AccessToken.for_user(user)) for user in users]
+        try:
+            asyncio.run(self.run(options, users, tokens))
+        finally:
+            User.objects.filter(username__startswith=prefix).delete()
+
+    async def run(self, options, users, tokens):
+        import websockets
+
+        self.connect_latencies, self.heartbeat_latencies, self.delivery_latencies = [], [], []
+        self.failures = 0
+        self.heartbeats_sent = {}
+        self.messages_sent = {}
+        limit = asyncio.Semaphore(options['concurrency'])
+
+        async def open_socket(token):
+            async with limit:
+                started = time.perf_counter()
+                try:
+                    socket = await websockets.connect(f"{options['url']}?token={token}", open_timeout=60, max_queue=None)
+                except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+                    self.failures += 1
+                    return None
+                self.connect_latencies.append(time.perf_counter() - started)
+                return socket
+
+        started = time.perf_counter()
+        sockets = await asyncio.gather(*(open_socket(token) for token in tokens))
+        connect_time = time.perf_counter() - started
+        open_sockets = [(user, socket) for user, socket in zip(users, sockets) if socket]
+        self.stdout.write(f'{len(open_sockets)}/{len(tokens)} sockets open in {connect_time:.1f}s')
+
+        deadline = time.perf_counter() + options['duration']
+        readers = [asyncio.create_task(self.read(user, socket)) for user, socket in open_sockets]
+        heartbeats = [
+            asyncio.create_task(self.heartbeat(socket, options['heartbeat'], deadline))
+            for _, socket in open_sockets
+        ]
+        sender = asyncio.create_task(self.send_messages(open_sockets, options['messages'], options['duration']))
+
+        await asyncio.gather(*heartbeats, sender)
+        # let the last deliveries arrive
+        await asyncio.sleep(2)
+        closed = sum(socket.close_code is not None for _, socket in open_sockets)
+        for task in readers:
+            task.cancel()
+        await asyncio.gather(*(socket.close() for _, socket in open_sockets), return_exceptions=True)
+
+        self.report('connect', self.connect_latencies)
+        self.report('heartbeat', self.heartbeat_latencies)
+        self.report('delivery', self.delivery_latencies)
+        self.stdout.write(
+            f'{self.failures} failed handshakes, {closed} sockets closed by the server, '
+            f'{len(self.delivery_latencies)}/{options["messages"]} messages delivered'
+        )
+
+    async def read(self, user, socket):
+        async for frame in socket:
+            data = json.loads(frame)
+            now = time.perf_counter()
+            if data.get('type') == 'heartbeat':
+                sent = self.heartbeats_sent.pop(socket.id, None)
+                if sent:
+                    self.heartbeat_latencies.append(now - sent)
+            elif data.get('message', {}).get('recipient') == user.pk:
+                # not the echo on the sender's socket
+                sent = self.messages_sent.pop((data['message']['content'], data['message']['recipient']), None)
+                if sent:
+                    self.delivery_latencies.append(now - sent)
+
+    async def heartbeat(self, socket, interval, deadline):
+        # spread the sockets over the interval like real clients
+        await asyncio.sleep(random.uniform(0, interval))
+        while time.perf_counter() < deadline and socket.close_code is None:
+            self.heartbeats_sent[socket.id] = time.perf_counter()
+            try:
+                await socket.send(json.dumps({'type': 'heartbeat'}))
+            except Exception:
+                return
+            await asyncio.sleep(interval)
+
+    async def send_messages(self, open_sockets, count, duration):
+        if not count or len(open_sockets) < 2:
+            await asyncio.sleep(duration)
+            return
+        for i in range(count):
+            (_, socket), (recipient, _) = random.sample(open_sockets, 2)
+            content = f'load {i}'
+            self.messages_sent[(content, recipient.pk)] = time.perf_counter()
+            try:
+                await socket.send(json.dumps({'recipient': recipient.pk, 'content': content}))
+            except Exception:
+                self.messages_sent.pop((content, recipient.pk), None)
+            await asyncio.sleep(duration / count)
+
+    def report(self, label, latencies):
+        if len(latencies) < 2:
+            self.stdout.write(f'{label:10} {len(latencies)} samples')
+            return
+        quantiles = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+            f'{label:10} {len(latencies):6} samples  p50 {quantiles[49] * 1000:8.1f} ms  '
+            f'p95 {quantiles[94] * 1000:8.1f} ms  p99 {quantiles[98] * 1000:8.1f} ms'
+        )
@@ -0,0 +1,65 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.db.models import F
+from main import models, visits
+
+
+class Command(BaseCommand):
+    help = (
+        "Hammer a single listing with concurrent visits, comparing the old "
+        "row-locking UPDATE with the buffered counter. Postgres max_connections "
+        "must allow --visitors concurrent connections."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('property_id', help='Listing to visit')
+        parser.add_argument('--visitors', type=int, default=500)
+        parser.add_argument('--visits', type=int, default=20, help='Visits per visitor')
+
+    def handle(self, *args, **options):
+        try:
+            prop = models.Property.objects.get(pk=options['property_id'])
+        except (models.Property.DoesNotExist, ValueError):
+            raise CommandError('Property not found.')
+
+        start_count = prop.visit_count
+        total = options['visitors'] * options['visits']
+
+        locked = self.run(self.locking_visit, prop.pk, options)
+        buffered = self.run(self.buffered_visit, prop.pk, options)
+        flushed = visits.flush_visits()
+
+        prop.refresh_from_db()
+        self.stdout.write(f"row lock   {total / locked:10.0f} visits/s ({locked:.2f}s)")
+        self.stdout.write(f"buffered   {total / buffered:10.0f} visits/s ({buffered:.2f}s), {flushed} flushed in one batch")
+        self.stdout.write(f"visit_count {start_count} -> {prop.visit_count} (expected +{total * 2})")
+
+        # leave the listing as we found it
+        models.Property.objects.filter(pk=prop.pk).update(visit_count=start_count)
+
+    def run(self, visit, pk, options):
+        def visitor():
+            try:
+                for _ in range(options['visits']):
+                    visit(pk)
+            finally:
+                close_old_connections()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['visitors']) as pool:
+            for future in [pool.submit(visitor) for _ in range(options['visitors'])]:
+                future.result()
+        return time.perf_counter() - started
+
+    def locking_visit(self, pk):
+        # what PropertyViewSet.visit used to do
+        prop = models.Property.objects.get(pk=pk)
+        prop.visit_count = F('visit_count') + 1
+        prop.save(update_fields=['visit_count'])
+        prop.refresh_from_db()
+
+    def buffered_visit(self, pk):
+        prop = models.Property.objects.only('id', 'visit_count').get(pk=pk)
+        visits.record_visit(prop.pk)
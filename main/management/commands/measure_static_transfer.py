@@ -0,0 +1,93 @@
+import re
+import shutil
+import tempfile
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import Client, override_settings
+
+
+ASSET_PATTERN = re.compile(r'(?:href|src)="(/static/[^"]+)"')
+# a repeat visit does not even revalidate assets cached for this long
+LONG_LIVED = 7 * 24 * 3600
+
+PLAIN_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
+MANIFEST_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+
+
+def max_age(response):
+    match = re.search(r'max-age=(\d+)', response.get('Cache-Control', ''))
+    return int(match.group(1)) if match else 0
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the bytes a browser transfers for a cold load of admin pages with plain "
+        "static storage and with compressed, hashed manifest storage. Each configuration "
+        "is collected into a temporary STATIC_ROOT and served through WhiteNoise, so "
+        "expect a minute or two for the Brotli pass."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--page', action='append', dest='pages',
+            help='Admin page to load (repeatable), default the login page, the index and the property list',
+        )
+
+    def handle(self, *args, **options):
+        pages = options['pages'] or ['/admin/login/', '/admin/', '/admin/main/property/']
+        results = {}
+        for label, backend in (('before', PLAIN_STORAGE), ('after', MANIFEST_STORAGE)):
+            results[label] = self.measure(backend, pages)
+
+        self.stdout.write(f"{'':8}{'requests':>10}{'bytes':>12}{'revalidated on repeat visit':>30}")
+        for label, (requests, transferred, revalidated) in results.items():
+            self.stdout.write(f'{label:8}{requests:>10}{transferred:>12,}{revalidated:>30}')
+        before, after = results['before'][1], results['after'][1]
+        self.stdout.write(self.style.SUCCESS(f'{1 - after / before:.0%} fewer bytes on a cold load'))
+
+    def measure(self, backend, pages):
+        static_root = tempfile.mkdtemp()
+        try:
+            with override_settings(
+                DEBUG=False,
+                STATIC_ROOT=static_root,
+                STORAGES={'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+                          'staticfiles': {'BACKEND': backend}},
+            ):
+                call_command('collectstatic', interactive=False, verbosity=0)
+                return self.load(pages)
+        finally:
+            shutil.rmtree(static_root, ignore_errors=True)
+
+    def load(self, pages):
+        requests = transferred = revalidated = 0
+        seen = set()
+        with transaction.atomic():
+            admin = get_user_model().objects.create_superuser('static-transfer-check', password=None)
+            client = Client(HTTP_ACCEPT_ENCODING='br, gzip')
+            client.force_login(admin)
+
+            for page in pages:
+                response = client.get(page)
+                html = response.content.decode()
+                requests += 1
+                transferred += len(response.content)
+
+                for url in ASSET_PATTERN.findall(html):
+                    url = url.split('?')[0]
+                    if url in seen:
+                        continue
+                    seen.add(url)
+                    asset = client.get(url)
+                    if asset.status_code != 200:
+                        self.stderr.write(f'{url}: {asset.status_code}')
+                        continue
+                    requests += 1
+                    transferred += sum(len(chunk) for chunk in asset.streaming_content)
+                    if max_age(asset) < LONG_LIVED:
+                        revalidated += 1
+
+            transaction.set_rollback(True)
+        return requests, transferred, revalidated
@@ -0,0 +1,129 @@
+import os
+from collections import defaultdict
+from django.conf import settings
+from django.core.files import File
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from PIL import Image, UnidentifiedImageError
+from main import blobs, models
+from main.images import dhash
+from main.storages import content_digest
+
+
+def megabytes(size):
+    return f'{size / 1_048_576:.1f} MB'
+
+
+class Command(BaseCommand):
+    help = (
+        "Report how much of the media tree is duplicate or unreferenced image data. "
+        "With --apply, PropertyImage files stored before content addressing are moved "
+        "to it, so each distinct file is kept once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', default='restate_ads', help='Directory under MEDIA_ROOT to scan')
+        parser.add_argument(
+            '--distance', type=int, default=4,
+            help='Report originals whose perceptual hashes differ in at most this many bits',
+        )
+        parser.add_argument('--apply', action='store_true', help='Move legacy files into the content-addressed layout')
+
+    def handle(self, *args, **options):
+        files = self.scan(options['directory'])
+        referenced = set()
+        originals = set()
+        for name, renditions in models.PropertyImage.objects.values_list('images', 'renditions'):
+            originals.add(name)
+            referenced.update([name, *(r['name'] for r in renditions)])
+
+        by_digest = defaultdict(list)
+        for name, (size, digest) in files.items():
+            by_digest[digest].append(name)
+        duplicates = {digest: names for digest, names in by_digest.items() if len(names) > 1}
+        reclaimable = sum(files[names[0]][0] * (len(names) - 1) for names in duplicates.values())
+        unreferenced = [name for name in files if name not in referenced]
+
+        total = sum(size for size, _ in files.values())
+        self.stdout.write(f'{len(files)} files, {megabytes(total)}')
+        self.stdout.write(
+            f'{len(duplicates)} sets of identical files, {megabytes(reclaimable)} reclaimable by storing each once'
+        )
+        if options['verbosity'] > 1:
+            for names in duplicates.values():
+                self.stdout.write('  ' + ', '.join(sorted(names)))
+        self.stdout.write(
+            f'{len(unreferenced)} files not used by any PropertyImage, '
+            f'{megabytes(sum(files[name][0] for name in unreferenced))}'
+        )
+
+        similar = self.near_duplicates(
+            [names[0] for names in by_digest.values() if any(name in originals for name in names)],
+            options['distance'],
+        )
+        self.stdout.write(f'{len(similar)} pairs of different originals that look alike')
+        for first, second, bits in similar:
+            self.stdout.write(f'  {first} ~ {second} ({bits} bits)')
+
+        if options['apply']:
+            moved = self.apply()
+            self.stdout.write(self.style.SUCCESS(
+                f'{moved} images moved to content-addressed names. The old files are deleted '
+                f'by the outbox worker once they have been unreferenced for {blobs.GRACE}.'
+            ))
+
+    def scan(self, directory):
+        """Size and SHA-256 of every file, keyed by storage name."""
+        files = {}
+        root = os.path.join(settings.MEDIA_ROOT, directory)
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/')
+                with open(path, 'rb') as fileobj:
+                    files[name] = (os.path.getsize(path), content_digest(File(fileobj)))
+        return files
+
+    def near_duplicates(self, names, distance):
+        hashes = []
+        for name in names:
+            try:
+                with Image.open(os.path.join(settings.MEDIA_ROOT, name)) as image:
+                    hashes.append((name, int(dhash(image), 16)))
+            except (OSError, UnidentifiedImageError):
+                continue
+
+        pairs = []
+        for i, (first, first_hash) in enumerate(hashes):
+            for second, second_hash in hashes[i + 1:]:
+                bits = (first_hash ^ second_hash).bit_count()
+                if bits <= distance:
+                    pairs.append((first, second, bits))
+        return pairs
+
+    def apply(self):
+        storage = blobs.storage()
+        moved = 0
+        for image in models.PropertyImage.objects.order_by('pk').iterator(chunk_size=100):
+            old = blobs.references(image)
+            if all(blobs.DIGEST_PATTERN.search(name) for name in old):
+                continue
+            try:
+                with storage.open(image.images.name, 'rb') as fileobj:
+                    name = storage.save(image.images.name, fileobj)
+                renditions = []
+                for rendition in image.renditions:
+                    with storage.open(rendition['name'], 'rb') as fileobj:
+                        renditions.append({**rendition, 'name': storage.save(rendition['name'], fileobj)})
+            except OSError as exc:
+                self.stderr.write(f'{image.images.name}: {exc}')
+                continue
+
+            with transaction.atomic():
+                image.images.name, image.renditions = name, renditions
+                image.save(update_fields=['images', 'renditions'])
+                new = blobs.references(image)
+                blobs.acquire(name for name in new if name not in old)
+                blobs.release(name for name in old if name not in new)
+            moved += 1
+        return moved
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from main import conversations
+
+
+class Command(BaseCommand):
+    help = "Recompute every Conversation (last message, unread counts, last activity) from the messages"
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            written = conversations.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {written} conversation(s).'))
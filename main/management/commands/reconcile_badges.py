@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from main import badges
+
+
+class Command(BaseCommand):
+    help = "Recount the unread badges in Redis from Postgres, for --user or everyone who has any"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='user_ids', help='May be given more than once')
+        parser.add_argument('--push', action='store_true', help="Also send the recounted badges to the users' sockets")
+
+    def handle(self, *args, **options):
+        counts = badges.reconcile(options['user_ids'], notify=options['push'])
+        self.stdout.write(self.style.SUCCESS(f'Reconciled the badges of {len(counts)} user(s).'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from main import images
+
+
+class Command(BaseCommand):
+    help = (
+        "Render every PropertyImage still marked processing, e.g. uploads whose worker was "
+        "restarted mid-render. drain_outbox does this for images stuck across two housekeeping "
+        "rounds; images another process finishes meanwhile are left as that process rendered them."
+    )
+
+    def handle(self, *args, **options):
+        count = images.requeue_processing()
+        self.stdout.write(self.style.SUCCESS(f'Rendered {count} image(s) left processing.'))
@@ -1,10 +1,51 @@
-from django.core.management.base import BaseCommand
-from django.contrib.staticfiles import finders
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.exceptions import BotoCoreError, ClientError
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
 from main.storages import StaticStorage
 
 
+MANIFEST_NAME = 'uploadstatic-manifest.json'
+
+# WhiteNoise's precompressed copies; S3 cannot pick one per request, so the
+# originals are uploaded gzipped instead
+COMPRESSED_SUFFIXES = ('.gz', '.br')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'public, max-age=300'
+
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+    'text/css',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+    'text/xml',
+}
+
+
+def megabytes(size):
+    return f'{size / 1_048_576:.2f} MB'
+
+
 class Command(BaseCommand):
-    help = "Upload all static files to S3 using your StaticStorage backend"
+    help = (
+        "Run collectstatic and sync STATIC_ROOT to S3 using StaticStorage, so the hashed "
+        "names {% static %} refers to are in the bucket. Only files whose content changed "
+        "since the last run (according to a manifest kept in the bucket) are uploaded, "
+        "in parallel; text assets are gzipped and the hashed names in the staticfiles "
+        "manifest get long-lived cache headers."
+    )
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -12,20 +53,129 @@ class Command(BaseCommand):
             action='store_true',
             help='List the static files that would be uploaded without actually uploading them.'
         )
+        parser.add_argument('--workers', type=int, default=16, help='Concurrent uploads')
+        parser.add_argument('--force', action='store_true', help='Ignore the remote manifest and upload everything')
+        parser.add_argument('--skip-collect', action='store_true', help='Upload STATIC_ROOT as it is, without running collectstatic')
 
     def handle(self, *args, **options):
+        started = time.perf_counter()
         storage = StaticStorage()
-        total = 0
         dry_run = options['dry_run']
 
-        for finder in finders.get_finders():
-            for path, finder_storage in finder.list([]):
-                total += 1
-                self.stdout.write(f"[{total}] {'Would upload' if dry_run else 'Uploading'}: {path}")
-                if not dry_run:
-                    with finder_storage.open(path) as f:
-                        storage.save(path, f)
+        if not options['skip_collect']:
+            call_command('collectstatic', interactive=False, verbosity=0)
+        local = self.collect()
+        remote = {} if options['force'] else self.read_manifest(storage)
+        changed = {path for path, entry in local.items() if remote.get(path) != entry['hash']}
+        skipped_bytes = sum(entry['size'] for path, entry in local.items() if path not in changed)
+
+        if dry_run or options['verbosity'] > 1:
+            for path in sorted(changed):
+                self.stdout.write(f"{'Would upload' if dry_run else 'Uploading'}: {path}")
+        if dry_run:
+            self.stdout.write(self.style.SUCCESS(
+                f'Dry run complete! {len(changed)} of {len(local)} static file(s) would be uploaded, '
+                f'{megabytes(sum(local[path]["size"] for path in changed))}.'
+            ))
+            return
+
+        uploaded, sent, failed = set(), 0, []
+        client = storage.client  # created once here, shared by the workers
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            futures = {pool.submit(self.upload, client, storage, path, local[path]): path for path in changed}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    sent += future.result()
+                except (BotoCoreError, ClientError, OSError) as exc:
+                    failed.append(path)
+                    self.stderr.write(f'{path}: {exc}')
+                else:
+                    uploaded.add(path)
+
+        # failed files keep their old hash, so the next run retries them
+        manifest = {path: remote[path] for path in local if path in remote}
+        manifest.update({path: local[path]['hash'] for path in local if path not in changed or path in uploaded})
+        self.write_manifest(storage, manifest)
 
+        raw = sum(local[path]['size'] for path in uploaded)
         self.stdout.write(self.style.SUCCESS(
-            f"{'Dry run complete!' if dry_run else 'Done!'} {total} static file(s) {'listed' if dry_run else 'uploaded'}."
+            f'Done! {len(uploaded)} uploaded ({megabytes(raw)}, {megabytes(sent)} sent after compression), '
+            f'{len(local) - len(changed)} unchanged skipped ({megabytes(skipped_bytes)}), '
+            f'{len(failed)} failed, in {time.perf_counter() - started:.1f}s.'
         ))
+        if failed:
+            raise CommandError(f'{len(failed)} file(s) failed to upload.')
+
+    def collect(self):
+        """
+        Content hash, size and cache policy of every file collectstatic wrote
+        to STATIC_ROOT, by path. Hashed names are the values of the
+        staticfiles manifest.
+        """
+        root = settings.STATIC_ROOT
+        if not root or not os.path.isdir(root):
+            raise CommandError('STATIC_ROOT does not exist; run collectstatic first.')
+
+        hashed = set()
+        if hasattr(staticfiles_storage, 'load_manifest'):
+            paths, _ = staticfiles_storage.load_manifest()
+            hashed.update(paths.values())
+
+        files = set()
+        for directory, _, names in os.walk(root):
+            for name in names:
+                files.add(os.path.relpath(os.path.join(directory, name), root).replace(os.sep, '/'))
+        local = {}
+        for path in files:
+            if path.endswith(COMPRESSED_SUFFIXES) and path[:-3] in files:
+                continue
+            source = os.path.join(root, path)
+            with open(source, 'rb') as f:
+                content = f.read()
+            local[path] = {
+                'hash': hashlib.sha256(content).hexdigest(),
+                'size': len(content),
+                'source': source,
+                'immutable': path in hashed,
+            }
+        return local
+
+    def read_manifest(self, storage):
+        try:
+            body = storage.client.get_object(Bucket=storage.bucket_name, Key=storage.key(MANIFEST_NAME))['Body']
+        except ClientError as exc:
+            if exc.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return {}
+            raise
+        return json.loads(body.read())
+
+    def write_manifest(self, storage, manifest):
+        storage.client.put_object(
+            Bucket=storage.bucket_name,
+            Key=storage.key(MANIFEST_NAME),
+            Body=json.dumps(manifest, sort_keys=True).encode(),
+            ContentType='application/json',
+            CacheControl='no-cache',
+        )
+
+    def upload(self, client, storage, path, entry):
+        """Put one file; returns the bytes sent."""
+        with open(entry['source'], 'rb') as f:
+            body = f.read()
+
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        params = {
+            'ContentType': content_type,
+            'CacheControl': IMMUTABLE if entry['immutable'] else REVALIDATE,
+        }
+        if content_type in COMPRESSIBLE_TYPES:
+            compressed = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(compressed) < len(body):
+                body = compressed
+                params['ContentEncoding'] = 'gzip'
+        if storage.default_acl:
+            params['ACL'] = storage.default_acl
+
+        client.put_object(Bucket=storage.bucket_name, Key=storage.key(path), Body=body, **params)
+        return len(body)
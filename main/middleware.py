@@ -1,34 +1,156 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
 from urllib.parse import parse_qs
 from channels.middleware import BaseMiddleware
+from django.conf import settings
+
+
+class UserCache:
+    """
+    Users resolved from websocket tokens, keyed by (user_id, jti) and kept
+    for WEBSOCKET_USER_CACHE_TTL seconds. Mobile clients reconnect with the
+    same token over and over, so most handshakes skip the database.
+
+    A user's entries are dropped when the user is saved or deleted (see
+    main/signals.py); that only reaches this process, so the TTL bounds how
+    long another one can keep a stale user.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._keys_by_user = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def set(self, key, user):
+        expires = time.monotonic() + settings.WEBSOCKET_USER_CACHE_TTL
+        with self._lock:
+            self._entries[key] = (user, expires)
+            self._entries.move_to_end(key)
+            self._keys_by_user.setdefault(key[0], set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._forget(next(iter(self._entries)))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            for key in list(self._keys_by_user.get(str(user_id), ())):
+                self._forget(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_user.clear()
+            self.hits = self.misses = 0
+
+    def _forget(self, key):
+        self._entries.pop(key, None)
+        keys = self._keys_by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[key[0]]
+
+
+user_cache = UserCache()
+
+
+def load_users(user_ids):
+    """Active users by str(id)."""
+    from django.contrib.auth import get_user_model
+    from rest_framework_simplejwt.settings import api_settings
+
+    User = get_user_model()
+    users = User.objects.filter(**{f'{api_settings.USER_ID_FIELD}__in': user_ids}, is_active=True)
+    return {str(getattr(user, api_settings.USER_ID_FIELD)): user for user in users}
+
+
+class UserLoader:
+    """
+    Loads the users of concurrent handshakes together: ids asked for while a
+    query is running wait for the next one, so a connect storm costs a query
+    (and a database connection, which channels opens per call) per batch
+    instead of per handshake.
+    """
+
+    def __init__(self):
+        self._pending = {}  # loop -> {user_id: future}
+        self._running = {}  # loop -> task draining it
+
+    async def load(self, user_id):
+        loop = asyncio.get_running_loop()
+        pending = self._pending.setdefault(loop, {})
+        future = pending.get(str(user_id))
+        if future is None:
+            future = pending[str(user_id)] = loop.create_future()
+        if loop not in self._running:
+            self._running[loop] = loop.create_task(self._drain(loop))
+        # shielded: one handshake going away must not cancel the others' lookup
+        return await asyncio.shield(future)
+
+    async def _drain(self, loop):
+        from channels.db import database_sync_to_async
+
+        try:
+            while self._pending.get(loop):
+                batch = self._pending.pop(loop)
+                try:
+                    users = await database_sync_to_async(load_users)(list(batch))
+                except Exception as exc:
+                    for future in batch.values():
+                        future.set_exception(exc)
+                    continue
+                for user_id, future in batch.items():
+                    future.set_result(users.get(user_id))
+        finally:
+            self._running.pop(loop, None)
+            self._pending.pop(loop, None)
+
+
+user_loader = UserLoader()
+
 
 class JwtAuthMiddleware(BaseMiddleware):
     async def __call__(self, scope, receive, send):
+        scope['user'] = await self.resolve_user(scope)
+        return await super().__call__(scope, receive, send)
+
+    async def resolve_user(self, scope):
         # Import Django and JWT classes inside method to avoid early evaluation
-        from django.conf import settings
-        from django.contrib.auth import get_user_model
         from django.contrib.auth.models import AnonymousUser
-        from channels.db import database_sync_to_async
+        from rest_framework_simplejwt.exceptions import TokenError
+        from rest_framework_simplejwt.settings import api_settings
         from rest_framework_simplejwt.tokens import UntypedToken
-        import jwt
-        from jwt import InvalidTokenError
-
-        User = get_user_model()
 
         # Extract token from query string: ?token=<jwt>
         qs = parse_qs(scope.get('query_string', b'').decode())
         token_list = qs.get('token')
-        if token_list:
-            token = token_list[0]
-            try:
-
-                UntypedToken(token)
-                # Decode to get user_id
-                decoded_data = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-                user = await database_sync_to_async(User.objects.get)(id=decoded_data.get('user_id'))
-                scope['user'] = user
-            except (InvalidTokenError, KeyError, User.DoesNotExist):
-                scope['user'] = AnonymousUser()
-        else:
-            scope['user'] = AnonymousUser()
+        if not token_list:
+            return AnonymousUser()
 
-        return await super().__call__(scope, receive, send)
+        try:
+            # one pass: signature, expiry and claims
+            token = UntypedToken(token_list[0])
+            user_id = token[api_settings.USER_ID_CLAIM]
+        except (TokenError, KeyError):
+            return AnonymousUser()
+
+        key = (str(user_id), token.get(api_settings.JTI_CLAIM))
+        user = user_cache.get(key)
+        if user is None:
+            user = await user_loader.load(user_id)
+            if user is None:
+                return AnonymousUser()
+            user_cache.set(key, user)
+        return user
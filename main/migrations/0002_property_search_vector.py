@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:32
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+# Weights: A title, B listing/property type, C address, D description.
+SEARCH_VECTOR_SQL = '''
+CREATE OR REPLACE FUNCTION main_property_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(NEW.type, '') || ' ' || coalesce(NEW.property_type, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(NEW.detailed_address, '')), 'C') ||
+        setweight(to_tsvector('english', coalesce(NEW.description, '')), 'D');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER main_property_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, type, property_type, detailed_address, description
+    ON main_property
+    FOR EACH ROW EXECUTE FUNCTION main_property_search_vector_update();
+
+UPDATE main_property SET title = title;
+'''
+
+DROP_SEARCH_VECTOR_SQL = '''
+DROP TRIGGER IF EXISTS main_property_search_vector_trigger ON main_property;
+DROP FUNCTION IF EXISTS main_property_search_vector_update();
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='property',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='property',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='property_search_vector_gin'),
+        ),
+        migrations.RunSQL(SEARCH_VECTOR_SQL, DROP_SEARCH_VECTOR_SQL),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:34
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # build the indexes without locking main_property against writes
+    atomic = False
+
+    dependencies = [
+        ('main', '0002_property_search_vector'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='property',
+            index=models.Index(condition=models.Q(('is_verified', True)), fields=['expiry_date'], name='property_live_expiry_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='property',
+            index=models.Index(condition=models.Q(('is_verified', True)), fields=['-date_posted', '-id'], name='property_live_recent_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='property',
+            index=models.Index(condition=models.Q(('is_verified', True)), fields=['price', 'id'], name='property_live_price_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='property',
+            index=models.Index(condition=models.Q(('is_verified', True)), fields=['city', '-date_posted', '-id'], name='property_city_recent_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='property',
+            index=models.Index(condition=models.Q(('is_verified', True)), fields=['city', 'price', 'id'], name='property_city_price_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='property',
+            index=models.Index(condition=models.Q(('is_verified', True)), fields=['type', 'property_type', '-date_posted', '-id'], name='property_type_recent_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='property',
+            index=models.Index(condition=models.Q(('is_verified', True)), fields=['type', 'property_type', 'price', 'id'], name='property_type_price_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='property',
+            index=models.Index(fields=['creator', '-date_posted', '-id'], name='property_creator_recent_idx'),
+        ),
+    ]
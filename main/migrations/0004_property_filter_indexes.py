@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:36
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('main', '0003_property_listing_indexes'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='property',
+            index=models.Index(condition=models.Q(('is_verified', True)), fields=['city', 'type', 'property_type', 'price'], name='property_city_type_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='property',
+            index=models.Index(condition=models.Q(('is_verified', True)), fields=['number_of_bedrooms', 'price'], name='property_bedrooms_price_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_property_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='property',
+            name='unique_visitors',
+            field=models.PositiveIntegerField(default=0, help_text='Approximate number of distinct visitors'),
+        ),
+    ]
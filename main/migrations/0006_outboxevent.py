@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:52
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_property_unique_visitors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(choices=[('push', 'Push notification'), ('email', 'Email'), ('message_email', 'Message email'), ('websocket', 'Websocket')], max_length=20)),
+                ('payload', models.JSONField()),
+                ('dedupe_key', models.CharField(max_length=200, unique=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('delivered_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('delivered_at__isnull', True)), fields=['channel', 'available_at'], name='outbox_pending_idx'), models.Index(fields=['channel', 'delivered_at'], name='outbox_delivered_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:09
+
+import main.storages
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_propertyimage_status'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='propertyimage',
+            name='images',
+            field=models.ImageField(storage=main.storages.property_image_storage, upload_to='restate_ads/'),
+        ),
+        migrations.CreateModel(
+            name='ImageBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('sha256', models.CharField(blank=True, db_index=True, max_length=64)),
+                ('phash', models.CharField(blank=True, db_index=True, max_length=16)),
+                ('size', models.BigIntegerField(blank=True, null=True)),
+                ('ref_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('released_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('ref_count__lte', 0)), fields=['released_at'], name='imageblob_orphan_idx')],
+            },
+        ),
+    ]
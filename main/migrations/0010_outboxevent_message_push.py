@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_imageblob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outboxevent',
+            name='channel',
+            field=models.CharField(choices=[('push', 'Push notification'), ('email', 'Email'), ('message_email', 'Message email'), ('message_push', 'Message push'), ('websocket', 'Websocket')], max_length=20),
+        ),
+    ]
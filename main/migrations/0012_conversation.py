@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:20
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+# one conversation per pair of users with messages (as conversations.rebuild)
+BACKFILL_SQL = """
+    INSERT INTO main_conversation (id, user_low_id, user_high_id, last_message_id, unread_low, unread_high, last_activity)
+    SELECT
+        gen_random_uuid(), low, high,
+        (array_agg(id ORDER BY timestamp DESC, id DESC))[1],
+        count(*) FILTER (WHERE NOT is_read AND recipient_id = low),
+        count(*) FILTER (WHERE NOT is_read AND recipient_id = high AND low <> high),
+        max(timestamp)
+    FROM (
+        SELECT id, timestamp, is_read, recipient_id,
+               LEAST(sender_id, recipient_id) AS low, GREATEST(sender_id, recipient_id) AS high
+        FROM main_message
+    ) messages
+    GROUP BY low, high
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_message_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('unread_low', models.PositiveIntegerField(default=0)),
+                ('unread_high', models.PositiveIntegerField(default=0)),
+                ('last_activity', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='main.message')),
+                ('user_high', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_low', '-last_activity'], name='conversation_low_inbox_idx'), models.Index(fields=['user_high', '-last_activity'], name='conversation_high_inbox_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user_low', 'user_high'), name='conversation_pair_unique'), models.CheckConstraint(condition=models.Q(('user_low__lte', models.F('user_high'))), name='conversation_pair_ordered')],
+            },
+        ),
+        migrations.RunSQL(BACKFILL_SQL, migrations.RunSQL.noop),
+    ]
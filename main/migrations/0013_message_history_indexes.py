@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:28
+
+import django.db.models.deletion
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('main', '0012_conversation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='read_high_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='read_low_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        AddIndexConcurrently(
+            model_name='message',
+            index=models.Index(fields=['recipient', 'sender', 'timestamp'], name='message_thread_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='message',
+            index=models.Index(fields=['recipient', 'is_read'], name='message_unread_idx'),
+        ),
+        # the recipient_id index is a prefix of message_thread_idx; dropped
+        # concurrently, as AlterField would lock main_message meanwhile
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    'DROP INDEX CONCURRENTLY IF EXISTS "main_message_recipient_id_2c3bcb37"',
+                    'CREATE INDEX CONCURRENTLY IF NOT EXISTS "main_message_recipient_id_2c3bcb37" ON "main_message" ("recipient_id")',
+                ),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='message',
+                    name='recipient',
+                    field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='received_messages', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+        ),
+    ]
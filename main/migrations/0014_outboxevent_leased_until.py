@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_message_history_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxevent',
+            name='leased_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -3,11 +3,57 @@ from django.utils.text import slugify
 import uuid
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import timezone
 from datetime import timedelta
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.conf import settings
+from .storages import property_image_storage
+
+
+class TrackedFieldsMixin:
+    """
+    Remembers the values of `tracked_fields` as loaded from the database (and
+    as of the last save), so signal receivers can tell whether a field changed
+    without fetching the row again.
+    """
+    tracked_fields = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._snapshot_tracked_fields()
+        return instance
+
+    def _snapshot_tracked_fields(self, names=None):
+        if not hasattr(self, '_loaded_values'):
+            self._loaded_values = {}
+        deferred = self.get_deferred_fields()
+        for name in self.tracked_fields:
+            if (names is None or name in names) and name not in deferred:
+                self._loaded_values[name] = getattr(self, name)
+
+    def tracked_field_changed(self, name, update_fields=None):
+        """
+        For post_save receivers: whether this save wrote a new value to a
+        tracked field. Saves whose update_fields leave the field out never
+        count; instances that were not loaded from the database always do.
+        """
+        if update_fields is not None and name not in update_fields:
+            return False
+        loaded = getattr(self, '_loaded_values', {})
+        return name not in loaded or loaded[name] != getattr(self, name)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._snapshot_tracked_fields(kwargs.get('update_fields'))
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        self._snapshot_tracked_fields(fields)
 
 
 class CompleteUser(AbstractUser):
@@ -40,8 +86,23 @@ class PropertyFeature(models.Model):
     objects = models.Manager()
 
 
+class PropertyQuerySet(models.QuerySet):
+
+    def live(self):
+        # the public listing predicate; backed by the partial indexes on Property
+        return self.filter(is_verified=True, expiry_date__gt=timezone.now())
 
-class Property(models.Model):
+    def for_listing(self):
+        # everything PropertySerializer renders, in a fixed number of queries
+        return self.defer('search_vector').select_related('city__region').prefetch_related(
+            models.Prefetch('features', queryset=PropertyFeature.objects.only('id', 'name')),
+            models.Prefetch('images', queryset=PropertyImage.objects.exclude(status=PropertyImage.STATUS_FAILED).order_by('id')),
+            models.Prefetch('reviews', queryset=PropertyReview.objects.order_by('created_at')),
+        )
+
+
+class Property(TrackedFieldsMixin, models.Model):
+    tracked_fields = ('is_verified',)
 
     def default_expiry():
         return timezone.now() + timedelta(days=14)
@@ -108,6 +169,7 @@ class Property(models.Model):
     features = models.ManyToManyField(PropertyFeature, related_name='property_features', blank=True)
     city = models.ForeignKey('City', on_delete=models.CASCADE, related_name='cities')
     visit_count = models.PositiveIntegerField(default=0, help_text="Total number of times this property has been viewed")
+    unique_visitors = models.PositiveIntegerField(default=0, help_text="Approximate number of distinct visitors")
     detailed_address = models.TextField(blank=True, null=True)
     square_meters = models.DecimalField(max_digits=7, decimal_places=2, null=True, blank=True)
     parking_spaces = models.PositiveIntegerField(default=0)
@@ -125,12 +187,30 @@ class Property(models.Model):
     expiry_date = models.DateTimeField(default=default_expiry)
     slug = models.SlugField(unique=True, blank=True)
     date_posted = models.DateField(auto_now_add=True)
+    # maintained by a database trigger, see migration 0002_property_search_vector
+    search_vector = SearchVectorField(null=True, editable=False)
 
     class Meta:
         verbose_name_plural = 'properties'
+        indexes = [
+            GinIndex(fields=['search_vector'], name='property_search_vector_gin'),
+            # partial indexes over live (verified) listings, one per filter/order shape
+            models.Index(fields=['expiry_date'], condition=models.Q(is_verified=True), name='property_live_expiry_idx'),
+            models.Index(fields=['-date_posted', '-id'], condition=models.Q(is_verified=True), name='property_live_recent_idx'),
+            models.Index(fields=['price', 'id'], condition=models.Q(is_verified=True), name='property_live_price_idx'),
+            models.Index(fields=['city', '-date_posted', '-id'], condition=models.Q(is_verified=True), name='property_city_recent_idx'),
+            models.Index(fields=['city', 'price', 'id'], condition=models.Q(is_verified=True), name='property_city_price_idx'),
+            models.Index(fields=['type', 'property_type', '-date_posted', '-id'], condition=models.Q(is_verified=True), name='property_type_recent_idx'),
+            models.Index(fields=['type', 'property_type', 'price', 'id'], condition=models.Q(is_verified=True), name='property_type_price_idx'),
+            models.Index(fields=['city', 'type', 'property_type', 'price'], condition=models.Q(is_verified=True), name='property_city_type_idx'),
+            models.Index(fields=['number_of_bedrooms', 'price'], condition=models.Q(is_verified=True), name='property_bedrooms_price_idx'),
+            # my-properties
+            models.Index(fields=['creator', '-date_posted', '-id'], name='property_creator_recent_idx'),
+        ]
 
     def save(self, *args, **kwargs):
-        if not self.slug:
+        # a deferred slug was loaded from the database, so it is already set
+        if 'slug' not in self.get_deferred_fields() and not self.slug:
             self.slug = slugify(self.title)
 
         super().save(*args, **kwargs)
@@ -138,15 +218,31 @@ class Property(models.Model):
     def __str__(self):
         return f'{self.title}-{self.type}-{self.property_type}'
 
-    objects = models.Manager()
+    objects = PropertyQuerySet.as_manager()
 
 
 class PropertyImage(models.Model):
+    STATUS_PROCESSING = 'processing'
+    STATUS_READY = 'ready'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_READY, 'Ready'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
     property = models.ForeignKey(Property, on_delete=models.CASCADE, related_name='images')
     images     = models.ImageField(
                     upload_to='restate_ads/',
                     # storage=MediaStorage(),
+                    storage=property_image_storage,
                 )
+    width      = models.PositiveIntegerField(null=True, blank=True)
+    height     = models.PositiveIntegerField(null=True, blank=True)
+    # [{'width', 'height', 'format', 'name'}], see main/images.py
+    renditions = models.JSONField(default=list, blank=True)
+    placeholder = models.TextField(blank=True)
+    status     = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_READY)
     created_at = models.DateField(auto_now_add=True)
 
     def __str__(self):
@@ -157,6 +253,29 @@ class PropertyImage(models.Model):
     objects = models.Manager()
 
 
+class ImageBlob(models.Model):
+    """
+    A file in the content-addressed image storage and how many references
+    (PropertyImage originals and renditions) point at it. See main/blobs.py.
+    """
+    name       = models.CharField(max_length=255, unique=True)
+    sha256     = models.CharField(max_length=64, blank=True, db_index=True)
+    # 64-bit difference hash of originals, for spotting near-duplicate photos
+    phash      = models.CharField(max_length=16, blank=True, db_index=True)
+    size       = models.BigIntegerField(null=True, blank=True)
+    ref_count  = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    released_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['released_at'], condition=models.Q(ref_count__lte=0), name='imageblob_orphan_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.ref_count})'
+
+
 class PropertyReview(models.Model):
     author = models.ForeignKey(CompleteUser, on_delete=models.CASCADE, related_name='authors')
     property = models.ForeignKey(Property, on_delete=models.CASCADE, related_name='reviews')   
@@ -244,19 +363,66 @@ class PushToken(models.Model):
 class Message(models.Model):
     id          = models.UUIDField(primary_key=True, editable=False, unique=True, default=uuid.uuid4)
     sender      = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='sent_messages', on_delete=models.CASCADE)
-    recipient   = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='received_messages', on_delete=models.CASCADE)
+    # indexed by message_thread_idx below
+    recipient   = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='received_messages', on_delete=models.CASCADE, db_index=False)
     content     = models.TextField()
-    timestamp   = models.DateTimeField(auto_now_add=True)
+    # set when the message is received, not when it is written; chat
+    # messages are saved in batches after they have been delivered
+    timestamp   = models.DateTimeField(default=timezone.now, editable=False)
     avatar_url  = models.URLField(blank=True, null=True)
     is_read     = models.BooleanField(default=False)
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # history windows and read receipts of one direction of a conversation
+            models.Index(fields=['recipient', 'sender', 'timestamp'], name='message_thread_idx'),
+            models.Index(fields=['recipient', 'is_read'], name='message_unread_idx'),
+        ]
 
     def __str__(self):
         return f'From {self.sender} to {self.recipient} at {self.timestamp}'
 
 
+class Conversation(models.Model):
+    """
+    Inbox summary of the messages between two users, kept up to date on
+    every message write by main/conversations.py. user_low is whichever
+    participant has the smaller id; unread_low counts the messages user_low
+    has not read yet, unread_high those of user_high. read_low_at and
+    read_high_at are how far each side's last read receipt went.
+    """
+    id            = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    # indexed by the unique constraint and the inbox indexes below
+    user_low      = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.CASCADE, db_index=False)
+    user_high     = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.CASCADE, db_index=False)
+    last_message  = models.ForeignKey(Message, related_name='+', null=True, blank=True, on_delete=models.SET_NULL)
+    unread_low    = models.PositiveIntegerField(default=0)
+    unread_high   = models.PositiveIntegerField(default=0)
+    last_activity = models.DateTimeField(default=timezone.now)
+    read_low_at   = models.DateTimeField(null=True, blank=True)
+    read_high_at  = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_low', 'user_high'], name='conversation_pair_unique'),
+            models.CheckConstraint(condition=models.Q(user_low__lte=models.F('user_high')), name='conversation_pair_ordered'),
+        ]
+        indexes = [
+            models.Index(fields=['user_low', '-last_activity'], name='conversation_low_inbox_idx'),
+            models.Index(fields=['user_high', '-last_activity'], name='conversation_high_inbox_idx'),
+        ]
+
+    def other_user(self, user_id):
+        return self.user_high if self.user_low_id == user_id else self.user_low
+
+    def unread_for(self, user_id):
+        return self.unread_low if self.user_low_id == user_id else self.unread_high
+
+    def __str__(self):
+        return f'{self.user_low} and {self.user_high}'
+
+
 class Notification(models.Model):
     id            = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user          = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='notifications', on_delete=models.CASCADE)
@@ -429,7 +595,9 @@ class SubscriptionPayment(models.Model):
 
 
 
-class ListingPayment(models.Model):
+class ListingPayment(TrackedFieldsMixin, models.Model):
+    tracked_fields = ('status',)
+
     user = models.ForeignKey(CompleteUser, on_delete=models.CASCADE)
     property = models.ForeignKey(Property, on_delete=models.CASCADE, related_name='payments')
     amount       = models.DecimalField(max_digits=12, decimal_places=2)
@@ -447,3 +615,48 @@ class ListingPayment(models.Model):
     
 
     objects = models.Manager()
+
+
+class OutboxEvent(models.Model):
+    """
+    A side effect (push, email, websocket message) recorded in the same
+    transaction as the change that caused it and delivered later by
+    `manage.py drain_outbox`.
+    """
+    CHANNEL_PUSH = 'push'
+    CHANNEL_EMAIL = 'email'
+    CHANNEL_MESSAGE_EMAIL = 'message_email'
+    CHANNEL_MESSAGE_PUSH = 'message_push'
+    CHANNEL_WEBSOCKET = 'websocket'
+    CHANNEL_CHOICES = [
+        (CHANNEL_PUSH, 'Push notification'),
+        (CHANNEL_EMAIL, 'Email'),
+        (CHANNEL_MESSAGE_EMAIL, 'Message email'),
+        (CHANNEL_MESSAGE_PUSH, 'Message push'),
+        (CHANNEL_WEBSOCKET, 'Websocket'),
+    ]
+
+    channel = models.CharField(max_length=20, choices=CHANNEL_CHOICES)
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+    # writing the same key twice is a no-op, so an event is only ever queued once
+    dedupe_key = models.CharField(max_length=200, unique=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    available_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # set while a worker is delivering the event
+    leased_until = models.DateTimeField(null=True, blank=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['channel', 'available_at'],
+                condition=models.Q(delivered_at__isnull=True),
+                name='outbox_pending_idx',
+            ),
+            models.Index(fields=['channel', 'delivered_at'], name='outbox_delivered_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.channel} {self.dedupe_key}'
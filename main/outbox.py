@@ -0,0 +1,208 @@
+"""
+Transactional outbox.
+
+Side effects (pushes, emails, websocket messages) are written to
+OutboxEvent in the same transaction as the change that causes them, so
+they are durable once it commits and vanish if it rolls back, and no
+network I/O happens while the transaction is open.
+
+`manage.py drain_outbox` delivers them at least once: a batch is claimed
+with SELECT ... FOR UPDATE SKIP LOCKED and leased for LEASE, delivered, and
+marked delivered. A worker that dies mid-batch leaves the lease to expire
+and another worker redelivers it. leased_until marks the events of a
+batch in flight, so that coalescing (see COALESCE) never takes them from
+the worker delivering them.
+"""
+import logging
+from datetime import timedelta
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Avg, Count, DurationField, ExpressionWrapper, F, Min, Q
+from django.utils import timezone
+from .models import OutboxEvent
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 8
+# how long a claimed batch is hidden from other workers while it is delivered
+LEASE = timedelta(minutes=5)
+
+
+def make_event(channel, payload, dedupe_key, delay=None):
+    """An unsaved OutboxEvent, for emit_many."""
+    return OutboxEvent(
+        channel=channel,
+        payload=payload,
+        dedupe_key=dedupe_key,
+        available_at=timezone.now() + (delay or timedelta()),
+    )
+
+
+def emit_many(events):
+    """
+    Queue unsaved events in the current transaction with one INSERT per 500.
+    Events whose dedupe_key already exists are skipped.
+    """
+    OutboxEvent.objects.bulk_create(events, batch_size=500, ignore_conflicts=True)
+
+
+def emit(channel, payload, dedupe_key, delay=None):
+    """
+    Queue a side effect in the current transaction. Emitting a dedupe_key
+    that already exists does nothing.
+    """
+    emit_many([make_event(channel, payload, dedupe_key, delay)])
+
+
+def send_push(payloads):
+    from .expo_utils import deliver_to_users
+
+    # per-device failures are retried and logged by deliver_to_users itself;
+    # it raises, and the batch is retried later, only when Expo could not be
+    # reached: what Expo rejected would be rejected again
+    deliver_to_users(
+        ((p['user_id'], p['title'], p['body'], p['data']) for p in payloads),
+        raise_unavailable=True,
+    )
+
+
+def send_email(payloads):
+    emails = [EmailMessage(p['subject'], p['body'], settings.DEFAULT_FROM_EMAIL, p['to']) for p in payloads]
+    get_connection(fail_silently=False).send_messages(emails)
+
+
+def send_message_email(payloads):
+    from .delivery import send_message_emails
+
+    send_message_emails([p['message_id'] for p in payloads])
+
+
+def send_message_push(payloads):
+    from .delivery import send_message_pushes
+
+    send_message_pushes([p['message_id'] for p in payloads])
+
+
+def send_websocket(payloads):
+    from channels.layers import get_channel_layer
+
+    channel_layer = get_channel_layer()
+    for p in payloads:
+        async_to_sync(channel_layer.group_send)(p['group'], p['message'])
+
+
+HANDLERS = {
+    OutboxEvent.CHANNEL_PUSH: send_push,
+    OutboxEvent.CHANNEL_EMAIL: send_email,
+    OutboxEvent.CHANNEL_MESSAGE_EMAIL: send_message_email,
+    OutboxEvent.CHANNEL_MESSAGE_PUSH: send_message_push,
+    OutboxEvent.CHANNEL_WEBSOCKET: send_websocket,
+}
+
+# payload keys whose not-yet-due events are delivered along with a due one,
+# e.g. every queued message email for a recipient goes out as one digest
+COALESCE = {
+    OutboxEvent.CHANNEL_MESSAGE_EMAIL: 'recipient_id',
+    OutboxEvent.CHANNEL_MESSAGE_PUSH: 'recipient_id',
+}
+
+
+def _backoff(attempts):
+    return timedelta(seconds=min(3600, 5 * 2 ** attempts))
+
+
+def claim(channel, batch_size=BATCH_SIZE):
+    """Lease up to batch_size due events of a channel to the caller."""
+    now = timezone.now()
+    pending = OutboxEvent.objects.filter(channel=channel, delivered_at__isnull=True, attempts__lt=MAX_ATTEMPTS)
+    with transaction.atomic():
+        events = list(
+            pending.filter(available_at__lte=now)
+            .order_by('available_at')
+            .select_for_update(skip_locked=True)[:batch_size]
+        )
+        key = COALESCE.get(channel)
+        if key and events:
+            values = {event.payload[key] for event in events}
+            # not yet due, and not being delivered by another worker
+            events += list(
+                pending.filter(available_at__gt=now, **{f'payload__{key}__in': values})
+                .filter(Q(leased_until__isnull=True) | Q(leased_until__lte=now))
+                .select_for_update(skip_locked=True)
+            )
+        OutboxEvent.objects.filter(pk__in=[event.pk for event in events]).update(
+            attempts=F('attempts') + 1, available_at=now + LEASE, leased_until=now + LEASE,
+        )
+    return events
+
+
+def process(channel, batch_size=BATCH_SIZE):
+    """
+    Claim and deliver one batch of a channel. Returns how many events were
+    claimed; a failed batch is retried later with exponential backoff.
+    """
+    events = claim(channel, batch_size)
+    if not events:
+        return 0
+
+    try:
+        HANDLERS[channel]([event.payload for event in events])
+    except Exception as exc:
+        logger.exception('Delivering %s outbox events failed', channel)
+        now = timezone.now()
+        for event in events:
+            event.attempts += 1
+            event.available_at = now + _backoff(event.attempts)
+            event.leased_until = None
+            event.last_error = repr(exc)[:1000]
+        OutboxEvent.objects.bulk_update(events, ['available_at', 'leased_until', 'last_error'])
+        return len(events)
+
+    OutboxEvent.objects.filter(pk__in=[event.pk for event in events], delivered_at__isnull=True).update(
+        delivered_at=timezone.now(), leased_until=None, last_error='',
+    )
+    return len(events)
+
+
+def lag_stats():
+    """Per channel backlog and delivery lag, for monitoring."""
+    now = timezone.now()
+    lag = ExpressionWrapper(F('delivered_at') - F('created_at'), output_field=DurationField())
+    pending = {
+        row['channel']: row
+        for row in OutboxEvent.objects.filter(delivered_at__isnull=True).values('channel').annotate(
+            pending=Count('id'),
+            dead=Count('id', filter=Q(attempts__gte=MAX_ATTEMPTS)),
+            oldest=Min('created_at'),
+        )
+    }
+    delivered = {
+        row['channel']: row
+        for row in OutboxEvent.objects.filter(delivered_at__gte=now - timedelta(hours=1)).values('channel').annotate(
+            delivered=Count('id'),
+            average_lag=Avg(lag),
+        )
+    }
+
+    stats = {}
+    for channel, _ in OutboxEvent.CHANNEL_CHOICES:
+        waiting = pending.get(channel, {})
+        done = delivered.get(channel, {})
+        stats[channel] = {
+            'pending': waiting.get('pending', 0),
+            'dead': waiting.get('dead', 0),
+            'oldest_pending_seconds': (now - waiting['oldest']).total_seconds() if waiting.get('oldest') else 0,
+            'delivered_last_hour': done.get('delivered', 0),
+            'average_lag_seconds': done['average_lag'].total_seconds() if done.get('average_lag') else 0,
+        }
+    return stats
+
+
+def purge_delivered(older_than=timedelta(days=7)):
+    """Delete delivered events older than `older_than`. Returns how many."""
+    deleted, _ = OutboxEvent.objects.filter(delivered_at__lt=timezone.now() - older_than).delete()
+    return deleted
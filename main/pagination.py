@@ -0,0 +1,167 @@
+import base64
+import binascii
+import json
+from collections import OrderedDict
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination keyed on (<ordering field>, id).
+
+    Each page is fetched with a `WHERE (field, id) > (last_field, last_id)`
+    style predicate instead of an OFFSET, so page 500 costs the same as page 1
+    and rows inserted while a client scrolls never shift the window.
+    """
+    cursor_query_param = 'cursor'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = '-date_posted'
+    tiebreaker = 'id'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.field_name, self.descending = self.get_ordering(request, queryset, view)
+        self.queryset = queryset
+
+        position, self.reverse = self.decode_cursor(request)
+
+        # walking backwards flips the sort so the rows nearest the cursor come first
+        descending = self.descending != self.reverse
+        prefix = '-' if descending else ''
+        queryset = queryset.order_by(prefix + self.field_name, prefix + self.tiebreaker)
+
+        if position is not None:
+            value, pk = position
+            lookup = 'lt' if descending else 'gt'
+            queryset = queryset.filter(
+                Q(**{f'{self.field_name}__{lookup}': value}) |
+                Q(**{self.field_name: value, f'{self.tiebreaker}__{lookup}': pk})
+            )
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+
+        if self.reverse:
+            results.reverse()
+            self.has_next = position is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = position is not None
+
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if size <= 0:
+            return self.page_size
+        return min(size, self.max_page_size)
+
+    def get_ordering(self, request, queryset, view):
+        """
+        Reuse whatever the view's OrderingFilter resolved, but only its first
+        term: the cursor is built from that field plus the tiebreaker.
+        """
+        ordering = None
+        for backend in getattr(view, 'filter_backends', []):
+            if issubclass(backend, OrderingFilter):
+                ordering = backend().get_ordering(request, queryset, view)
+                break
+
+        terms = [term for term in (ordering or []) if term.lstrip('-') != self.tiebreaker]
+        term = terms[0] if terms else self.ordering
+        return term.lstrip('-'), term.startswith('-')
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def encode_cursor(self, instance, reverse):
+        position = [
+            str(getattr(instance, self.field_name)),
+            str(getattr(instance, self.tiebreaker)),
+        ]
+        payload = {'p': position}
+        if reverse:
+            payload['r'] = 1
+        cursor = base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.page_size_query_param, self.page_size)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            value, pk = payload['p']
+            position = (self.to_python(self.field_name, value), self.to_python(self.tiebreaker, pk))
+        except (TypeError, ValueError, KeyError, binascii.Error, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return position, bool(payload.get('r'))
+
+    def to_python(self, field_name, value):
+        annotation = self.queryset.query.annotations.get(field_name)
+        if annotation is not None:
+            return annotation.output_field.to_python(value)
+        try:
+            field = self.queryset.model._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            return value
+        return field.to_python(value)
+
+
+class PropertyCursorPagination(KeysetPagination):
+    ordering = '-date_posted'
+
+    def get_page_size(self, request):
+        # read per request, not at import, so the setting can be changed per environment
+        self.page_size = getattr(settings, 'PROPERTY_PAGE_SIZE', 20)
+        return super().get_page_size(request)
+
+    def get_ordering(self, request, queryset, view):
+        # ranked search results stay in relevance order unless the client picked one
+        if 'search_rank' in queryset.query.annotations and not request.query_params.get('ordering'):
+            return 'search_rank', True
+        return super().get_ordering(request, queryset, view)
+
+
+class InboxPagination(KeysetPagination):
+    page_size = 30
+    ordering = '-last_activity'
+
+    def get_ordering(self, request, queryset, view):
+        # the inbox is always most recent first
+        return 'last_activity', True
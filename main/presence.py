@@ -0,0 +1,176 @@
+"""
+Who has a chat socket open right now.
+
+Every ChatConsumer connection registers its channel name under its user
+with an expiry PRESENCE_TTL seconds ahead. Clients renew it by sending
+{"type": "heartbeat"} (any chat frame counts too), and disconnecting
+removes it. A user is online while at least one connection has not
+expired, so a socket that died without a close frame (or a crashed daphne)
+drops out on its own within PRESENCE_TTL. Clients that never heartbeat
+look offline after PRESENCE_TTL and simply keep getting pushes and emails.
+
+Connections live in a Redis sorted set per user (score = expiry) when the
+default cache is django_redis, otherwise in sharded in-process dicts.
+Consumers' updates are written in batches: whatever arrives while one
+batch is being written goes out with the next, as one Redis pipeline.
+"""
+import asyncio
+import threading
+import time
+from collections import defaultdict
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+
+def _ttl():
+    return getattr(settings, 'PRESENCE_TTL', 60)
+
+
+class RedisPresence:
+    prefix = 'presence:'
+
+    def __init__(self):
+        from django_redis import get_redis_connection
+        self.redis = get_redis_connection('default')
+
+    def apply(self, changes):
+        """changes: (user_id, channel_name, connected) in order."""
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id, channel_name, connected in changes:
+            key = f'{self.prefix}{user_id}'
+            if connected:
+                pipe.zadd(key, {channel_name: now + _ttl()})
+                # connections of a crashed process are dropped on the next touch
+                pipe.zremrangebyscore(key, '-inf', now)
+                pipe.expire(key, _ttl())
+            else:
+                pipe.zrem(key, channel_name)
+        pipe.execute()
+
+    def touch(self, user_id, channel_name):
+        self.apply([(user_id, channel_name, True)])
+
+    def remove(self, user_id, channel_name):
+        self.apply([(user_id, channel_name, False)])
+
+    def online(self, user_ids):
+        user_ids, now = list(user_ids), time.time()
+        pipe = self.redis.pipeline()
+        for user_id in user_ids:
+            pipe.zcount(f'{self.prefix}{user_id}', now, '+inf')
+        return {user_id for user_id, count in zip(user_ids, pipe.execute()) if count}
+
+
+class LocalPresence:
+    shards = 16
+
+    def __init__(self):
+        self.locks = [threading.Lock() for _ in range(self.shards)]
+        self.connections = [defaultdict(dict) for _ in range(self.shards)]
+
+    def _shard(self, user_id):
+        return hash(str(user_id)) % self.shards
+
+    def touch(self, user_id, channel_name):
+        shard = self._shard(user_id)
+        with self.locks[shard]:
+            self.connections[shard][str(user_id)][channel_name] = time.time() + _ttl()
+
+    def remove(self, user_id, channel_name):
+        shard = self._shard(user_id)
+        with self.locks[shard]:
+            channels = self.connections[shard].get(str(user_id), {})
+            channels.pop(channel_name, None)
+            if not channels:
+                self.connections[shard].pop(str(user_id), None)
+
+    def apply(self, changes):
+        for user_id, channel_name, connected in changes:
+            (self.touch if connected else self.remove)(user_id, channel_name)
+
+    def online(self, user_ids):
+        now, online = time.time(), set()
+        for user_id in user_ids:
+            shard = self._shard(user_id)
+            with self.locks[shard]:
+                if any(expires > now for expires in self.connections[shard].get(str(user_id), {}).values()):
+                    online.add(user_id)
+        return online
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                backend = settings.CACHES['default']['BACKEND']
+                _registry = RedisPresence() if backend.startswith('django_redis') else LocalPresence()
+    return _registry
+
+
+def reset():
+    """Forget every connection (tests)."""
+    global _registry
+    _registry = None
+
+
+def online(user_ids):
+    """The subset of `user_ids` with a live chat socket."""
+    return get_registry().online(user_ids)
+
+
+def is_online(user_id):
+    return bool(online([user_id]))
+
+
+class Writer:
+    """Batches the consumers' changes and applies them off the event loop."""
+
+    def __init__(self):
+        self._pending = {}  # loop -> {change: future}
+        self._running = {}  # loop -> task draining it
+
+    async def submit(self, change):
+        loop = asyncio.get_running_loop()
+        pending = self._pending.setdefault(loop, {})
+        future = pending.get(change)
+        if future is None:
+            future = pending[change] = loop.create_future()
+        if loop not in self._running:
+            self._running[loop] = loop.create_task(self._drain(loop))
+        await asyncio.shield(future)
+
+    async def _drain(self, loop):
+        try:
+            while self._pending.get(loop):
+                batch = self._pending.pop(loop)
+                try:
+                    await sync_to_async(get_registry().apply, thread_sensitive=False)(list(batch))
+                except Exception as exc:
+                    for future in batch.values():
+                        future.set_exception(exc)
+                    continue
+                for future in batch.values():
+                    future.set_result(None)
+        finally:
+            self._running.pop(loop, None)
+            self._pending.pop(loop, None)
+
+
+writer = Writer()
+
+
+async def connected(user_id, channel_name):
+    await writer.submit((user_id, channel_name, True))
+
+
+heartbeat = connected
+
+
+async def disconnected(user_id, channel_name):
+    await writer.submit((user_id, channel_name, False))
@@ -4,7 +4,9 @@ from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.core import signing
 from . import models
+from .images import create_image
 from datetime import timedelta
 from django.contrib.auth import get_user_model
 
@@ -19,10 +21,31 @@ class PropertyFeatureSerializer(serializers.ModelSerializer):
 
 
 class PropertyImageSerializer(serializers.ModelSerializer):
+    renditions = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
+
     class Meta:
         model = models.PropertyImage
-        fields = ['id', 'property', 'images', 'created_at']
-        read_only_fields = ['id', 'property', 'created_at']
+        fields = ['id', 'property', 'images', 'status', 'width', 'height', 'placeholder', 'renditions', 'srcset', 'created_at']
+        read_only_fields = ['id', 'property', 'status', 'width', 'height', 'placeholder', 'created_at']
+
+    def rendition_url(self, name):
+        url = models.PropertyImage._meta.get_field('images').storage.url(name)
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+    def get_renditions(self, obj):
+        return [
+            {'width': r['width'], 'height': r['height'], 'format': r['format'], 'url': self.rendition_url(r['name'])}
+            for r in obj.renditions
+        ]
+
+    def get_srcset(self, obj):
+        # ready to drop into <img srcset> / <source srcset>, one entry per format
+        srcset = {}
+        for r in obj.renditions:
+            srcset.setdefault(r['format'], []).append(f"{self.rendition_url(r['name'])} {r['width']}w")
+        return {fmt: ', '.join(entries) for fmt, entries in srcset.items()}
 
     def create(self, validated_data):
         property_id = self.context.get('property_id')
@@ -30,7 +53,36 @@ class PropertyImageSerializer(serializers.ModelSerializer):
         if not property_id:
             raise serializers.ValidationError({'detail': 'Missing property_id in context.'})
 
-        return models.PropertyImage.objects.create(property_id=property_id, **validated_data)
+        # stored as uploaded; renditions are made off the request
+        return create_image(property_id, validated_data['images'])
+
+
+DIRECT_UPLOAD_SALT = 'main.direct-upload'
+DIRECT_UPLOAD_TYPES = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/webp': '.webp'}
+
+
+class DirectUploadSerializer(serializers.Serializer):
+    content_type = serializers.ChoiceField(choices=list(DIRECT_UPLOAD_TYPES))
+    size = serializers.IntegerField(min_value=1)
+
+    def validate_size(self, value):
+        if value > settings.DIRECT_UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(f'Images can be at most {settings.DIRECT_UPLOAD_MAX_SIZE} bytes.')
+        return value
+
+
+class RegisterUploadSerializer(serializers.Serializer):
+    upload_token = serializers.CharField()
+
+    def validate_upload_token(self, value):
+        try:
+            # an upload started just before the URL expired may still be running
+            upload = signing.loads(value, salt=DIRECT_UPLOAD_SALT, max_age=settings.DIRECT_UPLOAD_EXPIRY + 3600)
+        except signing.BadSignature:
+            raise serializers.ValidationError('Invalid or expired upload token.')
+        if upload['property'] != str(self.context['property_id']):
+            raise serializers.ValidationError('This upload belongs to another property.')
+        return upload
 
 
 class PropertyReviewSerializer(serializers.ModelSerializer):
@@ -78,17 +130,18 @@ class PropertySerializer(serializers.ModelSerializer):
                   'price', 'number_of_bedrooms', 
                   'number_of_bathrooms', 'property_type',
                   'features', 'images', 'city', 'detailed_address',
-                  'status', 'is_verified', 'is_featured', 'visit_count', 'condition',
+                  'status', 'is_verified', 'is_featured', 'visit_count', 'unique_visitors', 'condition',
                     'is_promoted', 'is_recommended', 'expiry_date', 
                     'slug', 'date_posted', 'reviews',
                     'square_meters', 'parking_spaces', 'has_garage', 'wheelchair_access',
                     'elevator', 'secure_parking', 'floor_number', 'year_built']
         
-        read_only_fields = ['id', 'creator', 'is_verified', 'is_featured', 'date_posted']
+        read_only_fields = ['id', 'creator', 'is_verified', 'is_featured', 'date_posted', 'unique_visitors']
 
     def to_representation(self, instance):
         rep = super().to_representation(instance)
-        rep['features'] = list(instance.features.all().values('id', 'name'))
+        # iterate .all() rather than .values() so prefetched features are reused
+        rep['features'] = [{'id': f.id, 'name': f.name} for f in instance.features.all()]
         rep['city'] = CitySerializer(instance.city).data if instance.city else None
         return rep
 
@@ -144,6 +197,39 @@ class MessageSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'sender', 'timestamp', 'sender_username', 'recipient_username']
 
 
+class ConversationSerializer(serializers.ModelSerializer):
+    """A conversation as seen by the requesting user (context['user_id'])."""
+    user = serializers.SerializerMethodField()
+    username = serializers.SerializerMethodField()
+    unread = serializers.SerializerMethodField()
+    last_message = serializers.SerializerMethodField()
+
+    class Meta:
+        model = models.Conversation
+        fields = ['id', 'user', 'username', 'unread', 'last_activity', 'last_message']
+
+    def get_user(self, obj):
+        return obj.other_user(self.context['user_id']).pk
+
+    def get_username(self, obj):
+        return obj.other_user(self.context['user_id']).username
+
+    def get_unread(self, obj):
+        return obj.unread_for(self.context['user_id'])
+
+    def get_last_message(self, obj):
+        message = obj.last_message
+        if message is None:
+            return None
+        return {
+            'id': str(message.id),
+            'sender': message.sender_id,
+            'content': message.content,
+            'timestamp': message.timestamp,
+            'is_read': message.is_read,
+        }
+
+
 
 
 class NotificationSerializer(serializers.ModelSerializer):
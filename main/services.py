@@ -0,0 +1,82 @@
+"""
+Operations that change many rows at once. They bypass the per-instance
+signals in main/signals.py, so each one does that work itself in bulk.
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from . import badges, caching, outbox
+from .expo_utils import push_event
+from .models import Notification, OutboxEvent, Property
+
+
+NOTIFICATION_PUSH_TEXT = {
+    Notification.NOTIF_VERIFIED: ("Your property was verified ✅", "Congratulations—one of your listings just got verified!"),
+    Notification.NOTIF_FAVORITE: ("Someone favorited your property ❤️", "A user just added one of your listings to their favorites."),
+}
+
+
+def notification_push_event(notification):
+    title, body = NOTIFICATION_PUSH_TEXT.get(notification.notif_type, ("You have a new notification", ""))
+    return push_event(
+        notification.user_id, title, body,
+        data={'notifId': str(notification.id)},
+        dedupe_key=f'notification:{notification.id}:push',
+    )
+
+
+def verified_websocket_event(notification, prop):
+    data = {
+        'id': str(notification.id),
+        'user': notification.user_id,
+        'notif_type': notification.notif_type,
+        'object_id': str(notification.object_id),
+        'object_data': {'title': prop.title, 'slug': prop.slug},
+        'timestamp': notification.timestamp.isoformat(),
+        'is_read': notification.is_read,
+    }
+    return outbox.make_event(
+        OutboxEvent.CHANNEL_WEBSOCKET,
+        {'group': f'notifications_{notification.user_id}', 'message': {'type': 'notify', 'data': data}},
+        f'notification:{notification.id}:websocket',
+    )
+
+
+def verify_properties(queryset):
+    """
+    Verify every unverified listing in `queryset`: one UPDATE, one INSERT for
+    the owners' notifications and batched INSERTs for their websocket and
+    push events. Returns the number of listings verified.
+    """
+    with transaction.atomic():
+        # lock the rows so a concurrent verification cannot notify twice
+        props = list(
+            queryset.filter(is_verified=False)
+            .select_for_update(of=('self',))
+            .only('id', 'creator_id', 'title', 'slug')
+        )
+        if not props:
+            return 0
+
+        Property.objects.filter(pk__in=[prop.pk for prop in props]).update(is_verified=True)
+
+        content_type = ContentType.objects.get_for_model(Property)
+        notifications = Notification.objects.bulk_create([
+            Notification(
+                user_id=prop.creator_id,
+                content_type=content_type,
+                object_id=prop.id,
+                notif_type=Notification.NOTIF_VERIFIED,
+            )
+            for prop in props
+        ])
+
+        events = []
+        for notification, prop in zip(notifications, props):
+            events.append(verified_websocket_event(notification, prop))
+            events.append(notification_push_event(notification))
+        outbox.emit_many(events)
+        badges.notifications_created(notifications)
+
+        # queryset.update() sends no post_save, so the cache has to be told
+        caching.invalidate(caching.PROPERTIES)
+    return len(props)
@@ -1,54 +1,55 @@
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.conf import settings
-from django.core.mail import send_mail
 from django.contrib.contenttypes.models import ContentType
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from .models import Message, PushToken
-from .expo_utils import send_expo_push
 
-from .models import Property, Notification, ListingPayment
+from .models import Property, Notification, ListingPayment, OutboxEvent
+from . import models
+from . import badges, blobs, caching, conversations, deferred, delivery, outbox, services
+from .middleware import user_cache
 
-channel_layer = get_channel_layer()
 
-@receiver(pre_save, sender=Property)
-def cache_old_verification(sender, instance, **kwargs):
-    # stash the old is_verified for comparison in post_save
-    if instance.pk:
-        try:
-            old = Property.objects.get(pk=instance.pk)
-            instance._old_is_verified = old.is_verified
-        except Property.DoesNotExist:
-            instance._old_is_verified = False
+# ——— anonymous response cache invalidation ———
+CACHE_DEPENDENCIES = {
+    models.Property: [caching.PROPERTIES],
+    models.PropertyImage: [caching.PROPERTIES],
+    models.PropertyReview: [caching.PROPERTIES],
+    models.PropertyFeature: [caching.PROPERTIES],
+    models.City: [caching.CITIES, caching.PROPERTIES],
+    models.Region: [caching.REGIONS, caching.CITIES, caching.PROPERTIES],
+    models.SubscriptionPlan: [caching.SUBSCRIPTION_PLANS],
+    models.Perk: [caching.SUBSCRIPTION_PLANS],
+    models.Property.features.through: [caching.PROPERTIES],
+    models.SubscriptionPlan.perks.through: [caching.SUBSCRIPTION_PLANS],
+}
+
+
+def invalidate_cached_responses(sender, **kwargs):
+    if kwargs.get('action', 'post_').startswith('post_'):
+        caching.invalidate(*CACHE_DEPENDENCIES[sender])
+
+
+for _model in CACHE_DEPENDENCIES:
+    if _model._meta.auto_created:
+        m2m_changed.connect(invalidate_cached_responses, sender=_model, dispatch_uid=f'cache-m2m-{_model.__name__}')
     else:
-        instance._old_is_verified = False
+        post_save.connect(invalidate_cached_responses, sender=_model, dispatch_uid=f'cache-save-{_model.__name__}')
+        post_delete.connect(invalidate_cached_responses, sender=_model, dispatch_uid=f'cache-delete-{_model.__name__}')
 
 @receiver(post_save, sender=Property)
-def property_verified(sender, instance, created, **kwargs):
+def property_verified(sender, instance, created, update_fields=None, **kwargs):
     # if not newly created, and was False → now True, send notification
-    if not created and not getattr(instance, '_old_is_verified', False) and instance.is_verified:
+    if not created and instance.tracked_field_changed('is_verified', update_fields) and instance.is_verified:
         notif = Notification.objects.create(
-            user=instance.creator,
+            user_id=instance.creator_id,
             content_type=ContentType.objects.get_for_model(instance),
             object_id=instance.id,
             notif_type=Notification.NOTIF_VERIFIED
         )
-        data = {
-            'id': str(notif.id),
-            'user': notif.user.id,
-            'notif_type': notif.notif_type,
-            'object_id': str(notif.object_id),
-            'object_data': {'title': instance.title, 'slug': instance.slug},
-            'timestamp': notif.timestamp.isoformat(),
-            'is_read': notif.is_read,
-        }
-        async_to_sync(channel_layer.group_send)(
-            f'notifications_{instance.creator.id}',
-            {'type': 'notify', 'data': data}
-        )
+        outbox.emit_many([services.verified_websocket_event(notif, instance)])
 
 
 # main/signals.py
@@ -56,40 +57,33 @@ def property_verified(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=Message)
 def send_message_push_and_email(sender, instance: Message, created, **kwargs):
-    if not created:
-        return
+    if created:
+        delivery.message_created(instance)
 
-    # ——— 1) Send Expo push ———
-    tokens = list(PushToken.objects.filter(user=instance.recipient)
-                                  .values_list('token', flat=True))
-    title = f"New message from {instance.sender.username}"
-    body  = instance.content[:100]
-    for t in tokens:
-        try:
-            send_expo_push(t, title, body, data={'chatId': str(instance.id)})
-        except Exception as exc:
-            # you might want to log this instead of print
-            print(f"[ERROR] send_expo_push failed for {t}: {exc}")
-
-    # ——— 2) Send email ———
-    recipient_email = instance.recipient.email
-    if recipient_email:
-        subject = title
-        message = (
-            f"You have a new message from {instance.sender.username}:\n\n"
-            f"{instance.content}\n\n"
-            f"View it in the app to reply."
-        )
-        try:
-            send_mail(
-                subject,
-                message,
-                settings.DEFAULT_FROM_EMAIL,
-                [recipient_email],
-                fail_silently=False,
-            )
-        except Exception as exc:
-            print(f"[ERROR] send_mail failed for {recipient_email}: {exc}")
+
+@receiver(post_save, sender=Message)
+def update_conversation(sender, instance: Message, created, **kwargs):
+    if created:
+        conversations.record([instance])
+    else:
+        conversations.rebuild([(instance.sender_id, instance.recipient_id)])
+
+
+@receiver(post_delete, sender=Message)
+def rebuild_conversation(sender, instance: Message, **kwargs):
+    # after commit: when a user is deleted, their conversations go in the
+    # same transaction and must not be written back. All of a deleted
+    # user's messages come through here; their pairs are rebuilt at once.
+    pair = conversations.pair(instance.sender_id, instance.recipient_id)
+    deferred.collect('conversations.rebuild', [pair], conversations.rebuild)
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def recount_message_badges(sender, instance: Message, created=False, **kwargs):
+    # new messages are counted by delivery.messages_created
+    if not created:
+        badges.recount([instance.sender_id, instance.recipient_id])
 
 
 
@@ -98,49 +92,39 @@ def send_notification_push(sender, instance: Notification, created, **kwargs):
     if not created:
         return
 
-    print(f"[DEBUG] post_save for Notification {instance.id} (type={instance.notif_type}) to {instance.user}")
-    tokens = list(
-        PushToken.objects.filter(user=instance.user).values_list('token', flat=True)
-    )
-    print(f"[DEBUG] Found tokens: {tokens}")
-
-    # Craft a human‑friendly title/body for your notif_type
-    if instance.notif_type == Notification.NOTIF_VERIFIED:
-        title = "Your property was verified ✅"
-        body  = "Congratulations—one of your listings just got verified!"
-    elif instance.notif_type == Notification.NOTIF_FAVORITE:
-        title = "Someone favorited your property ❤️"
-        body  = "A user just added one of your listings to their favorites."
-    else:
-        title = "You have a new notification"
-        body  = ""
+    outbox.emit_many([services.notification_push_event(instance)])
+    badges.notifications_created([instance])
 
-    for t in tokens:
-        try:
-            print(f"[DEBUG] Sending push to {t} …")
-            result = send_expo_push(t, title, body, data={'notifId': str(instance.id)})
-            print(f"[DEBUG] Expo response: {result}")
-        except Exception as exc:
-            print(f"[ERROR] send_expo_push failed for {t}: {exc}")
 
+@receiver(post_save, sender=Notification)
+@receiver(post_delete, sender=Notification)
+def recount_notification_badges(sender, instance: Notification, created=False, **kwargs):
+    if not created:
+        badges.recount([instance.user_id])
+
+
+@receiver([post_save, post_delete], sender=models.CompleteUser)
+def forget_websocket_user(sender, instance, **kwargs):
+    user_cache.invalidate(instance.pk)
+
+
+@receiver(post_delete, sender=models.CompleteUser)
+def forget_badges(sender, instance, **kwargs):
+    badges.forget(instance.pk)
+
+
+@receiver(post_delete, sender=models.PropertyImage)
+def release_image_files(sender, instance, **kwargs):
+    # also runs for every image of a deleted property
+    blobs.release(blobs.references(instance))
 
 
 
 
 
-@receiver(pre_save, sender=ListingPayment)
-def _capture_old_status(sender, instance, **kwargs):
-    """
-    Before saving, stash the old status on the instance so we can compare in post_save.
-    """
-    if not instance.pk:
-        instance._old_status = None
-    else:
-        old = sender.objects.get(pk=instance.pk)
-        instance._old_status = old.status
 
 @receiver(post_save, sender=ListingPayment)
-def _notify_admin_on_success(sender, instance, created, **kwargs):
+def _notify_admin_on_success(sender, instance, created, update_fields=None, **kwargs):
     """
     After saving, if status just turned to 'success', send an email to the admin.
     """
@@ -148,7 +132,7 @@ def _notify_admin_on_success(sender, instance, created, **kwargs):
     became_success = (
         (created and instance.status == 'success')
         or
-        (not created and instance.status == 'success' and instance._old_status != 'success')
+        (not created and instance.status == 'success' and instance.tracked_field_changed('status', update_fields))
     )
     if not became_success:
         return
@@ -167,10 +151,8 @@ def _notify_admin_on_success(sender, instance, created, **kwargs):
 
         admin_email = settings.DEFAULT_FROM_EMAIL
 
-    send_mail(
-        subject,
-        message,
-        settings.DEFAULT_FROM_EMAIL,
-        [admin_email],
-        fail_silently=False,
+    outbox.emit(
+        OutboxEvent.CHANNEL_EMAIL,
+        {'subject': subject, 'body': message, 'to': [admin_email]},
+        f'listing-payment:{instance.pk}:success',
     )
\ No newline at end of file
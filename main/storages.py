@@ -1,10 +1,103 @@
 # main/storages.py
-# from storages.backends.s3boto3 import S3Boto3Storage
+import hashlib
+import posixpath
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from storages.backends.s3boto3 import S3Boto3Storage
+from storages.utils import clean_name
 
-# class StaticStorage(S3Boto3Storage):
-#     location = "static"
-#     default_acl = "public-read"
 
-# class MediaStorage(S3Boto3Storage):
-#     location = "media"
-#     default_acl = "public-read"
+class BucketStorage(S3Boto3Storage):
+
+    @property
+    def client(self):
+        # boto3 clients, unlike resources, can be shared between threads
+        return self.bucket.meta.client
+
+    def key(self, name):
+        return self._normalize_name(clean_name(name))
+
+
+class StaticStorage(BucketStorage):
+    location = "static"
+    default_acl = "public-read"
+
+
+class MediaStorage(BucketStorage):
+    location = "media"
+    file_overwrite = False
+
+    def presigned_put(self, name, content_type, size, expires_in):
+        """
+        A URL the client can PUT exactly `size` bytes of `content_type` to,
+        stored as `name`. Both headers are signed, so S3 rejects anything else.
+        """
+        return self.client.generate_presigned_url(
+            'put_object',
+            Params={
+                'Bucket': self.bucket_name,
+                'Key': self.key(name),
+                'ContentType': content_type,
+                'ContentLength': size,
+            },
+            ExpiresIn=expires_in,
+        )
+
+    def head(self, name):
+        """(size, content type) of a stored object, or None if there is none."""
+        try:
+            obj = self.client.head_object(Bucket=self.bucket_name, Key=self.key(name))
+        except ClientError as exc:
+            if exc.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return obj['ContentLength'], obj.get('ContentType', '')
+
+
+def content_digest(content):
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+class ContentAddressedMixin:
+    """
+    Stores every file under the SHA-256 of its bytes, e.g.
+    restate_ads/3f/3fa9...c1.jpg, so identical files are written once and
+    shared. Nothing is ever overwritten with different bytes; deleting is
+    left to the reference counting in main/blobs.py.
+    """
+
+    def save(self, name, content, max_length=None):
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        digest = content_digest(content)
+        extension = posixpath.splitext(name)[1].lower()
+        name = posixpath.join(posixpath.dirname(name), digest[:2], digest + extension)
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length)
+
+
+class ContentAddressedStorage(ContentAddressedMixin, FileSystemStorage):
+
+    def __init__(self, **kwargs):
+        # two uploads of the same bytes may race to write the same name
+        kwargs.setdefault('allow_overwrite', True)
+        super().__init__(**kwargs)
+
+
+class ContentAddressedS3Storage(ContentAddressedMixin, MediaStorage):
+    file_overwrite = True
+    # a name always holds the same bytes
+    object_parameters = {'CacheControl': 'public, max-age=31536000, immutable'}
+
+
+def property_image_storage():
+    if settings.USE_S3:
+        return ContentAddressedS3Storage()
+    return ContentAddressedStorage()
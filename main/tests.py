@@ -1,3 +1,1818 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import requests
+from datetime import timedelta
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock, skipUnless
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.core import mail, signing
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from redis.exceptions import ConnectionError as RedisConnectionError
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+    import moto
+except ImportError:
+    moto = None
+from . import badges, blobs, caching, chat, conversations, delivery, expo_utils, images, models, outbox, presence, routing, services, storages, views, visits
+from .middleware import JwtAuthMiddleware, user_cache
 
-# Create your tests here.
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    VISIT_FLUSH_INTERVAL=0,
+)
+class MainTestCase(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        visits.get_buffer().drain()
+        presence.reset()
+        badges.reset()
+
+
+class PropertyFixturesMixin:
+
+    def make_user(self, username='owner', **kwargs):
+        return models.CompleteUser.objects.create_user(username=username, password='pass', **kwargs)
+
+    def make_city(self):
+        region = models.Region.objects.create(name='Greater Accra')
+        return models.City.objects.create(region=region, city='Accra')
+
+    def make_property(self, creator, city, **kwargs):
+        data = {
+            'title': 'Two bedroom apartment',
+            'description': 'Close to the mall',
+            'price': 1500,
+            'is_verified': True,
+        }
+        data.update(kwargs)
+        return models.Property.objects.create(creator=creator, city=city, **data)
+
+
+class PropertyQueryPlanTests(PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.owner = self.make_user()
+        self.reviewer = self.make_user('reviewer')
+        self.city = self.make_city()
+        self.features = [
+            models.PropertyFeature.objects.create(name='Borehole'),
+            models.PropertyFeature.objects.create(name='Wardrobe'),
+        ]
+
+    def add_listings(self, count):
+        start = models.Property.objects.count()
+        for i in range(start, start + count):
+            prop = self.make_property(self.owner, self.city, title=f'Listing {i}')
+            prop.features.set(self.features)
+            models.PropertyImage.objects.create(property=prop, images=f'restate_ads/{i}.jpg')
+            models.PropertyReview.objects.create(property=prop, author=self.reviewer, review='Nice')
+
+    def count_list_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/main/properties/')
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response
+
+    def test_list_query_count_is_constant(self):
+        self.add_listings(2)
+        small, _ = self.count_list_queries()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_listings(8)
+        large, response = self.count_list_queries()
+
+        self.assertEqual(small, large)
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_list_renders_related_rows(self):
+        self.add_listings(1)
+        _, response = self.count_list_queries()
+        listing = response.data['results'][0]
+
+        self.assertEqual({f['name'] for f in listing['features']}, {'Borehole', 'Wardrobe'})
+        self.assertEqual(listing['city']['region']['name'], 'Greater Accra')
+        self.assertEqual(len(listing['images']), 1)
+        self.assertEqual(len(listing['reviews']), 1)
+
+
+class PropertyPaginationTests(PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        owner = self.make_user()
+        city = self.make_city()
+        # several listings share a price so the id tiebreaker is exercised
+        self.listings = [
+            self.make_property(owner, city, title=f'Listing {i}', price=1000 + (i // 3) * 100)
+            for i in range(7)
+        ]
+
+    def walk(self, url):
+        seen = []
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.data)
+            seen.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+        return seen, pages
+
+    def test_pages_cover_every_listing_once(self):
+        seen, pages = self.walk('/main/properties/?ordering=price&page_size=2')
+
+        self.assertEqual(len(pages), 4)
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(set(seen), {str(p.id) for p in self.listings})
+        prices = [models.Property.objects.get(pk=pk).price for pk in seen]
+        self.assertEqual(prices, sorted(prices))
+
+    def test_previous_link_returns_the_prior_page(self):
+        first = self.client.get('/main/properties/?ordering=-price&page_size=3').data
+        second = self.client.get(first['next']).data
+        back = self.client.get(second['previous']).data
+
+        self.assertIsNone(first['previous'])
+        self.assertEqual(
+            [item['id'] for item in back['results']],
+            [item['id'] for item in first['results']],
+        )
+
+    def test_inserts_do_not_shift_the_next_page(self):
+        first = self.client.get('/main/properties/?page_size=3').data
+        self.make_property(self.listings[0].creator, self.listings[0].city, title='Fresh listing')
+        second = self.client.get(first['next']).data
+
+        ids = {item['id'] for item in first['results']} | {item['id'] for item in second['results']}
+        self.assertEqual(len(ids), 6)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get('/main/properties/?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(PROPERTY_PAGE_SIZE=3)
+    def test_default_page_size_follows_the_setting(self):
+        response = self.client.get('/main/properties/')
+        self.assertEqual(len(response.data['results']), 3)
+        self.assertIn('page_size=3', response.data['next'])
+
+
+class PropertySearchTests(PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        owner = self.make_user()
+        city = self.make_city()
+        self.in_title = self.make_property(owner, city, title='Furnished apartment', description='Quiet area')
+        self.in_description = self.make_property(
+            owner, city, title='Single room', property_type=models.Property.TYPE_SINGLE_ROOM,
+            description='Comes furnished with a wardrobe',
+        )
+        self.in_address = self.make_property(
+            owner, city, title='Chamber and hall', detailed_address='Near Spintex road',
+        )
+
+    def search(self, term, **params):
+        response = self.client.get('/main/properties/', {'search': term, **params})
+        self.assertEqual(response.status_code, 200)
+        return [item['id'] for item in response.data['results']]
+
+    def test_title_matches_rank_above_description_matches(self):
+        self.assertEqual(self.search('furnished'), [str(self.in_title.id), str(self.in_description.id)])
+
+    def test_prefix_matching(self):
+        self.assertEqual(self.search('furn wardr'), [str(self.in_description.id)])
+
+    def test_detailed_address_is_searchable(self):
+        self.assertEqual(self.search('spintex'), [str(self.in_address.id)])
+
+    def test_vector_follows_edits(self):
+        self.in_address.title = 'Renovated duplex'
+        self.in_address.save()
+        self.assertEqual(self.search('duplex'), [str(self.in_address.id)])
+
+    def test_ilike_mode(self):
+        self.assertEqual(self.search('ardrob', search_mode='ilike'), [str(self.in_description.id)])
+
+
+class PropertyFilterTests(PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        owner = self.make_user()
+        city = self.make_city()
+        self.apartment = self.make_property(
+            owner, city, title='Apartment', property_type=models.Property.TYPE_APARTMENT,
+            number_of_bedrooms=2, price=2000, has_garage=True,
+        )
+        self.duplex = self.make_property(
+            owner, city, title='Duplex', property_type=models.Property.TYPE_DUPLEX,
+            number_of_bedrooms=4, price=9000, type=models.Property.TYPE_SALE,
+        )
+        self.serviced = self.make_property(
+            owner, city, title='Serviced', property_type=models.Property.TYPE_SERVICED_APARTMENT,
+            number_of_bedrooms=1, price=4000,
+        )
+
+    def filter(self, **params):
+        response = self.client.get('/main/properties/', params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return {item['id'] for item in response.data['results']}
+
+    def test_property_type_is_exact_and_multi_valued(self):
+        self.assertEqual(self.filter(property_type='apartment'), {str(self.apartment.id)})
+        self.assertEqual(
+            self.filter(property_type='apartment,duplex'),
+            {str(self.apartment.id), str(self.duplex.id)},
+        )
+
+    def test_unknown_choice_is_rejected(self):
+        response = self.client.get('/main/properties/', {'type': 'rent'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_ranges(self):
+        self.assertEqual(self.filter(price_min=3000, price_max=9000), {str(self.duplex.id), str(self.serviced.id)})
+        self.assertEqual(self.filter(bedrooms_min=2, bedrooms_max=3), {str(self.apartment.id)})
+
+    def test_amenity_flags(self):
+        self.assertEqual(self.filter(has_garage='true'), {str(self.apartment.id)})
+
+    def test_combined_filters(self):
+        self.assertEqual(self.filter(type='rental,sale', property_type='duplex', price_max=10000), {str(self.duplex.id)})
+
+
+class ResponseCacheTests(PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.owner = self.make_user()
+        self.city = self.make_city()
+        self.listing = self.make_property(self.owner, self.city)
+
+    def test_anonymous_list_is_served_from_cache(self):
+        self.client.get('/main/properties/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/main/properties/')
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_query_params_are_normalised(self):
+        self.client.get('/main/properties/?type=rental&ordering=price')
+        with self.assertNumQueries(0):
+            self.client.get('/main/properties/?ordering=price&type=rental')
+
+    def test_saving_a_listing_invalidates(self):
+        self.client.get('/main/properties/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.listing.title = 'Renamed'
+            self.listing.save()
+        response = self.client.get('/main/properties/')
+        self.assertEqual(response.data['results'][0]['title'], 'Renamed')
+
+    def test_region_rename_invalidates_cities(self):
+        self.client.get('/main/cities/')
+        with self.captureOnCommitCallbacks(execute=True):
+            region = self.city.region
+            region.name = 'Ashanti'
+            region.save()
+        response = self.client.get('/main/cities/')
+        self.assertEqual(response.data[0]['region']['name'], 'Ashanti')
+
+    def test_timeout_is_capped_by_first_expiry(self):
+        self.listing.expiry_date = timezone.now() + timedelta(seconds=30)
+        self.listing.save()
+        data = self.client.get('/main/properties/').data
+        timeout = views.PropertyViewSet().get_cache_timeout(data)
+        self.assertLessEqual(timeout, 30)
+        self.assertGreater(timeout, 0)
+        self.assertEqual(caching.stats()[caching.PROPERTIES], {'hits': 0, 'misses': 1})
+
+    def test_authenticated_requests_bypass_cache(self):
+        self.client.force_authenticate(self.owner)
+        self.client.get('/main/properties/')
+        with self.assertNumQueries(4):
+            self.client.get('/main/properties/')
+
+
+class VisitCounterTests(PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        owner = self.make_user()
+        city = self.make_city()
+        self.listing = self.make_property(owner, city, visit_count=10)
+        self.other = self.make_property(owner, city, title='Other listing')
+        self.client.force_authenticate(self.make_user('visitor'))
+
+    def visit(self, prop):
+        response = self.client.post(f'/main/properties/{prop.pk}/visit/')
+        self.assertEqual(response.status_code, 200)
+        return response.data['visit_count']
+
+    def visit_as(self, prop, username):
+        self.client.force_authenticate(models.CompleteUser.objects.get_or_create(username=username)[0])
+        return self.visit(prop)
+
+    def test_visit_does_not_write_the_row(self):
+        self.visit_as(self.listing, 'first')
+        self.client.force_authenticate(self.make_user('second'))
+        with self.assertNumQueries(1):
+            count = self.visit(self.listing)
+        self.assertEqual(count, 12)
+        self.listing.refresh_from_db()
+        self.assertEqual(self.listing.visit_count, 10)
+
+    def test_flush_applies_all_pending_visits_in_one_update(self):
+        for name in ('a', 'b', 'c'):
+            self.visit_as(self.listing, name)
+        self.visit_as(self.other, 'a')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(visits.flush_visits(), 4)
+
+        self.listing.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual(self.listing.visit_count, 13)
+        self.assertEqual(self.listing.unique_visitors, 3)
+        self.assertEqual(self.other.visit_count, 1)
+        self.assertEqual(visits.pending_visits(self.listing.pk), 0)
+
+    def test_repeat_visits_on_the_same_day_count_once(self):
+        self.visit(self.listing)
+        self.assertEqual(self.visit(self.listing), 11)
+
+    def test_bots_are_not_counted(self):
+        response = self.client.post(
+            f'/main/properties/{self.listing.pk}/visit/', HTTP_USER_AGENT='Googlebot/2.1 (+http://www.google.com/bot.html)'
+        )
+        self.assertEqual(response.data['visit_count'], 10)
+        self.assertEqual(visits.pending_visits(self.listing.pk), 0)
+
+    def test_daily_series_for_owner_only(self):
+        self.visit_as(self.listing, 'a')
+        self.visit_as(self.listing, 'b')
+
+        response = self.client.get(f'/main/properties/{self.listing.pk}/visit-stats/?days=3')
+        self.assertEqual(response.status_code, 403)
+
+        self.client.force_authenticate(self.listing.creator)
+        response = self.client.get(f'/main/properties/{self.listing.pk}/visit-stats/?days=3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([day['unique_visitors'] for day in response.data['daily']], [0, 0, 2])
+
+    def test_forwarded_for_does_not_make_a_new_visitor(self):
+        ids = set()
+        for forwarded in ('1.1.1.1', '2.2.2.2'):
+            request = RequestFactory().post('/', HTTP_X_FORWARDED_FOR=forwarded, HTTP_FLY_CLIENT_IP='9.9.9.9')
+            request.user = AnonymousUser()
+            ids.add(visits.visitor_id(request))
+        self.assertEqual(len(ids), 1)
+
+    def test_every_distinct_visitor_is_counted(self):
+        for visitor in range(5000):
+            visits.record_visit(self.listing.pk, f'a:{visitor}')
+        visits.record_visit(self.listing.pk, 'a:0')
+        visits.flush_visits()
+
+        self.listing.refresh_from_db()
+        self.assertEqual(self.listing.visit_count, 5010)
+        self.assertAlmostEqual(self.listing.unique_visitors, 5000, delta=500)
+
+    def test_local_visitors_expire_with_the_series(self):
+        buffer = visits.LocalVisitBuffer()
+        buffer.add_visitor(self.listing.pk, 'a', '20260101')
+        buffer.add_visitor(self.listing.pk, 'b', '20260301')
+        self.assertNotIn((str(self.listing.pk), '20260101'), buffer.visitors)
+        self.assertNotIn((str(self.listing.pk), '20260101'), buffer.seen)
+        self.assertEqual(buffer.unique_visitors([self.listing.pk]), {self.listing.pk: 2})
+
+
+class StubExpoServer:
+    """
+    A local stand-in for Expo's push endpoint. Tokens starting with `dead`
+    come back as DeviceNotRegistered; while `fail_next` is positive the
+    server answers `fail_status`.
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.fail_next = 0
+        self.fail_status = 503
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                messages = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if stub.fail_next:
+                    stub.fail_next -= 1
+                    self.send_response(stub.fail_status)
+                    self.end_headers()
+                    return
+                stub.batches.append(messages)
+                tickets = [
+                    {'status': 'error', 'message': 'not registered', 'details': {'error': 'DeviceNotRegistered'}}
+                    if message['to'].startswith('dead') else {'status': 'ok', 'id': 'ticket'}
+                    for message in messages
+                ]
+                body = json.dumps({'data': tickets}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/push/send'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ExpoDeliveryTests(PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user()
+        self.other = self.make_user('other')
+
+    def deliver(self, stub, jobs):
+        with self.settings(EXPO_PUSH_URL=stub.url):
+            return expo_utils.deliver_to_users(jobs, sleep=lambda seconds: None)
+
+    def test_messages_are_sent_in_batches_of_100(self):
+        models.PushToken.objects.bulk_create(
+            models.PushToken(user=self.user, token=f'ExponentPushToken[{i}]') for i in range(150)
+        )
+        with StubExpoServer() as stub:
+            sent, failed = self.deliver(stub, [(self.user.id, 'Hi', 'There', {})])
+
+        self.assertEqual((sent, failed), (150, 0))
+        self.assertEqual([len(batch) for batch in stub.batches], [100, 50])
+
+    def test_unregistered_devices_are_pruned(self):
+        models.PushToken.objects.create(user=self.user, token='alive')
+        models.PushToken.objects.create(user=self.other, token='dead-device')
+        with StubExpoServer() as stub:
+            sent, failed = self.deliver(stub, [(self.user.id, 'a', 'b', {}), (self.other.id, 'a', 'b', {})])
+
+        self.assertEqual((sent, failed), (1, 1))
+        self.assertEqual(len(stub.batches), 1)
+        self.assertEqual(list(models.PushToken.objects.values_list('token', flat=True)), ['alive'])
+
+    def test_server_errors_are_retried(self):
+        models.PushToken.objects.create(user=self.user, token='alive')
+        with StubExpoServer() as stub:
+            stub.fail_next = 2
+            with self.assertLogs('main.expo_utils', 'WARNING'):
+                sent, failed = self.deliver(stub, [(self.user.id, 'a', 'b', {})])
+
+        self.assertEqual((sent, failed), (1, 0))
+
+    def test_gives_up_after_max_attempts(self):
+        models.PushToken.objects.create(user=self.user, token='alive')
+        with StubExpoServer() as stub:
+            stub.fail_next = expo_utils.MAX_ATTEMPTS
+            with self.assertLogs('main.expo_utils', 'WARNING'):
+                sent, failed = self.deliver(stub, [(self.user.id, 'a', 'b', {})])
+
+        self.assertEqual((sent, failed), (0, 1))
+
+    def test_outbox_pushes_are_retried_when_expo_is_down(self):
+        models.PushToken.objects.create(user=self.user, token='alive')
+        outbox.emit_many([expo_utils.push_event(self.user.id, 'a', 'b', dedupe_key='down')])
+        with StubExpoServer() as stub, self.settings(EXPO_PUSH_URL=stub.url), \
+                mock.patch('main.expo_utils._backoff', return_value=0):
+            stub.fail_next = expo_utils.MAX_ATTEMPTS
+            with self.assertLogs('main', 'WARNING'):
+                outbox.process(models.OutboxEvent.CHANNEL_PUSH)
+
+        event = models.OutboxEvent.objects.get()
+        self.assertIsNone(event.delivered_at)
+        self.assertIn('ExpoUnavailable', event.last_error)
+
+    def test_outbox_pushes_rejected_by_expo_are_not_retried(self):
+        models.PushToken.objects.create(user=self.user, token='alive')
+        models.PushToken.objects.create(user=self.other, token='dead-device')
+        outbox.emit_many([
+            expo_utils.push_event(self.user.id, 'a', 'b', dedupe_key='invalid'),
+            expo_utils.push_event(self.other.id, 'a', 'b', dedupe_key='unregistered'),
+        ])
+        with StubExpoServer() as stub, self.settings(EXPO_PUSH_URL=stub.url):
+            stub.fail_next, stub.fail_status = 1, 400
+            with self.assertLogs('main.expo_utils', 'ERROR'):
+                outbox.process(models.OutboxEvent.CHANNEL_PUSH)
+            outbox.emit_many([expo_utils.push_event(self.other.id, 'a', 'b', dedupe_key='unregistered-again')])
+            outbox.process(models.OutboxEvent.CHANNEL_PUSH)
+
+        self.assertFalse(models.OutboxEvent.objects.filter(delivered_at__isnull=True).exists())
+        self.assertEqual(list(models.PushToken.objects.values_list('token', flat=True)), ['alive'])
+
+
+class MessageDeliveryTests(PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sender = self.make_user('sender')
+        self.recipient = self.make_user('recipient', email='recipient@example.com')
+
+    def send(self, content, recipient=None):
+        return models.Message.objects.create(sender=self.sender, recipient=recipient or self.recipient, content=content)
+
+    def queued(self):
+        return sorted(models.OutboxEvent.objects.values_list('channel', flat=True))
+
+    def test_posting_a_message_queues_one_push_and_one_email(self):
+        client = APIClient()
+        client.force_authenticate(self.sender)
+        response = client.post('/main/messages/', {'recipient': self.recipient.id, 'content': 'Is it available?'}, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.queued(), ['message_email', 'message_push'])
+        push = models.OutboxEvent.objects.get(channel='message_push')
+        self.assertEqual(push.payload['recipient_id'], self.recipient.id)
+
+    def test_a_message_is_only_queued_once(self):
+        message = self.send('Hello')
+        delivery.message_created(message)
+        self.assertEqual(self.queued(), ['message_email', 'message_push'])
+
+    def test_online_recipients_only_get_the_message_over_their_socket(self):
+        presence.get_registry().touch(self.recipient.id, 'chat-channel')
+        message = self.send('Hello')
+
+        self.assertEqual(self.queued(), ['websocket'])
+        event = models.OutboxEvent.objects.get()
+        self.assertEqual(event.payload['group'], f'chat_user_{self.recipient.id}')
+        self.assertEqual(event.payload['message']['message']['id'], str(message.pk))
+
+        # ChatConsumer has sent it already
+        models.OutboxEvent.objects.all().delete()
+        delivery.message_created(message, delivered_live=True)
+        self.assertEqual(self.queued(), [])
+
+    def test_pushes_to_an_offline_recipient_are_batched(self):
+        other = self.make_user('other')
+        self.send('First')
+        self.send('Second')
+        models.Message.objects.create(sender=other, recipient=self.recipient, content='Third')
+
+        with mock.patch('main.delivery.deliver_to_users') as deliver:
+            models.OutboxEvent.objects.update(available_at=timezone.now())
+            self.assertEqual(outbox.process(models.OutboxEvent.CHANNEL_MESSAGE_PUSH), 3)
+
+        [(recipient_id, title, body, data)] = deliver.call_args.args[0]
+        self.assertEqual(recipient_id, self.recipient.id)
+        self.assertEqual(title, 'You have 3 new messages')
+        self.assertEqual(body, 'sender, other')
+
+    def test_recipients_who_came_online_are_not_notified(self):
+        message = self.send('Hello')
+        presence.get_registry().touch(self.recipient.id, 'chat-channel')
+
+        with mock.patch('main.delivery.deliver_to_users') as deliver:
+            self.assertEqual(delivery.send_message_pushes([message.pk]), 0)
+        self.assertEqual(list(deliver.call_args.args[0]), [])
+        self.assertEqual(delivery.send_message_emails([message.pk]), 0)
+        self.assertEqual(mail.outbox, [])
+
+    def test_unread_messages_to_one_recipient_are_sent_as_a_digest(self):
+        nobody = self.make_user('nobody')
+        first, second = self.send('First'), self.send('Second')
+        read = self.send('Already seen')
+        no_email = self.send('Hi', recipient=nobody)
+        models.Message.objects.filter(pk=read.pk).update(is_read=True)
+
+        sent = delivery.send_message_emails([first.pk, second.pk, read.pk, no_email.pk])
+
+        self.assertEqual(sent, 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['recipient@example.com'])
+        self.assertEqual(mail.outbox[0].subject, 'You have 2 new messages')
+        self.assertNotIn('Already seen', mail.outbox[0].body)
+
+    @override_settings(MESSAGE_EMAIL_DELAY=60)
+    def test_pending_emails_for_a_recipient_go_out_with_the_first_due_one(self):
+        other = self.make_user('other', email='other@example.com')
+        first, second = self.send('First'), self.send('Second')
+        self.send('Not yet', recipient=other)
+        models.OutboxEvent.objects.filter(dedupe_key=f'message:{first.pk}:email').update(available_at=timezone.now())
+
+        self.assertEqual(outbox.process(models.OutboxEvent.CHANNEL_MESSAGE_EMAIL), 2)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['recipient@example.com'])
+        self.assertIn('Second', mail.outbox[0].body)
+
+
+class ConversationTests(PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.alice = self.make_user('alice')
+        self.bob = self.make_user('bob')
+        self.carol = self.make_user('carol')
+
+    def send(self, sender, recipient, content):
+        return models.Message.objects.create(sender=sender, recipient=recipient, content=content)
+
+    def inbox(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.get('/main/messages/inbox/')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def test_inbox_lists_conversations_most_recent_first(self):
+        self.send(self.bob, self.alice, 'Hi Alice')
+        self.send(self.alice, self.carol, 'Hi Carol')
+        last = self.send(self.bob, self.alice, 'Still there?')
+
+        with self.assertNumQueries(1):
+            inbox = self.inbox(self.alice)
+
+        self.assertEqual([row['username'] for row in inbox], ['bob', 'carol'])
+        self.assertEqual(inbox[0]['user'], self.bob.id)
+        self.assertEqual(inbox[0]['unread'], 2)
+        self.assertEqual(inbox[0]['last_message']['id'], str(last.pk))
+        self.assertEqual(inbox[1]['unread'], 0)
+        self.assertEqual(self.inbox(self.carol)[0]['unread'], 1)
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def test_read_receipt_clears_only_the_readers_count(self):
+        self.send(self.bob, self.alice, 'Hi Alice')
+        self.send(self.alice, self.bob, 'Hi Bob')
+
+        response = self.client_for(self.alice).post('/main/messages/read/', {'user_id': self.bob.id}, format='json')
+
+        self.assertEqual(response.json(), {'marked': 1})
+        conversation = models.Conversation.objects.get()
+        self.assertEqual(conversation.unread_for(self.alice.id), 0)
+        self.assertEqual(conversation.unread_for(self.bob.id), 1)
+        self.assertIsNotNone(conversation.read_low_at if conversation.user_low_id == self.alice.id else conversation.read_high_at)
+
+    def test_read_receipt_stops_at_up_to(self):
+        first = self.send(self.bob, self.alice, 'First')
+        later = self.send(self.bob, self.alice, 'Later')
+        client = self.client_for(self.alice)
+
+        response = client.post('/main/messages/read/', {'user_id': self.bob.id, 'up_to': str(first.pk)}, format='json')
+        self.assertEqual(response.json(), {'marked': 1})
+        self.assertEqual(set(models.Message.objects.filter(is_read=False)), {later})
+
+        # nothing left unread: the receipt does not touch main_message
+        client.post('/main/messages/read/', {'user_id': self.bob.id}, format='json')
+        with self.assertNumQueries(1):
+            self.assertEqual(conversations.mark_read(self.alice.id, self.bob.id), 0)
+
+    def test_read_receipt_only_looks_past_the_previous_one(self):
+        old = self.send(self.bob, self.alice, 'Old')
+        conversations.mark_read(self.alice.id, self.bob.id)
+        models.Message.objects.filter(pk=old.pk).update(
+            is_read=False, timestamp=timezone.now() - 2 * conversations.RECEIPT_SLACK
+        )
+        self.send(self.bob, self.alice, 'New')
+
+        self.assertEqual(conversations.mark_read(self.alice.id, self.bob.id), 1)
+        self.assertFalse(models.Message.objects.get(pk=old.pk).is_read)
+
+    def test_read_receipt_finds_messages_written_long_after_their_timestamp(self):
+        self.send(self.bob, self.alice, 'First')
+        conversations.mark_read(self.alice.id, self.bob.id)
+        # received before the receipt, stored by the chat writer much later
+        late = models.Message(sender=self.bob, recipient=self.alice, content='Late')
+        late.timestamp = timezone.now() - 2 * conversations.RECEIPT_SLACK
+        chat.persist([late])
+
+        self.assertEqual(conversations.mark_read(self.alice.id, self.bob.id), 1)
+        self.assertTrue(models.Message.objects.get(pk=late.pk).is_read)
+        conversation = models.Conversation.objects.get(conversations.pair_filter(self.alice.id, self.bob.id))
+        self.assertEqual(conversation.unread_for(self.alice.id), 0)
+
+    def test_history_is_read_in_windows(self):
+        start = timezone.now()
+        for i in range(7):
+            sender, recipient = (self.alice, self.bob) if i % 2 else (self.bob, self.alice)
+            models.Message.objects.create(
+                sender=sender, recipient=recipient, content=f'm{i}', timestamp=start + timedelta(seconds=i)
+            )
+        self.send(self.carol, self.alice, 'Elsewhere')
+        client = self.client_for(self.alice)
+
+        with self.assertNumQueries(3):
+            latest = client.get(f'/main/messages/?user_id={self.bob.id}&limit=3').json()
+        self.assertEqual([m['content'] for m in latest['messages']], ['m4', 'm5', 'm6'])
+        self.assertTrue(latest['has_more'])
+        self.assertEqual(latest['messages'][0]['sender_username'], 'bob')
+
+        before = latest['messages'][0]['id']
+        older = client.get(f'/main/messages/?user_id={self.bob.id}&limit=3&before={before}').json()
+        self.assertEqual([m['content'] for m in older['messages']], ['m1', 'm2', 'm3'])
+        oldest = client.get(f"/main/messages/?user_id={self.bob.id}&limit=3&before={older['messages'][0]['id']}").json()
+        self.assertEqual(([m['content'] for m in oldest['messages']], oldest['has_more']), (['m0'], False))
+
+        newer = client.get(f'/main/messages/?user_id={self.bob.id}&limit=2&after={before}').json()
+        self.assertEqual(([m['content'] for m in newer['messages']], newer['has_more']), (['m5', 'm6'], False))
+
+        # reading history is not a read receipt
+        conversation = models.Conversation.objects.get(conversations.pair_filter(self.alice.id, self.bob.id))
+        self.assertEqual(conversation.unread_for(self.alice.id), 4)
+
+    def test_history_rejects_bad_cursors(self):
+        client = self.client_for(self.alice)
+        self.assertEqual(client.get(f'/main/messages/?user_id={self.bob.id}&before=nope').status_code, 400)
+        self.assertEqual(client.get(f'/main/messages/?user_id={self.bob.id}&limit=x').status_code, 400)
+
+    def test_deleting_messages_rebuilds_the_conversation(self):
+        first = self.send(self.bob, self.alice, 'First')
+        second = self.send(self.bob, self.alice, 'Second')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        conversation = models.Conversation.objects.get()
+        self.assertEqual((conversation.last_message_id, conversation.unread_for(self.alice.id)), (first.pk, 1))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertFalse(models.Conversation.objects.exists())
+
+    def test_deleting_a_user_rebuilds_their_conversations_once(self):
+        for i in range(5):
+            self.send(self.bob, self.alice, f'To Alice {i}')
+            self.send(self.bob, self.carol, f'To Carol {i}')
+        self.send(self.alice, self.carol, 'Hi Carol')
+        bob_id = self.bob.id
+
+        with mock.patch('main.conversations.rebuild', wraps=conversations.rebuild) as rebuild, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.bob.delete()
+
+        rebuild.assert_called_once()
+        self.assertEqual(
+            sorted(rebuild.call_args.args[0]),
+            sorted([conversations.pair(bob_id, self.alice.id), conversations.pair(bob_id, self.carol.id)]),
+        )
+        conversation = models.Conversation.objects.get()
+        self.assertEqual(conversation.unread_for(self.carol.id), 1)
+
+    def test_rebuild_matches_the_incremental_state(self):
+        self.send(self.bob, self.alice, 'Hi Alice')
+        self.send(self.alice, self.bob, 'Hi Bob')
+        self.send(self.carol, self.alice, 'Hello')
+        conversations.mark_read(self.alice.id, self.bob.id)
+        fields = ('user_low', 'user_high', 'last_message', 'unread_low', 'unread_high', 'last_activity')
+        incremental = sorted(models.Conversation.objects.values_list(*fields))
+
+        models.Conversation.objects.all().delete()
+        self.assertEqual(conversations.rebuild(), 2)
+        self.assertEqual(sorted(models.Conversation.objects.values_list(*fields)), incremental)
+
+
+class OutboxTests(PropertyFixturesMixin, MainTestCase):
+
+    def emit_email(self, key='welcome'):
+        outbox.emit(models.OutboxEvent.CHANNEL_EMAIL, {'subject': 'Hi', 'body': 'Welcome', 'to': ['a@example.com']}, key)
+
+    def test_events_are_discarded_with_their_transaction(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            self.emit_email()
+            raise RuntimeError
+        self.assertFalse(models.OutboxEvent.objects.exists())
+
+    def test_emitting_a_key_twice_queues_one_event(self):
+        self.emit_email()
+        self.emit_email()
+        self.assertEqual(models.OutboxEvent.objects.count(), 1)
+
+    def test_process_delivers_each_event_once(self):
+        self.emit_email()
+
+        self.assertEqual(outbox.process(models.OutboxEvent.CHANNEL_EMAIL), 1)
+        self.assertEqual(outbox.process(models.OutboxEvent.CHANNEL_EMAIL), 0)
+        self.assertEqual(len(mail.outbox), 1)
+        event = models.OutboxEvent.objects.get()
+        self.assertIsNotNone(event.delivered_at)
+        self.assertEqual(event.attempts, 1)
+
+    def test_coalescing_skips_events_leased_to_another_worker(self):
+        def queue(key, delay):
+            outbox.emit(models.OutboxEvent.CHANNEL_MESSAGE_PUSH, {'message_id': key, 'recipient_id': 1}, key, delay)
+
+        queue('first', None)
+        queue('later', timedelta(minutes=5))
+        first = outbox.claim(models.OutboxEvent.CHANNEL_MESSAGE_PUSH)
+        # a new message for the same recipient falls due while `first` is in flight
+        queue('new', None)
+        second = outbox.claim(models.OutboxEvent.CHANNEL_MESSAGE_PUSH)
+
+        self.assertEqual(sorted(event.dedupe_key for event in first), ['first', 'later'])
+        self.assertEqual([event.dedupe_key for event in second], ['new'])
+
+    def test_failed_delivery_is_retried_later(self):
+        self.emit_email()
+
+        def fail(payloads):
+            raise ConnectionError('smtp down')
+
+        with mock.patch.dict(outbox.HANDLERS, {models.OutboxEvent.CHANNEL_EMAIL: fail}), \
+                self.assertLogs('main.outbox', 'ERROR'):
+            outbox.process(models.OutboxEvent.CHANNEL_EMAIL)
+
+        event = models.OutboxEvent.objects.get()
+        self.assertIsNone(event.delivered_at)
+        self.assertIn('smtp down', event.last_error)
+        self.assertGreater(event.available_at, timezone.now())
+        self.assertEqual(outbox.lag_stats()['email']['pending'], 1)
+
+    def test_listing_payment_email_is_queued_not_sent(self):
+        owner = self.make_user()
+        prop = self.make_property(owner, self.make_city())
+        models.ListingPayment.objects.create(user=owner, property=prop, amount=100, status='success', payment_ref='ref-1')
+
+        self.assertEqual(len(mail.outbox), 0)
+        event = models.OutboxEvent.objects.get(channel=models.OutboxEvent.CHANNEL_EMAIL)
+        self.assertIn('ref-1', event.payload['body'])
+
+    def test_verifying_a_property_queues_push_and_websocket_message(self):
+        owner = self.make_user()
+        prop = self.make_property(owner, self.make_city(), is_verified=False)
+        prop.is_verified = True
+        prop.save()
+
+        self.assertEqual(
+            sorted(models.OutboxEvent.objects.values_list('channel', flat=True)),
+            ['push', 'websocket'],
+        )
+
+    def test_drain_once_does_the_housekeeping(self):
+        with mock.patch('main.outbox.process', return_value=0), \
+                mock.patch('main.outbox.purge_delivered') as purge_delivered, \
+                mock.patch('main.blobs.collect_garbage') as collect_garbage:
+            call_command('drain_outbox', '--once', '--stats-interval', '0', stdout=io.StringIO())
+
+        purge_delivered.assert_called_once()
+        collect_garbage.assert_called_once()
+
+
+class VerifyPropertiesTests(PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner = self.make_user()
+        self.city = self.make_city()
+        self.props = [
+            self.make_property(self.owner, self.city, title=f'Listing {i}', is_verified=False) for i in range(5)
+        ]
+
+    def test_verifies_in_a_fixed_number_of_queries(self):
+        ContentType.objects.get_for_model(models.Property)
+        with self.assertNumQueries(6):
+            verified = services.verify_properties(models.Property.objects.all())
+
+        self.assertEqual(verified, 5)
+        self.assertEqual(models.Property.objects.filter(is_verified=True).count(), 5)
+        self.assertEqual(models.Notification.objects.filter(notif_type=models.Notification.NOTIF_VERIFIED).count(), 5)
+        self.assertEqual(models.OutboxEvent.objects.filter(channel='websocket').count(), 5)
+        self.assertEqual(models.OutboxEvent.objects.filter(channel='push').count(), 5)
+
+    def test_already_verified_listings_are_not_notified_again(self):
+        services.verify_properties(models.Property.objects.filter(pk=self.props[0].pk))
+        self.assertEqual(services.verify_properties(models.Property.objects.all()), 4)
+        self.assertEqual(services.verify_properties(models.Property.objects.all()), 0)
+        self.assertEqual(models.Notification.objects.count(), 5)
+
+    def test_admin_action(self):
+        admin_user = models.CompleteUser.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.force_login(admin_user)
+
+        response = self.client.post('/admin/main/property/', {
+            'action': 'mark_verified',
+            '_selected_action': [str(prop.pk) for prop in self.props[:2]],
+        })
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(models.Property.objects.filter(is_verified=True).count(), 2)
+
+
+class TrackedFieldsTests(PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner = self.make_user()
+        self.prop = self.make_property(self.owner, self.make_city(), is_verified=False)
+        ContentType.objects.get_for_model(models.Property)
+
+    def notifications(self):
+        return models.Notification.objects.filter(notif_type=models.Notification.NOTIF_VERIFIED).count()
+
+    def test_unrelated_saves_cost_only_the_update(self):
+        prop = models.Property.objects.get(pk=self.prop.pk)
+        with self.assertNumQueries(1):
+            prop.save(update_fields=['visit_count'])
+        with self.assertNumQueries(1):
+            prop.title = 'Renamed'
+            prop.save()
+
+    def test_verification_is_detected_from_the_loaded_value(self):
+        prop = models.Property.objects.get(pk=self.prop.pk)
+        prop.is_verified = True
+        prop.save()
+        self.assertEqual(self.notifications(), 1)
+
+        # already verified when loaded
+        prop = models.Property.objects.get(pk=self.prop.pk)
+        prop.save()
+        self.assertEqual(self.notifications(), 1)
+
+    def test_snapshot_moves_forward_on_save_and_refresh(self):
+        prop = models.Property.objects.get(pk=self.prop.pk)
+        prop.is_verified = True
+        prop.save(update_fields=['is_verified'])
+        prop.save(update_fields=['is_verified'])
+        self.assertEqual(self.notifications(), 1)
+
+        models.Property.objects.filter(pk=prop.pk).update(is_verified=False)
+        prop.refresh_from_db()
+        prop.is_verified = True
+        prop.save(update_fields=['is_verified'])
+        self.assertEqual(self.notifications(), 2)
+
+    def test_deferred_field_is_not_treated_as_changed(self):
+        prop = models.Property.objects.only('id', 'visit_count').get(pk=self.prop.pk)
+        models.Property.objects.filter(pk=prop.pk).update(is_verified=True)
+        with self.assertNumQueries(1):
+            prop.visit_count = 3
+            prop.save()
+        self.assertEqual(self.notifications(), 0)
+
+    def test_listing_payment_status_change(self):
+        payment = models.ListingPayment.objects.create(user=self.owner, property=self.prop, amount=100, payment_ref='ref-2')
+        payment = models.ListingPayment.objects.get(pk=payment.pk)
+        with self.assertNumQueries(1):
+            payment.save(update_fields=['amount'])
+
+        payment.status = 'success'
+        payment.save(update_fields=['status'])
+        self.assertTrue(models.OutboxEvent.objects.filter(dedupe_key=f'listing-payment:{payment.pk}:success').exists())
+
+
+def make_jpeg(size=(2000, 1500), orientation=None, name='photo.jpg'):
+    exif = Image.Exif()
+    exif[0x0110] = 'Phone'  # model
+    if orientation:
+        exif[0x0112] = orientation
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 120, 40)).save(buffer, 'JPEG', exif=exif)
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+
+class MediaRootMixin:
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+
+@override_settings(IMAGE_WORKERS=0)
+class ImagePipelineTests(MediaRootMixin, PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner = self.make_user()
+        self.prop = self.make_property(self.owner, self.make_city())
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def upload(self, *files):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(f'/main/properties/{self.prop.pk}/add_images/', {'images': list(files)}, format='multipart')
+
+    def test_upload_is_acknowledged_before_rendering(self):
+        response = self.client.post(f'/main/properties/{self.prop.pk}/add_images/', {'images': [make_jpeg()]}, format='multipart')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data[0]['status'], 'processing')
+        self.assertEqual(response.data[0]['renditions'], [])
+        self.assertRegex(response.data[0]['images'], r'/restate_ads/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+
+    def test_upload_is_oriented_stripped_and_rendered(self):
+        # orientation 6: stored sideways, displayed rotated 90 degrees
+        self.upload(make_jpeg(orientation=6))
+
+        image = models.PropertyImage.objects.get()
+        self.assertEqual(image.status, models.PropertyImage.STATUS_READY)
+        self.assertEqual((image.width, image.height), (1500, 2000))
+        # only the raw upload is left unreferenced
+        self.assertEqual(models.ImageBlob.objects.filter(ref_count__lte=0).count(), 1)
+        with Image.open(image.images.path) as original:
+            self.assertEqual(original.size, (1500, 2000))
+            self.assertEqual(len(original.getexif()), 0)
+
+        widths = sorted({r['width'] for r in image.renditions})
+        self.assertEqual(widths, [320, 640, 1280])
+        self.assertEqual({r['format'] for r in image.renditions}, {'webp', 'jpeg'})
+        for rendition in image.renditions:
+            with Image.open(image.images.storage.path(rendition['name'])) as stored:
+                self.assertEqual(stored.width, rendition['width'])
+                self.assertEqual(len(stored.getexif()), 0)
+        self.assertTrue(image.placeholder.startswith('data:image/jpeg;base64,'))
+        self.assertLess(len(image.placeholder), 2000)
+
+    def test_serializer_exposes_renditions(self):
+        self.upload(make_jpeg(size=(800, 600)))
+        data = self.client.get(f'/main/properties/{self.prop.pk}/images/').data[0]
+
+        self.assertEqual([r['width'] for r in data['renditions']], [320, 320, 640, 640])
+        self.assertTrue(data['renditions'][0]['url'].startswith('http://testserver/media/restate_ads/renditions/'))
+        self.assertIn(' 640w', data['srcset']['webp'])
+
+    def test_small_images_get_one_rendition_at_their_own_width(self):
+        self.upload(make_jpeg(size=(200, 100)))
+        image = models.PropertyImage.objects.get()
+        self.assertEqual({r['width'] for r in image.renditions}, {200})
+
+    def test_owner_is_notified_when_renditions_are_ready(self):
+        self.upload(make_jpeg(size=(800, 600)))
+        image = models.PropertyImage.objects.get()
+
+        event = models.OutboxEvent.objects.get(dedupe_key=f'property-image:{image.pk}:ready')
+        self.assertEqual(event.payload['group'], f'notifications_{self.owner.id}')
+        self.assertEqual(event.payload['message']['data']['notif_type'], 'image_ready')
+        self.assertEqual(len(event.payload['message']['data']['image']['renditions']), 4)
+
+    def test_undecodable_upload_is_marked_failed(self):
+        truncated = make_jpeg()
+        truncated.file = io.BytesIO(truncated.read()[:3000])
+        with self.assertLogs('main.images', 'WARNING'):
+            self.upload(truncated)
+
+        image = models.PropertyImage.objects.get()
+        self.assertEqual(image.status, models.PropertyImage.STATUS_FAILED)
+        self.assertTrue(models.OutboxEvent.objects.filter(dedupe_key=f'property-image:{image.pk}:failed').exists())
+        self.assertEqual(list(models.Property.objects.for_listing().get().images.all()), [])
+
+    @override_settings(IMAGE_WORKERS=1)
+    def test_a_broken_pool_is_replaced(self):
+        class InlinePool:
+            def __init__(self, *args, **kwargs):
+                pass
+
+            def submit(self, fn, *args):
+                future = Future()
+                future.set_result(fn(*args))
+                return future
+
+            def shutdown(self, wait=True):
+                pass
+
+        broken = mock.Mock()
+        broken.submit.side_effect = BrokenProcessPool('a worker died')
+        with mock.patch.object(images, '_pool', broken), \
+                mock.patch('main.images.ProcessPoolExecutor', InlinePool), \
+                mock.patch('main.images.close_old_connections'):
+            self.upload(make_jpeg(size=(800, 600)))
+            self.assertIsInstance(images._pool, InlinePool)
+
+        self.assertEqual(models.PropertyImage.objects.get().status, models.PropertyImage.STATUS_READY)
+        broken.shutdown.assert_called_once_with(wait=False)
+
+    def test_images_left_processing_are_requeued(self):
+        self.client.post(f'/main/properties/{self.prop.pk}/add_images/', {'images': [make_jpeg(size=(800, 600))]}, format='multipart')
+
+        call_command('requeue_images', stdout=io.StringIO())
+        image = models.PropertyImage.objects.get()
+        self.assertEqual(image.status, models.PropertyImage.STATUS_READY)
+
+        # a late result from the process that was restarted is dropped
+        images.finish(image.pk, 'late', {'renditions': [{'name': 'restate_ads/renditions/late.webp'}]})
+        image.refresh_from_db()
+        self.assertNotIn('late', str(image.renditions))
+
+    def test_housekeeping_renders_images_stuck_across_two_rounds(self):
+        self.client.post(f'/main/properties/{self.prop.pk}/add_images/', {'images': [make_jpeg(size=(800, 600))]}, format='multipart')
+        image = models.PropertyImage.objects.get()
+
+        # the first round cannot tell a lost image from one being rendered
+        seen = images.requeue_stuck(set())
+        self.assertEqual(seen, {image.pk})
+        image.refresh_from_db()
+        self.assertEqual(image.status, models.PropertyImage.STATUS_PROCESSING)
+
+        with self.assertLogs('main.images', 'WARNING'):
+            self.assertEqual(images.requeue_stuck(seen), set())
+        image.refresh_from_db()
+        self.assertEqual(image.status, models.PropertyImage.STATUS_READY)
+
+
+@override_settings(IMAGE_WORKERS=0)
+class ImageBlobTests(MediaRootMixin, PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.owner = self.make_user()
+        self.city = self.make_city()
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def upload(self, prop, upload):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/main/properties/{prop.pk}/add_images/', {'images': [upload]}, format='multipart')
+        return prop.images.latest('pk')
+
+    def counts(self, image):
+        return set(models.ImageBlob.objects.filter(name__in=blobs.references(image)).values_list('ref_count', flat=True))
+
+    def collect(self):
+        return blobs.collect_garbage(grace=timedelta(0))
+
+    def test_identical_uploads_share_files(self):
+        first = self.upload(self.make_property(self.owner, self.city), make_jpeg(size=(800, 600)))
+        second = self.upload(self.make_property(self.owner, self.city, title='Second'), make_jpeg(size=(800, 600)))
+
+        self.assertEqual(blobs.references(first), blobs.references(second))
+        self.assertEqual(self.counts(first), {2})
+        blob = models.ImageBlob.objects.get(name=first.images.name)
+        self.assertEqual(len(blob.phash), 16)
+        self.assertEqual(blob.size, first.images.size)
+
+    def test_files_are_collected_once_unreferenced(self):
+        first = self.upload(self.make_property(self.owner, self.city), make_jpeg(size=(800, 600)))
+        second = self.upload(self.make_property(self.owner, self.city, title='Second'), make_jpeg(size=(800, 600)))
+        storage = first.images.storage
+        self.collect()  # the raw upload
+
+        first.delete()
+        self.assertEqual(self.counts(second), {1})
+        self.assertEqual(self.collect(), 0)
+        self.assertTrue(all(storage.exists(name) for name in blobs.references(second)))
+
+        # deleting the property cascades to its images
+        second.property.delete()
+        self.assertEqual(blobs.collect_garbage(), 0)  # still within the grace period
+        self.assertEqual(self.collect(), 5)
+        self.assertFalse(any(storage.exists(name) for name in blobs.references(second)))
+        self.assertFalse(models.ImageBlob.objects.exists())
+
+    def test_reupload_during_grace_period_revives_file(self):
+        prop = self.make_property(self.owner, self.city)
+        image = self.upload(prop, make_jpeg(size=(200, 100)))
+        names = blobs.references(image)
+        image.delete()
+
+        again = self.upload(prop, make_jpeg(size=(200, 100)))
+        self.assertEqual(blobs.references(again), names)
+        self.collect()
+        self.assertTrue(all(again.images.storage.exists(name) for name in names))
+
+    def test_dedupe_report(self):
+        storage = images.image_storage()
+        prop = self.make_property(self.owner, self.city)
+        legacy = [
+            models.PropertyImage.objects.create(property=prop, images=name)
+            for name in ('restate_ads/a.jpg', 'restate_ads/b.jpg')
+        ]
+        os.makedirs(storage.path('restate_ads'))
+        for image in legacy:
+            # written the way the old storage did, under the upload name
+            with open(storage.path(image.images.name), 'wb') as fileobj:
+                fileobj.write(make_jpeg(size=(400, 300)).read())
+
+        out = io.StringIO()
+        call_command('media_dedupe', '--apply', stdout=out)
+
+        self.assertIn('2 files, ', out.getvalue())
+        self.assertIn('1 sets of identical files', out.getvalue())
+        self.assertIn('2 images moved', out.getvalue())
+        names = {image.images.name for image in models.PropertyImage.objects.all()}
+        self.assertEqual(len(names), 1)
+        self.assertEqual(models.ImageBlob.objects.get(name=names.pop()).ref_count, 2)
+        self.assertEqual(self.collect(), 2)
+        self.assertFalse(storage.exists('restate_ads/a.jpg'))
+
+
+@skipUnless(moto, 'moto is not installed')
+@override_settings(
+    IMAGE_WORKERS=0,
+    AWS_STORAGE_BUCKET_NAME='media-test',
+    AWS_S3_REGION_NAME='us-east-1',
+    AWS_ACCESS_KEY_ID='testing',
+    AWS_SECRET_ACCESS_KEY='testing',
+)
+class DirectUploadTests(PropertyFixturesMixin, MainTestCase):
+    """Presigned uploads against a moto bucket standing in for S3/MinIO."""
+
+    def setUp(self):
+        super().setUp()
+        aws = moto.mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        self.s3.create_bucket(Bucket='media-test')
+
+        self.storage = storages.ContentAddressedS3Storage()
+        patcher = mock.patch.object(models.PropertyImage._meta.get_field('images'), 'storage', self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.owner = self.make_user()
+        self.prop = self.make_property(self.owner, self.make_city())
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def request_upload(self, content, content_type='image/jpeg'):
+        response = self.client.post(
+            f'/main/properties/{self.prop.pk}/upload-url/',
+            {'content_type': content_type, 'size': len(content)}, format='json',
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def put(self, upload, content):
+        return requests.put(upload['url'], data=content, headers=upload['headers'])
+
+    def register(self, upload):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                f'/main/properties/{self.prop.pk}/register-image/',
+                {'upload_token': upload['upload_token']}, format='json',
+            )
+
+    def test_direct_upload_is_registered_and_rendered(self):
+        content = make_jpeg(size=(800, 600)).read()
+        upload = self.request_upload(content)
+        self.assertIn('X-Amz-Signature=', upload['url'])
+        self.assertEqual(self.put(upload, content).status_code, 200)
+
+        response = self.register(upload)
+
+        self.assertEqual(response.status_code, 201, response.data)
+        image = models.PropertyImage.objects.get()
+        self.assertEqual(image.status, models.PropertyImage.STATUS_READY)
+        self.assertEqual(len(image.renditions), 4)
+        key = f'media/{image.images.name}'
+        head = self.s3.head_object(Bucket='media-test', Key=key)
+        self.assertEqual(head['CacheControl'], 'public, max-age=31536000, immutable')
+        self.assertTrue(self.storage.url(image.images.name).startswith('https://media-test.s3.amazonaws.com/media/'))
+
+    def test_register_requires_the_upload(self):
+        upload = self.request_upload(b'x' * 100)
+        response = self.register(upload)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(models.PropertyImage.objects.exists())
+
+    def test_size_and_type_are_signed(self):
+        # moto does not check signatures; S3 and MinIO reject a PUT whose signed headers differ
+        upload = self.request_upload(b'x' * 100)
+        self.assertIn('X-Amz-SignedHeaders=content-length%3Bcontent-type%3Bhost', upload['url'])
+
+        # so a mismatch only gets past a stand-in, and register-image still refuses it
+        self.put(upload, b'y' * 200)
+        self.assertEqual(self.register(upload).status_code, 400)
+        self.assertIsNone(self.storage.head(signing.loads(upload['upload_token'], salt='main.direct-upload')['name']))
+
+    def test_token_is_bound_to_its_property(self):
+        content = make_jpeg(size=(200, 100)).read()
+        upload = self.request_upload(content)
+        self.put(upload, content)
+        other = self.make_property(self.owner, self.make_city(), title='Other')
+
+        response = self.client.post(
+            f'/main/properties/{other.pk}/register-image/', {'upload_token': upload['upload_token']}, format='json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.register(upload).status_code, 201)
+        self.assertEqual(self.register(upload).status_code, 400)
+
+    def test_upload_limits(self):
+        response = self.client.post(
+            f'/main/properties/{self.prop.pk}/upload-url/',
+            {'content_type': 'image/gif', 'size': 100}, format='json',
+        )
+        self.assertEqual(response.status_code, 400)
+        with override_settings(DIRECT_UPLOAD_MAX_SIZE=1000):
+            response = self.client.post(
+                f'/main/properties/{self.prop.pk}/upload-url/',
+                {'content_type': 'image/png', 'size': 1001}, format='json',
+            )
+        self.assertEqual(response.status_code, 400)
+
+
+@skipUnless(moto, 'moto is not installed')
+@override_settings(
+    AWS_STORAGE_BUCKET_NAME='static-test',
+    AWS_S3_REGION_NAME='us-east-1',
+    AWS_ACCESS_KEY_ID='testing',
+    AWS_SECRET_ACCESS_KEY='testing',
+    STATICFILES_FINDERS=['django.contrib.staticfiles.finders.FileSystemFinder'],
+)
+class UploadStaticTests(TestCase):
+
+    def setUp(self):
+        aws = moto.mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        self.s3.create_bucket(Bucket='static-test')
+
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.static_root, ignore_errors=True)
+        self.write('css/site.css', 'body { color: #333; }\n' * 200)
+        self.write('js/app.js', 'console.log("hello");\n' * 50)
+        self.write('img/logo.png', os.urandom(2048))
+        override = override_settings(STATICFILES_DIRS=[self.root], STATIC_ROOT=self.static_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def write(self, path, content):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content.encode() if isinstance(content, str) else content)
+
+    def sync(self, *args):
+        out = io.StringIO()
+        call_command('uploadstatic', *args, stdout=out)
+        return out.getvalue()
+
+    def head(self, path):
+        return self.s3.head_object(Bucket='static-test', Key=f'static/{path}')
+
+    def hashed_name(self, path):
+        with open(os.path.join(self.static_root, 'staticfiles.json')) as f:
+            return json.load(f)['paths'][path]
+
+    def test_only_changed_files_are_uploaded(self):
+        # three files, their hashed copies and the staticfiles manifest
+        self.assertIn('7 uploaded', self.sync())
+        self.assertIn('0 uploaded', self.sync())
+        self.assertIn('7 unchanged skipped', self.sync())
+
+        self.write('css/site.css', 'body { color: #000; }\n')
+        # collectstatic compares modification times to the second
+        later = time.time() + 2
+        os.utime(os.path.join(self.root, 'css/site.css'), (later, later))
+        self.assertIn('Would upload: css/site.css', self.sync('--dry-run'))
+        output = self.sync()
+        # the file, its new hashed copy and the manifest
+        self.assertIn('3 uploaded', output)
+        self.assertIn('5 unchanged skipped', output)
+        self.assertIn('8 uploaded', self.sync('--force'))
+
+    def test_collected_files_are_uploaded_under_their_hashed_names(self):
+        self.sync('--workers', '2')
+
+        css = self.head('css/site.css')
+        self.assertEqual(css['ContentEncoding'], 'gzip')
+        self.assertEqual(css['ContentType'], 'text/css')
+        self.assertLess(css['ContentLength'], 200 * 22)
+        self.assertEqual(css['CacheControl'], 'public, max-age=300')
+
+        hashed = self.head(self.hashed_name('js/app.js'))
+        self.assertEqual(hashed['CacheControl'], 'public, max-age=31536000, immutable')
+        self.assertEqual(hashed['ContentEncoding'], 'gzip')
+        self.assertNotIn('ContentEncoding', self.head('img/logo.png'))
+        # WhiteNoise's precompressed copies are not uploaded
+        with self.assertRaises(ClientError):
+            self.head(f"{self.hashed_name('css/site.css')}.gz")
+
+
+class DirectUploadWithoutS3Tests(PropertyFixturesMixin, MainTestCase):
+
+    def test_filesystem_storage_cannot_presign(self):
+        owner = self.make_user()
+        prop = self.make_property(owner, self.make_city())
+        client = APIClient()
+        client.force_authenticate(owner)
+        response = client.post(
+            f'/main/properties/{prop.pk}/upload-url/', {'content_type': 'image/jpeg', 'size': 100}, format='json',
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class WebsocketAuthTests(PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        user_cache.clear()
+        self.addCleanup(user_cache.clear)
+        self.user = self.make_user()
+        # the socket's first frame is the badge; count it now
+        badges.reconcile([self.user.id], notify=False)
+        self.application = JwtAuthMiddleware(URLRouter(routing.websocket_urlpatterns))
+        # database_sync_to_async would close the test case's connection
+        patcher = mock.patch('channels.db.close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self, token):
+        async def handshake():
+            communicator = WebsocketCommunicator(self.application, f'/ws/notifications/?token={token}')
+            connected, _ = await communicator.connect()
+            await communicator.disconnect()
+            return connected
+        return async_to_sync(handshake)()
+
+    def test_reconnects_reuse_the_resolved_user(self):
+        token = AccessToken.for_user(self.user)
+        with self.assertNumQueries(1):
+            self.assertTrue(self.connect(token))
+        with self.assertNumQueries(0):
+            self.assertTrue(self.connect(token))
+        self.assertEqual((user_cache.hits, user_cache.misses), (1, 1))
+
+        # a new token is a new key
+        with self.assertNumQueries(1):
+            self.assertTrue(self.connect(AccessToken.for_user(self.user)))
+
+    def test_saving_the_user_invalidates(self):
+        token = AccessToken.for_user(self.user)
+        self.connect(token)
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertFalse(self.connect(token))
+
+    def test_bad_tokens_are_rejected_without_queries(self):
+        token = AccessToken.for_user(self.user)
+        expired = AccessToken.for_user(self.user)
+        expired.set_exp(lifetime=-timedelta(minutes=1))
+        with self.assertNumQueries(0):
+            self.assertFalse(self.connect(str(token)[:-2] + 'xx'))
+            self.assertFalse(self.connect(expired))
+            self.assertFalse(self.connect('not-a-jwt'))
+
+    def test_cache_entries_expire(self):
+        token = AccessToken.for_user(self.user)
+        with override_settings(WEBSOCKET_USER_CACHE_TTL=0):
+            self.connect(token)
+        with self.assertNumQueries(1):
+            self.connect(token)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class BadgeTests(PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.alice = self.make_user('alice')
+        self.bob = self.make_user('bob')
+        self.carol = self.make_user('carol')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def send(self, sender, content='Hi'):
+        with self.captureOnCommitCallbacks(execute=True):
+            return models.Message.objects.create(sender=sender, recipient=self.alice, content=content)
+
+    def notify(self):
+        prop = self.make_property(self.alice, self.make_city())
+        with self.captureOnCommitCallbacks(execute=True):
+            return models.Notification.objects.create(
+                user=self.alice, content_type=ContentType.objects.get_for_model(prop), object_id=prop.id,
+                notif_type=models.Notification.NOTIF_FAVORITE,
+            )
+
+    def badge(self):
+        response = self.client.get('/main/badges/')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_messages_and_read_receipts_move_the_counters(self):
+        self.badge()
+        self.send(self.bob)
+        self.send(self.bob)
+        self.send(self.carol)
+
+        with self.assertNumQueries(0):
+            badge = self.badge()
+        self.assertEqual(badge, {'messages': 3, 'notifications': 0, 'conversations': {str(self.bob.id): 2, str(self.carol.id): 1}})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/main/messages/read/', {'user_id': self.bob.id}, format='json')
+        self.assertEqual(self.badge(), {'messages': 1, 'notifications': 0, 'conversations': {str(self.carol.id): 1}})
+
+    def test_notifications_are_counted_until_marked_read(self):
+        self.badge()
+        notification = self.notify()
+        self.assertEqual(self.badge()['notifications'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/main/notifications/mark_read/', {'ids': [str(notification.id)]}, format='json')
+        self.assertEqual(self.badge()['notifications'], 0)
+
+    def test_counters_are_reconciled_with_postgres(self):
+        # written without their on-commit updates: nothing counted yet
+        models.Message.objects.create(sender=self.bob, recipient=self.alice, content='Hi')
+        self.assertEqual(self.badge()['messages'], 1)
+
+        badges.get_store().apply({self.alice.id: {badges.MESSAGES: 5}})
+        self.assertEqual(self.badge()['messages'], 6)
+        call_command('reconcile_badges', stdout=io.StringIO())
+        self.assertEqual(self.badge(), {'messages': 1, 'notifications': 0, 'conversations': {str(self.bob.id): 1}})
+
+        # edits recount the users involved
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Message.objects.update(is_read=True)
+            models.Message.objects.get().save()
+        self.assertEqual(self.badge()['messages'], 0)
+
+    def test_cascaded_deletes_recount_each_user_once(self):
+        for _ in range(5):
+            self.send(self.bob)
+
+        with mock.patch('main.badges.reconcile', wraps=badges.reconcile) as reconcile, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.bob.delete()
+
+        reconcile.assert_called_once()
+        self.assertEqual(self.badge()['messages'], 0)
+
+    def test_reconcile_keeps_changes_made_while_counting(self):
+        self.send(self.bob)
+        self.badge()
+        counted = []
+        real_count = badges.count
+
+        def count(user_ids):
+            counts = real_count(user_ids)
+            if not counted:
+                # a message committed and applied between the count and the write
+                self.send(self.carol)
+            counted.append(counts)
+            return counts
+
+        with mock.patch('main.badges.count', side_effect=count):
+            badges.reconcile([self.alice.id], notify=False)
+
+        self.assertEqual(len(counted), 2)
+        self.assertEqual(self.badge(), {'messages': 2, 'notifications': 0, 'conversations': {str(self.bob.id): 1, str(self.carol.id): 1}})
+
+    def test_badges_are_counted_while_redis_is_down(self):
+        self.send(self.bob)
+        with mock.patch.object(badges.get_store(), 'get', side_effect=RedisConnectionError), \
+                self.assertLogs('main.badges', 'ERROR'):
+            self.assertEqual(self.badge()['messages'], 1)
+
+    def test_changes_are_pushed_to_notification_sockets(self):
+        application = JwtAuthMiddleware(URLRouter(routing.websocket_urlpatterns))
+        patcher = mock.patch('channels.db.close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.send(self.bob)
+
+        async def session():
+            communicator = WebsocketCommunicator(application, f'/ws/notifications/?token={AccessToken.for_user(self.alice)}')
+            await communicator.connect()
+            initial = await communicator.receive_json_from()
+            await database_sync_to_async(self.send)(self.carol)
+            pushed = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return initial, pushed
+
+        initial, pushed = async_to_sync(session)()
+        self.assertEqual(initial, {'type': 'badges', 'messages': 1, 'notifications': 0, 'conversations': {str(self.bob.id): 1}})
+        self.assertEqual(pushed, {'type': 'badges', 'messages': 2, 'notifications': 0, 'conversations': {str(self.carol.id): 1}})
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class PresenceTests(PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_user()
+        self.application = JwtAuthMiddleware(URLRouter(routing.websocket_urlpatterns))
+        # database_sync_to_async would close the test case's connection
+        patcher = mock.patch('channels.db.close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_online_until_every_connection_is_gone(self):
+        registry = presence.get_registry()
+        registry.touch(self.user.id, 'phone')
+        registry.touch(self.user.id, 'tablet')
+        registry.remove(self.user.id, 'phone')
+        self.assertTrue(presence.is_online(self.user.id))
+
+        registry.remove(self.user.id, 'tablet')
+        self.assertFalse(presence.is_online(self.user.id))
+
+    def test_connections_without_heartbeats_expire(self):
+        with override_settings(PRESENCE_TTL=0):
+            presence.get_registry().touch(self.user.id, 'phone')
+        self.assertEqual(presence.online([self.user.id]), set())
+
+    def test_chat_sockets_register_and_answer_heartbeats(self):
+        token = AccessToken.for_user(self.user)
+
+        async def session():
+            communicator = WebsocketCommunicator(self.application, f'/ws/chat/?token={token}')
+            await communicator.connect()
+            online = presence.is_online(self.user.id)
+            await communicator.send_json_to({'type': 'heartbeat'})
+            reply = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return online, reply
+
+        online, reply = async_to_sync(session)()
+        self.assertTrue(online)
+        self.assertEqual(reply, {'type': 'heartbeat'})
+        self.assertFalse(presence.is_online(self.user.id))
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ChatWriterTests(PropertyFixturesMixin, MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sender = self.make_user('sender')
+        self.recipient = self.make_user('recipient', email='recipient@example.com')
+        self.application = JwtAuthMiddleware(URLRouter(routing.websocket_urlpatterns))
+        # database_sync_to_async would close the test case's connection
+        patcher = mock.patch('channels.db.close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def chat(self, frames, listen=False):
+        """Send frames as the sender; returns the sender's and the recipient's replies."""
+        async def session():
+            sender = WebsocketCommunicator(self.application, f'/ws/chat/?token={AccessToken.for_user(self.sender)}')
+            recipient = WebsocketCommunicator(self.application, f'/ws/chat/?token={AccessToken.for_user(self.recipient)}')
+            await sender.connect()
+            if listen:
+                await recipient.connect()
+            for frame in frames:
+                await sender.send_json_to(frame)
+            replies = [await sender.receive_json_from() for _ in frames]
+            received = [await recipient.receive_json_from() for _ in frames] if listen else []
+            await chat.get_writer().flush()
+            await sender.disconnect()
+            if listen:
+                await recipient.disconnect()
+            return replies, received
+        return async_to_sync(session)()
+
+    def test_messages_are_acknowledged_delivered_and_saved_in_order(self):
+        frames = [{'recipient': self.recipient.id, 'content': f'Message {i}'} for i in range(5)]
+        replies, received = self.chat(frames, listen=True)
+
+        self.assertEqual([reply['message']['content'] for reply in replies], [f'Message {i}' for i in range(5)])
+        self.assertEqual(received, replies)
+        saved = models.Message.objects.order_by('timestamp')
+        self.assertEqual([str(message.pk) for message in saved], [reply['message']['id'] for reply in replies])
+        self.assertEqual(saved[0].sender_id, self.sender.id)
+        # online recipients are not pushed or emailed
+        self.assertFalse(models.OutboxEvent.objects.exists())
+
+    def test_queued_messages_are_written_in_one_batch(self):
+        messages = [models.Message(sender=self.sender, recipient=self.recipient, content=f'Message {i}') for i in range(50)]
+
+        async def write():
+            writer = chat.get_writer()
+            for message in messages:
+                await writer.submit(message)
+            await writer.flush()
+
+        # savepoint, messages, conversation, outbox events, release
+        with self.assertNumQueries(5):
+            async_to_sync(write)()
+        self.assertEqual(models.Message.objects.count(), 50)
+        self.assertEqual(models.OutboxEvent.objects.count(), 100)
+        conversation = models.Conversation.objects.get()
+        self.assertEqual(conversation.last_message_id, messages[-1].pk)
+        self.assertEqual(conversation.unread_for(self.recipient.id), 50)
+
+    def test_offline_recipients_get_push_and_email(self):
+        self.chat([{'recipient': self.recipient.id, 'content': 'Hello'}])
+
+        message = models.Message.objects.get()
+        self.assertEqual(
+            sorted(models.OutboxEvent.objects.values_list('dedupe_key', flat=True)),
+            [f'message:{message.pk}:email', f'message:{message.pk}:push'],
+        )
+
+    def test_unknown_recipients_are_rejected(self):
+        replies, _ = self.chat([{'recipient': 999999, 'content': 'Hello'}, {'recipient': 'nobody', 'content': 'Hello'}])
+
+        self.assertEqual(replies, [{'type': 'error', 'error': 'Unknown recipient.'}] * 2)
+        self.assertFalse(models.Message.objects.exists())
+
+    def test_senders_hear_about_messages_that_could_not_be_saved(self):
+        with mock.patch('main.chat.persist', side_effect=RuntimeError), mock.patch('main.chat.asyncio.sleep'):
+            async def session():
+                sender = WebsocketCommunicator(self.application, f'/ws/chat/?token={AccessToken.for_user(self.sender)}')
+                await sender.connect()
+                await sender.send_json_to({'recipient': self.recipient.id, 'content': 'Hello'})
+                ack = await sender.receive_json_from()
+                failed = await sender.receive_json_from()
+                await sender.disconnect()
+                return ack, failed
+            with self.assertLogs('main.chat', 'ERROR'):
+                ack, failed = async_to_sync(session)()
+
+        self.assertEqual(failed, {'type': 'failed', 'ids': [ack['message']['id']]})
+
+    def test_a_bad_message_does_not_lose_its_batch(self):
+        messages = [models.Message(sender=self.sender, recipient=self.recipient, content=f'Message {i}') for i in range(5)]
+        messages[3].content = 'bad'
+        real_persist = chat.persist
+
+        def persist(batch):
+            if any(message.content == 'bad' for message in batch):
+                raise IntegrityError('recipient is gone')
+            real_persist(batch)
+
+        async def write():
+            channel_layer = get_channel_layer()
+            reply_channel = await channel_layer.new_channel()
+            writer = chat.get_writer()
+            for message in messages:
+                await writer.submit(message, reply_channel)
+            await writer.flush()
+            return await channel_layer.receive(reply_channel)
+
+        with mock.patch('main.chat.persist', side_effect=persist), mock.patch('main.chat.asyncio.sleep'), \
+                self.assertLogs('main.chat', 'ERROR'):
+            failed = async_to_sync(write)()
+
+        self.assertEqual(failed, {'type': 'chat.failed', 'ids': [str(messages[3].pk)]})
+        self.assertEqual(
+            list(models.Message.objects.order_by('timestamp').values_list('content', flat=True)),
+            ['Message 0', 'Message 1', 'Message 2', 'Message 4'],
+        )
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    IMAGE_WORKERS=1,
+)
+class ImageWorkerPoolTests(MediaRootMixin, PropertyFixturesMixin, TransactionTestCase):
+
+    def test_renditions_are_made_in_the_process_pool(self):
+        owner = self.make_user()
+        prop = self.make_property(owner, self.make_city())
+        client = APIClient()
+        client.force_authenticate(owner)
+        self.addCleanup(self.shutdown_pool)
+
+        client.post(f'/main/properties/{prop.pk}/add_images/', {'images': [make_jpeg(size=(800, 600))]}, format='multipart')
+
+        deadline = time.monotonic() + 30
+        image = models.PropertyImage.objects.get()
+        while image.status == models.PropertyImage.STATUS_PROCESSING and time.monotonic() < deadline:
+            time.sleep(0.1)
+            image.refresh_from_db()
+        self.assertEqual(image.status, models.PropertyImage.STATUS_READY)
+        self.assertEqual(len(image.renditions), 4)
+
+    def shutdown_pool(self):
+        if images._pool is not None:
+            images._pool.shutdown()
+            images._pool = None
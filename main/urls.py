@@ -1,5 +1,5 @@
 from django.urls import path, include
-from .views import (verify_subscription_payment, 
+from .views import (verify_subscription_payment, cache_stats, outbox_stats, unread_badges,
                      verify_listing_payment, PropertyViewSet, 
                      ProperyFeatureViewSet, PropertyImageViewSet, 
                      PropertyReviewViewset, RegionViewSet, 
@@ -32,6 +32,9 @@ property_router.register('favorites', viewset=SavedPropertyViewSet, basename='fa
 urlpatterns = [
     path('payments/verify-listing/', verify_listing_payment, name='verify-listing'),
     path('payments/verify-subscription/', verify_subscription_payment, name='verify-subscription'),
+    path('badges/', unread_badges, name='badges'),
+    path('cache-stats/', cache_stats, name='cache-stats'),
+    path('outbox-stats/', outbox_stats, name='outbox-stats'),
     path('', include(router.urls)),
     path('', include(property_router.urls)),
 ]
@@ -2,7 +2,7 @@ import requests, logging
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from rest_framework.exceptions import PermissionDenied
 from rest_framework.decorators import api_view, permission_classes, action
-from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAuthenticated
+from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAuthenticated, IsAdminUser
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.exceptions import ValidationError
 from rest_framework.decorators import action
@@ -11,12 +11,19 @@ from rest_framework.response import Response
 from django.db.models import F, Q, Max
 from rest_framework import status, parsers
 from rest_framework.filters import SearchFilter, OrderingFilter
-from . filters import PropertyFilter
+from . filters import PropertyFilter, PropertySearchFilter
+from .pagination import InboxPagination, PropertyCursorPagination
+from . import badges
+from . import caching
+from . import conversations
+from . import visits
+from . import outbox
+from .images import create_image, image_storage
 from django.db import transaction
 from datetime import timedelta
 import uuid
 from django.conf import settings
-from .expo_utils import send_expo_push
+from django.core import signing
 
 logger = logging.getLogger(__name__) 
 from django.conf import settings
@@ -43,24 +50,41 @@ class ProperyFeatureViewSet(ModelViewSet):
 
 MAX_IMAGES_PER_PROPERTY = 4
 
-class PropertyViewSet(ModelViewSet):
+class PropertyViewSet(caching.CachedResponseMixin, ModelViewSet):
     queryset = models.Property.objects.all()
     serializer_class = serializers.PropertySerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, PropertySearchFilter, OrderingFilter]
     filterset_class = PropertyFilter
-    search_fields = ['title', 'type', 'property_type']
+    # only used by the ?search_mode=ilike fallback
+    search_fields = ['title', 'type', 'property_type', 'description', 'detailed_address']
     ordering_fields = ['price', 'date_posted', 'type', 'property_type']
+    ordering = ['-date_posted']
+    pagination_class = PropertyCursorPagination
+    cache_namespace = caching.PROPERTIES
+
+    # actions that serialize full listings and need the related rows up front
+    listing_actions = ('list', 'retrieve', 'my_properties')
 
     def get_queryset(self):
         qs = super().get_queryset()
-        now = timezone.now()
+
+        if self.action in self.listing_actions:
+            qs = qs.for_listing()
+        elif self.action == 'visit':
+            qs = qs.only('id', 'visit_count', 'creator_id', 'is_verified', 'expiry_date')
+        elif self.action in ('update', 'partial_update'):
+            # DRF drops prefetch caches after an update, so only join the city
+            qs = qs.select_related('city__region')
 
         if self.request.user.is_staff:
             return qs
         if self.action == 'my_properties':
             return qs.filter(creator=self.request.user)
-        return qs.filter(is_verified=True, expiry_date__gt=now)
+        return qs.live()
+
+    def get_cache_timeout(self, data):
+        return caching.seconds_until_first_expiry(data, self.cache_timeout)
 
     def perform_create(self, serializer):
         user = self.request.user
@@ -85,19 +109,41 @@ class PropertyViewSet(ModelViewSet):
 
     @action(detail=True, methods=['post'])
     def visit(self, request, pk=None):
-        """Increment and return the new visit count."""
+        """Record a visit and return the approximate live visit count."""
         prop = self.get_object()
-        # Optionally: throttle by IP / user to avoid bots
-        prop.visit_count = F('visit_count') + 1
-        prop.save(update_fields=['visit_count'])
-        prop.refresh_from_db()  # get the actual integer value
-        return Response({'visit_count': prop.visit_count}, status=status.HTTP_200_OK)
+        # buffered and flushed in batches by main.visits, no row lock here;
+        # bots and repeat visits on the same day are not counted
+        if visits.is_bot(request):
+            pending = visits.pending_visits(prop.pk)
+        else:
+            pending = visits.record_visit(prop.pk, visits.visitor_id(request))
+        return Response({'visit_count': prop.visit_count + pending}, status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=['get'], url_path='visit-stats', permission_classes=[IsAuthenticated])
+    def visit_stats(self, request, pk=None):
+        """
+        GET /main/properties/<id>/visit-stats/?days=30
+        Unique visitors per day, for the listing owner.
+        """
+        prop = get_object_or_404(models.Property.objects.only('id', 'creator_id', 'visit_count', 'unique_visitors'), pk=pk)
+        if prop.creator_id != request.user.id:
+            raise PermissionDenied('You do not have permission to view stats for this property.')
+        try:
+            days = int(request.query_params.get('days', visits.SERIES_DAYS))
+        except ValueError:
+            raise ValidationError({'days': 'Must be a number.'})
+        return Response({
+            'visit_count': prop.visit_count + visits.pending_visits(prop.pk),
+            'unique_visitors': prop.unique_visitors,
+            'daily': visits.daily_unique_visitors(prop.pk, max(days, 1)),
+        }, status=status.HTTP_200_OK)
 
     @action(detail=False, methods=['get'], url_path='my-properties')
     def my_properties(self, request):
-        queryset = self.get_queryset().filter(creator=request.user)
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        queryset = self.filter_queryset(self.get_queryset().filter(creator=request.user))
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
     @action(
         detail=True,
@@ -127,6 +173,86 @@ class PropertyViewSet(ModelViewSet):
             created.append(ser.data)
 
         return Response(created, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['post'], url_path='upload-url')
+    def upload_url(self, request, pk=None):
+        """
+        POST /main/properties/<id>/upload-url/ {"content_type": "image/jpeg", "size": 123456}
+
+        A presigned URL to PUT one image straight to the bucket, with the
+        headers to send. Once the PUT succeeds, POST the returned
+        upload_token to register-image.
+        """
+        prop = get_object_or_404(models.Property, pk=pk)
+        if prop.creator != request.user:
+            raise PermissionDenied("You do not have permission to add images to this property.")
+
+        storage = image_storage()
+        if not hasattr(storage, 'presigned_put'):
+            return Response({"detail": "Direct uploads need S3 media storage."}, status=status.HTTP_400_BAD_REQUEST)
+        if prop.images.count() >= MAX_IMAGES_PER_PROPERTY:
+            return Response(
+                {"detail": f"Maximum of {MAX_IMAGES_PER_PROPERTY} images allowed."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        ser = serializers.DirectUploadSerializer(data=request.data)
+        ser.is_valid(raise_exception=True)
+        content_type, size = ser.validated_data['content_type'], ser.validated_data['size']
+        # rendering moves it to a content-addressed name; a bucket lifecycle
+        # rule on restate_ads/incoming/ can expire uploads never registered
+        name = f'restate_ads/incoming/{uuid.uuid4().hex}{serializers.DIRECT_UPLOAD_TYPES[content_type]}'
+
+        token = signing.dumps(
+            {'property': str(prop.pk), 'name': name, 'content_type': content_type, 'size': size},
+            salt=serializers.DIRECT_UPLOAD_SALT,
+        )
+        return Response({
+            'url': storage.presigned_put(name, content_type, size, settings.DIRECT_UPLOAD_EXPIRY),
+            'method': 'PUT',
+            'headers': {'Content-Type': content_type},
+            'expires_in': settings.DIRECT_UPLOAD_EXPIRY,
+            'upload_token': token,
+        })
+
+    @action(detail=True, methods=['post'], url_path='register-image')
+    def register_image(self, request, pk=None):
+        """
+        POST /main/properties/<id>/register-image/ {"upload_token": "..."}
+
+        Checks that a direct upload arrived as announced and adds it to the
+        property. It is rendered like any other upload.
+        """
+        prop = get_object_or_404(models.Property, pk=pk)
+        if prop.creator != request.user:
+            raise PermissionDenied("You do not have permission to add images to this property.")
+
+        ser = serializers.RegisterUploadSerializer(data=request.data, context={'property_id': prop.pk})
+        ser.is_valid(raise_exception=True)
+        upload = ser.validated_data['upload_token']
+        name = upload['name']
+
+        if models.ImageBlob.objects.filter(name=name).exists():
+            return Response({"detail": "This upload is already registered."}, status=status.HTTP_400_BAD_REQUEST)
+        if prop.images.count() >= MAX_IMAGES_PER_PROPERTY:
+            return Response(
+                {"detail": f"Maximum of {MAX_IMAGES_PER_PROPERTY} images allowed."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        storage = image_storage()
+        stored = storage.head(name)
+        if stored is None:
+            return Response({"detail": "The upload has not arrived."}, status=status.HTTP_400_BAD_REQUEST)
+        if stored != (upload['size'], upload['content_type']):
+            storage.delete(name)
+            return Response({"detail": "The upload does not match what was announced."}, status=status.HTTP_400_BAD_REQUEST)
+
+        image = create_image(prop.pk, name, size=upload['size'])
+        return Response(
+            serializers.PropertyImageSerializer(image, context={'request': request}).data,
+            status=status.HTTP_201_CREATED,
+        )
     
    
 
@@ -251,14 +377,16 @@ class SavedPropertyViewSet(ModelViewSet):
         )
     
 
-class RegionViewSet(ReadOnlyModelViewSet):
+class RegionViewSet(caching.CachedResponseMixin, ReadOnlyModelViewSet):
     queryset = models.Region.objects.all()
     serializer_class = serializers.RegionSerializer
+    cache_namespace = caching.REGIONS
     
 
-class CityViewSet(ReadOnlyModelViewSet):
-    queryset = models.City.objects.all()
+class CityViewSet(caching.CachedResponseMixin, ReadOnlyModelViewSet):
+    queryset = models.City.objects.select_related('region')
     serializer_class = serializers.CitySerializer
+    cache_namespace = caching.CITIES
 
 
 class InquiryViewSet(ModelViewSet):
@@ -280,9 +408,20 @@ class InquiryViewSet(ModelViewSet):
 
 
 
+def parse_message_id(value, field):
+    if not value:
+        return None
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        raise ValidationError({field: "Must be a message id."})
+
+
 class MessageViewSet(ModelViewSet):
     serializer_class    = serializers.MessageSerializer
     permission_classes  = [IsAuthenticated]
+    history_limit       = 50
+    max_history_limit   = 200
 
     def get_queryset(self):
         user = self.request.user
@@ -296,12 +435,63 @@ class MessageViewSet(ModelViewSet):
         return qs.order_by('timestamp')
 
     def list(self, request, *args, **kwargs):
-        queryset = self.filter_queryset(self.get_queryset())
+        """
+        A window of the user's messages, or of their conversation with
+        ?user_id, oldest first: the latest ones, or those just ?before or
+        ?after a message id, at most ?limit of them.
+        """
         other_id = request.query_params.get('user_id')
-        if other_id:
-            queryset.filter(recipient=request.user, is_read=False).update(is_read=True)
-        serializer = self.get_serializer(queryset, many=True)
-        return Response({'current_user': request.user.id, 'messages': serializer.data})
+        if other_id and not other_id.isdigit():
+            raise ValidationError({"user_id": "Must be a user id."})
+        before = parse_message_id(request.query_params.get('before'), 'before')
+        after = parse_message_id(request.query_params.get('after'), 'after')
+        if before and after:
+            raise ValidationError({"after": "Cannot be combined with before."})
+
+        messages, has_more = conversations.history(
+            request.user.id, int(other_id) if other_id else None,
+            before=before, after=after, limit=self.get_history_limit(request),
+        )
+        serializer = self.get_serializer(messages, many=True)
+        return Response({'current_user': request.user.id, 'messages': serializer.data, 'has_more': has_more})
+
+    def get_history_limit(self, request):
+        try:
+            limit = int(request.query_params.get('limit', self.history_limit))
+        except ValueError:
+            raise ValidationError({"limit": "Must be a number."})
+        if limit <= 0:
+            return self.history_limit
+        return min(limit, self.max_history_limit)
+
+    @action(detail=False, methods=['post'])
+    def read(self, request):
+        """Read receipt: everything ?user_id sent, up to the message `up_to` if given, is read."""
+        other_id = str(request.data.get('user_id') or request.query_params.get('user_id') or '')
+        if not other_id.isdigit():
+            raise ValidationError({"user_id": "Must be a user id."})
+        up_to = parse_message_id(request.data.get('up_to'), 'up_to')
+        if up_to:
+            up_to = get_object_or_404(
+                models.Message.objects.filter(
+                    Q(sender=request.user, recipient_id=other_id) | Q(sender_id=other_id, recipient=request.user)
+                ),
+                pk=up_to,
+            ).timestamp
+        marked = conversations.mark_read(request.user.id, int(other_id), up_to)
+        return Response({'marked': marked})
+
+    @action(detail=False, methods=['get'])
+    def inbox(self, request):
+        """The user's conversations, most recent first, from one query per page."""
+        queryset = (
+            models.Conversation.objects.filter(conversations.involving(request.user.id))
+            .select_related('user_low', 'user_high', 'last_message')
+        )
+        paginator = InboxPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = serializers.ConversationSerializer(page, many=True, context={'user_id': request.user.id})
+        return paginator.get_paginated_response(serializer.data)
 
     def create(self, request, *args, **kwargs):
         recipient_id = (
@@ -326,17 +516,8 @@ class MessageViewSet(ModelViewSet):
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
     def perform_create(self, serializer):
-        msg = serializer.save(sender=self.request.user)
-        # --- SEND PUSH to recipient ---
-        tokens = models.PushToken.objects.filter(user=msg.recipient).values_list('token', flat=True)
-        title = f"New message from {self.request.user.username}"
-        body  = msg.content[:100]
-        for t in tokens:
-            try:
-                send_expo_push(t, title, body, data={'chatId': str(msg.id)})
-            except Exception:
-                pass  # optionally log
-        return msg
+        # push and email are sent by the Message post_save receiver
+        return serializer.save(sender=self.request.user)
 
     def perform_update(self, serializer):
         inst = serializer.instance
@@ -367,22 +548,15 @@ class NotificationViewSet(ModelViewSet):
         )
 
     def perform_create(self, serializer):
-        note = serializer.save(user=self.request.user)
-        # --- SEND PUSH to user ---
-        tokens = models.PushToken.objects.filter(user=note.user).values_list('token', flat=True)
-        title = "You have a new notification"
-        body  = dict(models.Notification.TYPE_CHOICES)[note.notif_type]
-        for t in tokens:
-            try:
-                send_expo_push(t, title, body, data={'notifId': str(note.id)})
-            except Exception:
-                pass
-        return note
+        # the push is sent by the Notification post_save receiver
+        return serializer.save(user=self.request.user)
 
     @action(detail=False, methods=['POST'])
     def mark_read(self, request):
         ids = request.data.get('ids', [])
-        models.Notification.objects.filter(user=request.user, id__in=ids).update(is_read=True)
+        marked = self.get_queryset().filter(id__in=ids, is_read=False).update(is_read=True)
+        if marked:
+            badges.notifications_read(request.user.id, marked)
         return Response({'status': 'marked read'}, status=status.HTTP_200_OK)
 
 
@@ -414,9 +588,10 @@ class PushTokenViewSet(ModelViewSet):
 
 
 
-class SubscriptionPlanViewSet(ReadOnlyModelViewSet):
-    queryset = models.SubscriptionPlan.objects.filter(is_active=True)
+class SubscriptionPlanViewSet(caching.CachedResponseMixin, ReadOnlyModelViewSet):
+    queryset = models.SubscriptionPlan.objects.filter(is_active=True).prefetch_related('perks')
     serializer_class = serializers.SubscriptionPlanSerializer
+    cache_namespace = caching.SUBSCRIPTION_PLANS
 
 
 
@@ -696,6 +871,37 @@ class ListingPaymentViewSet(ModelViewSet):
 
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def unread_badges(request):
+    """
+    GET /main/badges/
+    The user's unread message (total and per conversation) and notification
+    counts, from one Redis read.
+    """
+    return Response(badges.get(request.user.id), status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def cache_stats(request):
+    """
+    GET /main/cache-stats/
+    Hit/miss counters of the anonymous response cache, per namespace.
+    """
+    return Response(caching.stats(), status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def outbox_stats(request):
+    """
+    GET /main/outbox-stats/
+    Backlog and delivery lag of the side-effect outbox, per channel.
+    """
+    return Response(outbox.lag_stats(), status=status.HTTP_200_OK)
+
+
 @api_view(['POST'])
 def verify_listing_payment(request):
     reference = request.data.get("reference")
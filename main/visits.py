@@ -0,0 +1,315 @@
+"""
+Write-behind visit counting.
+
+Visits are accumulated in a buffer (a Redis hash when the default cache is
+django_redis, otherwise sharded in-process counters) and periodically
+flushed to Property.visit_count with one batched UPDATE, so a page view
+never takes a row lock on main_property.
+
+A visit only counts once per visitor per listing per day: who has visited
+today is kept exactly, in a set per listing that expires after a day.
+Unique visitor figures come from HyperLogLogs (one per listing per day,
+plus an all-time one per listing), which stay the same size however many
+visitors there are. Days older than SERIES_DAYS are dropped.
+"""
+import hashlib
+import logging
+import math
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Case, F, PositiveIntegerField, Value, When
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+FLUSH_BATCH_SIZE = 500
+# how many days of per-day unique visitor series are kept
+SERIES_DAYS = 30
+# how long who visited on a day is kept for repeat visits on that day
+SEEN_TTL = timedelta(days=2)
+
+BOT_PATTERN = re.compile(
+    r'bot|crawl|spider|slurp|scrape|curl|wget|python-requests|httpx|aiohttp|go-http-client|'
+    r'headless|phantomjs|facebookexternalhit|whatsapp|preview',
+    re.IGNORECASE,
+)
+
+
+def is_bot(request):
+    return bool(BOT_PATTERN.search(request.META.get('HTTP_USER_AGENT', '')))
+
+
+def visitor_id(request):
+    """
+    A stable, non-reversible id for whoever made the request: the user id
+    when logged in, otherwise a hash of client IP and user agent.
+    """
+    if request.user.is_authenticated:
+        return f'u:{request.user.pk}'
+    # Fly's proxy sets Fly-Client-IP; X-Forwarded-For is whatever the
+    # client sent, and rotating it would make every visit a new visitor
+    ip = request.META.get('HTTP_FLY_CLIENT_IP') or request.META.get('REMOTE_ADDR', '')
+    raw = f"{ip}|{request.META.get('HTTP_USER_AGENT', '')}"
+    return 'a:' + hashlib.sha1(raw.encode()).hexdigest()
+
+
+def _day(date):
+    return date.strftime('%Y%m%d')
+
+
+class RedisVisitBuffer:
+    key = 'visits:pending'
+
+    def __init__(self):
+        from django_redis import get_redis_connection
+        self.redis = get_redis_connection('default')
+
+    def add(self, property_id, amount=1):
+        return self.redis.hincrby(self.key, str(property_id), amount)
+
+    def pending(self, property_id):
+        return int(self.redis.hget(self.key, str(property_id)) or 0)
+
+    def add_visitor(self, property_id, visitor, day):
+        """Returns True the first time the visitor is seen on that day."""
+        # PFADD only says whether a register changed, most new visitors
+        # don't change one, so the check is against an exact set
+        seen_key = f'visits:seen:{property_id}:{day}'
+        day_key = f'visits:uv:{property_id}:{day}'
+        pipe = self.redis.pipeline()
+        pipe.sadd(seen_key, visitor)
+        pipe.expire(seen_key, SEEN_TTL)
+        pipe.pfadd(day_key, visitor)
+        pipe.expire(day_key, timedelta(days=SERIES_DAYS + 1))
+        pipe.pfadd(f'visits:uv:{property_id}', visitor)
+        is_new, _, _, _, _ = pipe.execute()
+        return bool(is_new)
+
+    def unique_visitors(self, property_ids):
+        pipe = self.redis.pipeline()
+        for property_id in property_ids:
+            pipe.pfcount(f'visits:uv:{property_id}')
+        return dict(zip(property_ids, pipe.execute()))
+
+    def daily_unique_visitors(self, property_id, days):
+        pipe = self.redis.pipeline()
+        for day in days:
+            pipe.pfcount(f'visits:uv:{property_id}:{day}')
+        return dict(zip(days, pipe.execute()))
+
+    def drain(self):
+        # RENAME is atomic: visits recorded from here on land in a fresh hash,
+        # and concurrent flushers each get their own snapshot
+        from redis.exceptions import ResponseError
+
+        snapshot = f'{self.key}:flushing:{uuid.uuid4().hex}'
+        try:
+            self.redis.rename(self.key, snapshot)
+        except ResponseError:
+            # nothing buffered since the last flush
+            return {}
+        pipe = self.redis.pipeline()
+        pipe.hgetall(snapshot)
+        pipe.delete(snapshot)
+        counts, _ = pipe.execute()
+        return {key.decode(): int(value) for key, value in counts.items()}
+
+
+class Sketch:
+    """
+    A HyperLogLog with 2**PRECISION one-byte registers, standing in for
+    Redis's PFADD/PFCOUNT: 1 KB whatever the number of visitors, exact for
+    a handful and within a few percent beyond.
+    """
+    PRECISION = 10
+
+    def __init__(self):
+        self.registers = bytearray(1 << self.PRECISION)
+
+    def add(self, value):
+        bits = 64 - self.PRECISION
+        digest = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+        index, rest = digest >> bits, digest & ((1 << bits) - 1)
+        rank = bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more accurate for small sets
+            return round(m * math.log(m / zeros))
+        return round(estimate)
+
+
+class LocalVisitBuffer:
+    shards = 16
+
+    def __init__(self):
+        self.locks = [threading.Lock() for _ in range(self.shards)]
+        self.counts = [defaultdict(int) for _ in range(self.shards)]
+        # (property id, day or None for all time) -> Sketch
+        self.visitors = defaultdict(Sketch)
+        # (property id, day) -> visitors seen that day, today's and yesterday's only
+        self.seen = defaultdict(set)
+        self.visitors_lock = threading.Lock()
+
+    def _shard(self, property_id):
+        return hash(str(property_id)) % self.shards
+
+    def add(self, property_id, amount=1):
+        shard = self._shard(property_id)
+        with self.locks[shard]:
+            self.counts[shard][str(property_id)] += amount
+            return self.counts[shard][str(property_id)]
+
+    def pending(self, property_id):
+        shard = self._shard(property_id)
+        with self.locks[shard]:
+            return self.counts[shard].get(str(property_id), 0)
+
+    def drain(self):
+        drained = {}
+        for shard in range(self.shards):
+            with self.locks[shard]:
+                drained.update(self.counts[shard])
+                self.counts[shard] = defaultdict(int)
+        return drained
+
+    def add_visitor(self, property_id, visitor, day):
+        with self.visitors_lock:
+            if (str(property_id), day) not in self.visitors:
+                self._expire(day)
+            seen = self.seen[(str(property_id), day)]
+            is_new = visitor not in seen
+            seen.add(visitor)
+            self.visitors[(str(property_id), day)].add(visitor)
+            self.visitors[(str(property_id), None)].add(visitor)
+        return is_new
+
+    def _expire(self, today):
+        # as the Redis keys expire: sketches after SERIES_DAYS + 1 days,
+        # seen sets after SEEN_TTL
+        today = datetime.strptime(today, '%Y%m%d')
+        oldest = _day(today - timedelta(days=SERIES_DAYS))
+        for key in [key for key in self.visitors if key[1] is not None and key[1] < oldest]:
+            del self.visitors[key]
+        oldest = _day(today - SEEN_TTL + timedelta(days=1))
+        for key in [key for key in self.seen if key[1] < oldest]:
+            del self.seen[key]
+
+    def unique_visitors(self, property_ids):
+        with self.visitors_lock:
+            return {pk: self._count((str(pk), None)) for pk in property_ids}
+
+    def daily_unique_visitors(self, property_id, days):
+        with self.visitors_lock:
+            return {day: self._count((str(property_id), day)) for day in days}
+
+    def _count(self, key):
+        sketch = self.visitors.get(key)
+        return sketch.count() if sketch else 0
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+_flusher = None
+
+
+def get_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                backend = settings.CACHES['default']['BACKEND']
+                _buffer = RedisVisitBuffer() if backend.startswith('django_redis') else LocalVisitBuffer()
+    return _buffer
+
+
+def record_visit(property_id, visitor=None):
+    """
+    Buffer one visit and return how many visits are pending for the property,
+    i.e. what has to be added to the stored visit_count for a live figure.
+    Repeat visits by the same visitor on the same day are not counted.
+    """
+    ensure_flusher()
+    buffer = get_buffer()
+    if visitor is not None and not buffer.add_visitor(property_id, visitor, _day(timezone.now())):
+        return buffer.pending(property_id)
+    return buffer.add(property_id)
+
+
+def pending_visits(property_id):
+    return get_buffer().pending(property_id)
+
+
+def daily_unique_visitors(property_id, days=SERIES_DAYS):
+    """Unique visitors per day for the last `days` days, oldest first."""
+    today = timezone.now().date()
+    dates = [today - timedelta(days=offset) for offset in range(min(days, SERIES_DAYS) - 1, -1, -1)]
+    counts = get_buffer().daily_unique_visitors(property_id, [_day(date) for date in dates])
+    return [{'date': date, 'unique_visitors': counts[_day(date)]} for date in dates]
+
+
+def flush_visits():
+    """
+    Apply every buffered visit to Property.visit_count. Returns the number of
+    visits written.
+    """
+    from .models import Property
+
+    buffer = get_buffer()
+    items = list(buffer.drain().items())
+    for start in range(0, len(items), FLUSH_BATCH_SIZE):
+        batch = items[start:start + FLUSH_BATCH_SIZE]
+        pks = [pk for pk, _ in batch]
+        increment = Case(
+            *[When(pk=pk, then=Value(amount)) for pk, amount in batch],
+            default=Value(0),
+            output_field=PositiveIntegerField(),
+        )
+        unique = Case(
+            *[When(pk=pk, then=Value(count)) for pk, count in buffer.unique_visitors(pks).items()],
+            default=F('unique_visitors'),
+            output_field=PositiveIntegerField(),
+        )
+        try:
+            Property.objects.filter(pk__in=pks).update(visit_count=F('visit_count') + increment, unique_visitors=unique)
+        except Exception:
+            # put back what was not written so the next flush retries it
+            for pk, amount in items[start:]:
+                buffer.add(pk, amount)
+            raise
+    return sum(amount for _, amount in items)
+
+
+def _flush_forever(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            flush_visits()
+        except Exception:
+            logger.exception('Flushing buffered visits failed')
+        finally:
+            close_old_connections()
+
+
+def ensure_flusher():
+    """Start the background flush thread for this process, once."""
+    global _flusher
+    interval = getattr(settings, 'VISIT_FLUSH_INTERVAL', 10)
+    if _flusher is not None or not interval:
+        return
+    with _buffer_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_forever, args=(interval,), name='visit-flusher', daemon=True)
+            _flusher.start()